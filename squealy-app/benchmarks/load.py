@@ -0,0 +1,353 @@
+'''Load test for squealyapp, without a real database
+
+Run from the squealy-app directory -
+
+    python -m benchmarks.load --workers 2 --threads 8 --duration 10
+    python -m benchmarks.load --latency lognormal:50:0.8 --rows 10:5000 --cache-ttl 60 --zipf 1.2
+    python -m benchmarks.load --save results.json
+
+The harness creates a squealy home in a temporary directory - a config.yml, a sqlite database,
+and --resources resources, each in its own file. Half the resources query the sqlite database,
+the other half query a fake datasource. The fake engine sleeps for a duration drawn from --latency,
+and returns the number of rows written in the query as a comment, like -- rows: 250.
+Row counts of resources are spread between the bounds of --rows.
+
+Every worker is a separate process that boots squealyapp the same way wsgi.py does,
+including the prometheus middleware. Its threads call the wsgi application directly,
+so the results measure squealy and flask, not an http server. Resources are picked at random,
+uniformly or with a zipf distribution, to compare caching modes.
+
+Reports throughput, latency percentiles, and the memory of every worker, after booting and at its peak
+'''
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import queue
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+import yaml
+
+from squealy import Engine, Table
+
+# Columns of the tables returned by the sqlite and the fake datasource
+COLUMNS = ['id', 'name', 'category', 'price', 'quantity', 'created_on']
+
+_ROWS_COMMENT = '-- rows: '
+
+def parse_latency(spec):
+    '''Returns a function that draws a latency in seconds from a distribution, described in milliseconds as -
+        constant:MS, uniform:LOW:HIGH, normal:MEAN:STDDEV, lognormal:MEDIAN:SIGMA or exponential:MEAN
+    '''
+    name, *args = spec.split(':')
+    try:
+        args = [float(arg) for arg in args]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid latency " + spec)
+    distributions = {
+        'constant': (1, lambda rand, ms: ms),
+        'uniform': (2, lambda rand, low, high: rand.uniform(low, high)),
+        'normal': (2, lambda rand, mean, stddev: max(rand.gauss(mean, stddev), 0)),
+        'lognormal': (2, lambda rand, median, sigma: rand.lognormvariate(math.log(median), sigma)),
+        'exponential': (1, lambda rand, mean: rand.expovariate(1 / mean)),
+    }
+    if name not in distributions or len(args) != distributions[name][0]:
+        raise argparse.ArgumentTypeError("Invalid latency " + spec + ", see --help for the supported distributions")
+    draw = distributions[name][1]
+    return lambda rand: draw(rand, *args) / 1000
+
+def parse_range(spec):
+    'LOW:HIGH, or a single number'
+    try:
+        low, _, high = spec.partition(':')
+        low = int(low)
+        high = int(high) if high else low
+    except ValueError:
+        raise argparse.ArgumentTypeError("Invalid range " + spec)
+    if low < 0 or high < low:
+        raise argparse.ArgumentTypeError("Invalid range " + spec)
+    return (low, high)
+
+def _row(i):
+    return (i, 'item ' + str(i), 'category ' + str(i % 17), round((i * 7919) % 10000 / 100, 2), i % 50, '2020-01-01')
+
+class FakeEngine(Engine):
+    '''Simulates a remote database - sleeps for a random latency, then returns rows that are generated once
+
+    The number of rows is read from a comment in the query, like -- rows: 250
+    '''
+    thread_safe = True
+    dialect = 'sqlite'
+    param_style = 'qmark'
+
+    def __init__(self, latency, seed=None):
+        self.latency = latency
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def execute(self, query, bind_params):
+        num_rows = 0
+        for line in query.splitlines():
+            line = line.strip()
+            if line.startswith(_ROWS_COMMENT):
+                num_rows = int(line[len(_ROWS_COMMENT):])
+        with self._lock:
+            seconds = self.latency(self.random)
+            data = self._tables.get(num_rows)
+            if data is None:
+                data = self._tables[num_rows] = [_row(i) for i in range(num_rows)]
+        time.sleep(seconds)
+        return Table(COLUMNS, data)
+
+def create_home(directory, args):
+    'Writes config.yml, a sqlite database and the resources to directory. Returns the path of config.yml'
+    low, high = args.rows
+    database = os.path.join(directory, 'load.db')
+    conn = sqlite3.connect(database)
+    conn.execute("CREATE TABLE items (" + ", ".join(COLUMNS) + ")")
+    conn.executemany("INSERT INTO items VALUES (?, ?, ?, ?, ?, ?)", (_row(i) for i in range(high)))
+    conn.commit()
+    conn.close()
+
+    config = {
+        "datasources": [
+            {"id": "sqlitedb", "url": "sqlite:///" + database},
+            # The engine of this datasource is replaced by FakeEngine once the app boots
+            {"id": "fake", "url": "sqlite://"},
+        ]
+    }
+    config_file = os.path.join(directory, 'config.yml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+
+    rand = random.Random(args.seed)
+    for i in range(args.resources):
+        # Spread row counts evenly on a log scale, so there are as many small resources as large ones
+        num_rows = int(round(math.exp(rand.uniform(math.log(low + 1), math.log(high + 1))))) - 1
+        if i % 2 == 0:
+            datasource = 'sqlitedb'
+            query = "SELECT * FROM items WHERE id < " + str(num_rows)
+        else:
+            datasource = 'fake'
+            query = _ROWS_COMMENT + str(num_rows) + "\nSELECT * FROM items"
+        resource = {
+            "id": "load-" + str(i),
+            "path": "/load/" + str(i),
+            "datasource": datasource,
+            "queries": [{"queryForList": query}],
+        }
+        if args.cache_ttl:
+            resource["cache"] = {"ttl": args.cache_ttl}
+        with open(os.path.join(directory, "load-" + str(i) + ".resource.yml"), 'w') as f:
+            yaml.safe_dump(resource, f)
+    return config_file
+
+def _memory_kb():
+    'Resident memory of this process, in kilobytes. Returns None where /proc is not available'
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (OSError, ValueError):
+        return None
+
+def _peak_memory_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, and kilobytes elsewhere
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+def _weights(count, zipf):
+    if not zipf:
+        return None
+    return [1 / (rank ** zipf) for rank in range(1, count + 1)]
+
+def _call(application, path):
+    '''Calls the wsgi application and reads the complete body. Returns the status code and the size of the body'''
+    from werkzeug.test import EnvironBuilder
+    environ = EnvironBuilder(path=path).get_environ()
+    status = []
+    def start_response(status_line, headers, exc_info=None):
+        status.append(int(status_line.split(' ', 1)[0]))
+    body = application(environ, start_response)
+    try:
+        size = sum(len(chunk) for chunk in body)
+    finally:
+        if hasattr(body, 'close'):
+            body.close()
+    return status[0], size
+
+def worker(number, config_file, args, barrier, results):
+    'Boots squealyapp in this process, and sends requests from args.threads threads for args.duration seconds'
+    os.environ['SQUEALY_CONFIG_FILE'] = config_file
+    import squealyapp
+    squealy = squealyapp.app.extensions['squealy']
+    squealy.add_engine('fake', FakeEngine(parse_latency(args.latency_spec), seed=args.seed + number))
+    application = squealyapp.wsgi_app
+    paths = ["/load/" + str(i) for i in range(args.resources)]
+    weights = _weights(len(paths), args.zipf)
+    boot_memory = _memory_kb()
+
+    latencies = []
+    errors = []
+    response_bytes = []
+    def run(thread):
+        rand = random.Random(args.seed * 1000 + number * 100 + thread)
+        thread_latencies = []
+        thread_errors = 0
+        thread_bytes = 0
+        deadline = time.perf_counter() + args.duration
+        while time.perf_counter() < deadline:
+            path = rand.choices(paths, weights)[0]
+            start = time.perf_counter()
+            try:
+                status, size = _call(application, path)
+            except Exception:
+                status, size = 500, 0
+            thread_latencies.append(time.perf_counter() - start)
+            thread_bytes += size
+            if status >= 400:
+                thread_errors += 1
+        latencies.extend(thread_latencies)
+        errors.append(thread_errors)
+        response_bytes.append(thread_bytes)
+
+    # Warm up compiled templates and connection pools, then start all workers at the same time
+    for path in paths:
+        _call(application, path)
+    barrier.wait()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=run, args=(i, )) for i in range(args.threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    scrape_start = time.perf_counter()
+    status, metrics_bytes = _call(application, '/metrics')
+    results.put({
+        "worker": number,
+        "elapsed": elapsed,
+        "latencies": latencies,
+        "errors": sum(errors),
+        "response_bytes": sum(response_bytes),
+        "boot_memory_kb": boot_memory,
+        "peak_memory_kb": _peak_memory_kb(),
+        "metrics_scrape_ms": round((time.perf_counter() - scrape_start) * 1000, 3) if status == 200 else None,
+    })
+
+def _collect(processes, results):
+    'Waits for the results of every worker. Stops all workers if one of them fails, for example while booting the app'
+    workers = []
+    while len(workers) < len(processes):
+        try:
+            workers.append(results.get(timeout=1))
+        except queue.Empty:
+            failed = [p for p in processes if p.exitcode not in (None, 0)]
+            if failed:
+                for process in processes:
+                    process.terminate()
+                raise SystemExit("A worker exited with code " + str(failed[0].exitcode))
+    for process in processes:
+        process.join()
+    return workers
+
+def percentile(values, fraction):
+    'values must be sorted'
+    if not values:
+        return None
+    index = min(int(math.ceil(fraction * len(values))) - 1, len(values) - 1)
+    return values[max(index, 0)]
+
+def summarize(args, workers):
+    latencies = sorted(latency for w in workers for latency in w['latencies'])
+    elapsed = max(w['elapsed'] for w in workers)
+    to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "parameters": {
+            "workers": args.workers,
+            "threads": args.threads,
+            "duration": args.duration,
+            "resources": args.resources,
+            "latency": args.latency_spec,
+            "rows": "%d:%d" % args.rows,
+            "cache_ttl": args.cache_ttl,
+            "zipf": args.zipf,
+        },
+        "requests": len(latencies),
+        "errors": sum(w['errors'] for w in workers),
+        "throughput": round(len(latencies) / elapsed, 2),
+        "latency_ms": {
+            "p50": to_ms(percentile(latencies, 0.5)),
+            "p90": to_ms(percentile(latencies, 0.9)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+        "workers": [{
+            "worker": w['worker'],
+            "requests": len(w['latencies']),
+            "response_bytes": w['response_bytes'],
+            "boot_memory_kb": w['boot_memory_kb'],
+            "peak_memory_kb": w['peak_memory_kb'],
+            "metrics_scrape_ms": w['metrics_scrape_ms'],
+        } for w in sorted(workers, key=lambda w: w['worker'])],
+    }
+
+def print_summary(summary):
+    print("%d requests, %d errors, %.1f requests/second" % (summary['requests'], summary['errors'], summary['throughput']))
+    latency = summary['latency_ms']
+    print("latency ms - p50 %s, p90 %s, p99 %s, max %s" % (latency['p50'], latency['p90'], latency['p99'], latency['max']))
+    for w in summary['workers']:
+        print("worker %d - %d requests, memory %s kB after boot, %s kB peak, /metrics in %s ms" % (
+            w['worker'], w['requests'], w['boot_memory_kb'], w['peak_memory_kb'], w['metrics_scrape_ms']))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test for squealyapp")
+    parser.add_argument('--workers', type=int, default=1, help="number of worker processes")
+    parser.add_argument('--threads', type=int, default=4, help="number of threads in each worker")
+    parser.add_argument('--duration', type=float, default=10, help="seconds to send requests for")
+    parser.add_argument('--resources', type=int, default=20, help="number of resources")
+    parser.add_argument('--latency', dest='latency_spec', default='lognormal:20:0.5',
+        help="latency of the fake datasource in milliseconds - constant:MS, uniform:LOW:HIGH, "
+            "normal:MEAN:STDDEV, lognormal:MEDIAN:SIGMA or exponential:MEAN")
+    parser.add_argument('--rows', type=parse_range, default=(10, 1000), help="rows returned by a resource, LOW:HIGH")
+    parser.add_argument('--cache-ttl', type=int, default=None, help="cache results of every resource for these many seconds")
+    parser.add_argument('--zipf', type=float, default=0,
+        help="pick resources with a zipf distribution of this exponent, instead of uniformly")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--save', default=None, help="save the results as json to this file")
+    args = parser.parse_args(argv)
+    # Fail early on an invalid distribution. Workers parse it again, because functions cannot be sent to a process
+    try:
+        parse_latency(args.latency_spec)
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+
+    with tempfile.TemporaryDirectory(prefix='squealy-load-') as directory:
+        config_file = create_home(directory, args)
+        # Workers are spawned rather than forked, so every worker boots the app like a fresh uwsgi process
+        context = multiprocessing.get_context('spawn')
+        barrier = context.Barrier(args.workers)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(i, config_file, args, barrier, results))
+                        for i in range(args.workers)]
+        for process in processes:
+            process.start()
+        workers = _collect(processes, results)
+
+    summary = summarize(args, workers)
+    print_summary(summary)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(summary, f, indent=2)
+    return 1 if summary['errors'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -9,15 +9,27 @@ import yaml
 from jinja2 import Environment, FileSystemLoader, TemplateNotFound
 
 from squealy import Resource, SquealyConfigException
-from squealy.flask import FlaskSquealy, SqlAlchemyEngine, SqlView
+from squealy.flask import FlaskSquealy, SqlView
+from squealy.http import Compression
+from squealyapp.metrics import InstrumentedSqlAlchemyEngine, POOLS
 
 def bootstrap():
     config = _load_config()
     app = Flask(__name__)
     app.config.update(config)
-    squealy = FlaskSquealy(app, _find_resources_dir(config))
+    bundle = _find_bundle(config)
+    # lazy builds each resource on its first request, and warmUp then builds the rest in the background
+    lazy = config.get('lazy', False)
+    if bundle:
+        squealy = FlaskSquealy(app, bundle=bundle, lazy=lazy)
+    else:
+        squealy = FlaskSquealy(app, _find_resources_dir(config), lazy=lazy)
+    if lazy and config.get('warmUp', False):
+        squealy.warm_up()
     _load_engines(squealy, config)
-    _load_routes(app, squealy)
+    view_options = _view_options(config)
+    _load_routes(app, squealy, view_options)
+    _watch_resources(app, squealy, config, view_options)
     _register_swagger(app, config)
     wsgi_app = _add_promethueus_middleware(app)
     return (app, wsgi_app)
@@ -47,6 +59,19 @@ def _find_resources_dir(config):
         raise SquealyConfigException(resources_dir + " does not exist!")
     return resources_dir
 
+def _find_bundle(config):
+    # bundle is built with python -m squealy.bundle, and loads much faster than the yaml files in resources_dir
+    # If it is a relative path, assume it is relative to the directory containing config file
+    bundle = config.get('bundle', None)
+    if not bundle:
+        return None
+    if not os.path.isabs(bundle):
+        config_dir = os.path.abspath(os.path.dirname(os.environ.get('SQUEALY_CONFIG_FILE')))
+        bundle = os.path.join(config_dir, bundle)
+    if not os.path.exists(bundle):
+        raise SquealyConfigException(bundle + " does not exist!")
+    return bundle
+
 def _load_engines(squealy, config):
     datasources = config.get('datasources', [])
     if not datasources:
@@ -57,12 +82,49 @@ def _load_engines(squealy, config):
     for datasource in datasources:
         _id = datasource['id']
         url = datasource['url']
+        pool_options = _pool_options(_id, datasource.get('pool', None))
         try:
-            engine = create_engine(url)
-        except SQLAlchemyError as e:
+            engine = create_engine(url, **pool_options)
+        except (SQLAlchemyError, TypeError) as e:
+            # TypeError means the pool used by this database does not accept one of the pool settings
             raise SquealyConfigException("Could not load SQLAlchemy Engine for datasource " + _id + ", url = " + url) from e
-        squealy.add_engine(_id, SqlAlchemyEngine(engine))
+        squealy.add_engine(_id, InstrumentedSqlAlchemyEngine(_id, engine))
+        POOLS.add_engine(_id, engine)
+
+# Pool settings in config.yml, and the corresponding argument of sqlalchemy's create_engine
+_POOL_OPTIONS = {
+    'size': 'pool_size',
+    'maxOverflow': 'max_overflow',
+    'recycle': 'pool_recycle',
+    'prePing': 'pool_pre_ping',
+    'timeout': 'pool_timeout',
+}
+
+def _pool_options(_id, pool):
+    if not pool:
+        return {}
+    if not isinstance(pool, dict):
+        raise SquealyConfigException("pool must be an object, in datasource " + _id)
+    unknown = set(pool.keys()) - set(_POOL_OPTIONS.keys())
+    if unknown:
+        raise SquealyConfigException("Unknown pool settings " + ", ".join(sorted(unknown)) + " in datasource " + _id)
+    return {_POOL_OPTIONS[key]: value for key, value in pool.items()}
+
 
+def _view_options(config):
+    # Responses are gzip compressed for clients that accept it. compression: false turns it off,
+    # for example if a proxy in front of squealy already compresses responses
+    compression = config.get('compression', None)
+    if compression is None:
+        return {}
+    if compression is False:
+        return {'compression': False}
+    if not isinstance(compression, dict):
+        raise SquealyConfigException("compression must be false, or an object with minSize and level")
+    unknown = set(compression.keys()) - {'minSize', 'level'}
+    if unknown:
+        raise SquealyConfigException("Unknown compression settings " + ", ".join(sorted(unknown)))
+    return {'compression': Compression(min_size=compression.get('minSize', 1024), level=compression.get('level', 6))}
 
 def _register_swagger(app, config):
     swaggerui_blueprint = get_swaggerui_blueprint(
@@ -83,11 +145,28 @@ def _add_promethueus_middleware(app):
     })
     return wsgi_app
 
-def _load_routes(app, squealy):
+def _load_routes(app, squealy, view_options):
     # Dynamically register all Resources to the function process_resource
     for _id, resource in squealy.get_resources().items():
         if resource.path:
-            app.add_url_rule(resource.path, view_func=SqlView.as_view(_id))
+            app.add_url_rule(resource.path, view_func=SqlView.as_view(_id, **view_options))
+
+def _watch_resources(app, squealy, config, view_options):
+    # reloadInterval, in seconds, picks up changes to resource files without a restart
+    # docker-entrypoint.sh sets SQUEALY_RELOAD_INTERVAL in development mode
+    interval = config.get('reloadInterval', None) or os.environ.get('SQUEALY_RELOAD_INTERVAL', None)
+    if interval:
+        squealy.watch(float(interval), on_reload=lambda: _load_new_routes(app, squealy, view_options))
+
+def _load_new_routes(app, squealy, view_options):
+    # Adds routes for resources that were added, or whose path changed, after the app started.
+    # Flask does not allow add_url_rule after the first request in debug mode, so rules are added to the url map directly.
+    # Routes of deleted resources remain until a restart, and fail because the resource does not exist
+    routes = {(rule.endpoint, rule.rule) for rule in app.url_map.iter_rules()}
+    for _id, resource in squealy.get_resources().items():
+        if resource.path and (_id, resource.path) not in routes:
+            app.view_functions.setdefault(_id, SqlView.as_view(_id, **view_options))
+            app.url_map.add(app.url_rule_class(resource.path, endpoint=_id, methods=['GET']))
 
 
 # Expose flask app as module variable
@@ -0,0 +1,53 @@
+import time
+from prometheus_client import Histogram
+from prometheus_client.core import GaugeMetricFamily, REGISTRY
+from sqlalchemy.pool import QueuePool
+
+from squealy.flask import SqlAlchemyEngine
+
+POOL_CHECKOUT_SECONDS = Histogram('squealy_pool_checkout_seconds',
+    'Time spent waiting for a connection from the pool', ['datasource'])
+
+class InstrumentedSqlAlchemyEngine(SqlAlchemyEngine):
+    'Records how long each query waits for a connection from the pool'
+    def __init__(self, datasource, engine):
+        super(InstrumentedSqlAlchemyEngine, self).__init__(engine)
+        self.checkout_seconds = POOL_CHECKOUT_SECONDS.labels(datasource=datasource)
+
+    def connect(self):
+        start = time.perf_counter()
+        conn = super(InstrumentedSqlAlchemyEngine, self).connect()
+        self.checkout_seconds.observe(time.perf_counter() - start)
+        return conn
+
+class PoolCollector:
+    '''Reports the state of every connection pool when prometheus scrapes /metrics
+
+    Only QueuePool keeps these counts. Pools used for sqlite, for example, are skipped
+    '''
+    def __init__(self):
+        # datasource id -> sqlalchemy engine
+        self.engines = {}
+
+    def add_engine(self, datasource, engine):
+        self.engines[datasource] = engine
+
+    def collect(self):
+        size = GaugeMetricFamily('squealy_pool_size',
+            'Number of connections the pool keeps open', labels=['datasource'])
+        in_use = GaugeMetricFamily('squealy_pool_connections_in_use',
+            'Number of connections checked out of the pool', labels=['datasource'])
+        overflow = GaugeMetricFamily('squealy_pool_overflow',
+            'Number of connections opened beyond the pool size', labels=['datasource'])
+        for datasource, engine in self.engines.items():
+            pool = engine.pool
+            if not isinstance(pool, QueuePool):
+                continue
+            size.add_metric([datasource], pool.size())
+            in_use.add_metric([datasource], pool.checkedout())
+            # overflow() is negative until the pool has opened pool_size connections
+            overflow.add_metric([datasource], max(pool.overflow(), 0))
+        return [size, in_use, overflow]
+
+POOLS = PoolCollector()
+REGISTRY.register(POOLS)
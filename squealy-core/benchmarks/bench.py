@@ -0,0 +1,251 @@
+'''Micro-benchmarks for the request path of squealy
+
+Run from the squealy-core directory -
+
+    python -m benchmarks.bench                              # print results
+    python -m benchmarks.bench --save baseline.json         # save results as a baseline
+    python -m benchmarks.bench --compare baseline.json      # compare with a baseline, fail on regressions
+
+Queries run against an in-memory sqlite database, filled with a synthetic table of --rows rows and --width columns.
+Every benchmark is run --repeat times, and the median and fastest run are reported in milliseconds.
+Baselines are json files, so they can be saved for one commit and compared against another.
+Timings are only comparable if they are taken on the same machine, with the same rows and width
+'''
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+from squealy import Squealy, Resource, Engine, Table, TableEncoder
+from squealy.core import JinjaWrapper, TableProxy, Query
+from squealy.formatters import JsonFormatter, SimpleFormatter, SeriesFormatter, GoogleChartsFormatter
+
+class InMemorySqliteEngine(Engine):
+    def __init__(self, conn):
+        self.conn = conn
+        self.param_style = 'qmark'
+
+    def execute(self, query, bind_params):
+        cursor = self.conn.cursor()
+        cursor.execute(query, bind_params)
+        cols = [col[0] for col in cursor.description]
+        return Table(cols, cursor.fetchall())
+
+def _column_names(width):
+    'id, then a mix of int, float and text columns. Every fourth column is nested, like author.c4'
+    names = ['id']
+    for i in range(1, width):
+        names.append(('author.c' if i % 4 == 0 else 'c') + str(i))
+    return names
+
+def _value(colnum, rownum, rand):
+    kind = colnum % 3
+    if kind == 0:
+        return rownum * colnum
+    elif kind == 1:
+        return rand.random() * 1000
+    return 'text ' + str(rand.randrange(100000))
+
+def create_database(rows, width, seed=42):
+    '''Creates the tables items, with rows rows and width columns, and comments with 3 comments per item'''
+    rand = random.Random(seed)
+    conn = sqlite3.connect(":memory:")
+    columns = _column_names(width)
+    conn.execute("CREATE TABLE items (" + ", ".join('"' + c + '"' for c in columns) + ")")
+    conn.executemany("INSERT INTO items VALUES (" + ", ".join(["?"] * width) + ")",
+        [[i] + [_value(c, i, rand) for c in range(1, width)] for i in range(rows)])
+    conn.execute("CREATE TABLE comments (id, item_id, comment)")
+    conn.executemany("INSERT INTO comments VALUES (?, ?, ?)",
+        [(i * 3 + j, i, 'comment ' + str(j)) for i in range(rows) for j in range(3)])
+    return conn
+
+class Benchmarks:
+    'Each method starting with bench_ returns a function to time, after doing any setup it needs'
+    def __init__(self, rows, width):
+        self.rows = rows
+        self.width = width
+        self.conn = create_database(rows, width)
+        self.engine = InMemorySqliteEngine(self.conn)
+        self.squealy = Squealy(metrics=False)
+        self.squealy.add_engine('default', self.engine)
+        self.items = self.engine.execute("SELECT * FROM items", [])
+        self.flat_items = Table(['c' + str(i) for i in range(width)], self.items.data)
+        self.comments = self.engine.execute("SELECT * FROM comments", [])
+
+    def names(self):
+        return [name[len('bench_'):] for name in dir(self) if name.startswith('bench_')]
+
+    # Stages
+
+    def bench_render(self):
+        jinja = JinjaWrapper()
+        query = "SELECT * FROM comments WHERE item_id in {{ items.id | inclause }} AND comment != {{ params.comment }}"
+        context = {"params": {"comment": "x"}, "items": TableProxy(self.items, 'list')}
+        return lambda: jinja.prepare_query(query, context, 'qmark')
+
+    def bench_execute(self):
+        return lambda: self.engine.execute("SELECT * FROM items", [])
+
+    def bench_table_proxy(self):
+        proxy = TableProxy(Table(self.items.columns, self.items.data), 'list')
+        return lambda: proxy.id
+
+    def bench_as_dict_flat(self):
+        return lambda: Table(self.flat_items.columns, self.flat_items.data).as_dict()
+
+    def bench_as_dict_nested(self):
+        return lambda: Table(self.items.columns, self.items.data).as_dict()
+
+    def bench_unflatten(self):
+        columns = self.items.columns
+        rows = self.items.data
+        return lambda: [Table.unflatten(dict(zip(columns, row))) for row in rows]
+
+    def bench_merge(self):
+        formatter = JsonFormatter()
+        query = Query(key='comments', queryForList='SELECT 1', merge={'parent': 'id', 'child': 'item_id'})
+        root = Query(isRoot=True, queryForList='SELECT 1')
+        def merge():
+            results = formatter.format(None, root, Table(self.items.columns, self.items.data))
+            return formatter.format(results, query, Table(self.comments.columns, self.comments.data))
+        return merge
+
+    # Formatters, from a fresh table so that cached column vectors are not reused
+
+    def _format(self, formatter):
+        query = Query(isRoot=True, queryForList='SELECT 1')
+        return lambda: formatter.format(None, query, Table(self.items.columns, self.items.data))
+
+    def _encode(self, formatter):
+        query = Query(isRoot=True, queryForList='SELECT 1')
+        encoder = TableEncoder()
+        return lambda: formatter.encode(query, Table(self.items.columns, self.items.data), encoder)
+
+    def bench_format_json(self):
+        return self._format(JsonFormatter())
+
+    def bench_format_simple(self):
+        return self._format(SimpleFormatter())
+
+    def bench_format_series(self):
+        return self._format(SeriesFormatter())
+
+    def bench_format_google_charts(self):
+        return self._format(GoogleChartsFormatter())
+
+    def bench_encode_json(self):
+        return self._encode(JsonFormatter())
+
+    def bench_encode_simple(self):
+        return self._encode(SimpleFormatter())
+
+    def bench_encode_series(self):
+        return self._encode(SeriesFormatter())
+
+    def bench_encode_google_charts(self):
+        return self._encode(GoogleChartsFormatter())
+
+    def bench_serialize_json_dumps(self):
+        data = {"data": self.items.as_dict()}
+        return lambda: json.dumps(data)
+
+    # Complete requests
+
+    def bench_request_list(self):
+        resource = Resource("items", queries=[{"queryForList": "SELECT * FROM items"}])
+        return lambda: resource.process_json(self.squealy, {"params": {}})
+
+    def bench_request_parent_child(self):
+        resource = Resource("items-with-comments", queries=[
+            {"contextKey": "items", "queryForList": "SELECT * FROM items"},
+            {"key": "comments", "merge": {"parent": "id", "child": "item_id"},
+                "queryForList": "SELECT * FROM comments WHERE item_id in {{ items.id | inclause }}"}
+        ])
+        return lambda: resource.process_json(self.squealy, {"params": {}})
+
+def run(benchmarks, names, repeat):
+    results = {}
+    for name in names:
+        fn = getattr(benchmarks, 'bench_' + name)()
+        fn()  # warm up caches, like compiled templates
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {"median_ms": round(statistics.median(timings), 4), "min_ms": round(min(timings), 4)}
+        print("%-28s median %10.3f ms   min %10.3f ms" % (name, results[name]['median_ms'], results[name]['min_ms']))
+    return results
+
+def compare(results, baseline, threshold):
+    'Prints the change of every benchmark against the baseline, and returns the names of benchmarks that regressed'
+    regressions = []
+    print("\n%-28s %12s %12s %9s" % ("benchmark", "baseline ms", "current ms", "change"))
+    for name, result in results.items():
+        before = baseline['results'].get(name)
+        if not before:
+            print("%-28s %12s %12.3f" % (name, "-", result['median_ms']))
+            continue
+        change = (result['median_ms'] - before['median_ms']) / before['median_ms'] if before['median_ms'] else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print("%-28s %12.3f %12.3f %+8.1f%%%s" % (name, before['median_ms'], result['median_ms'], change * 100, flag))
+    return regressions
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for squealy")
+    parser.add_argument('--rows', type=int, default=2000, help="rows in the synthetic table")
+    parser.add_argument('--width', type=int, default=12, help="columns in the synthetic table")
+    parser.add_argument('--repeat', type=int, default=20, help="number of times each benchmark is run")
+    parser.add_argument('--filter', default=None, help="only run benchmarks whose name contains this text")
+    parser.add_argument('--save', default=None, help="save the results as a json baseline to this file")
+    parser.add_argument('--compare', default=None, help="compare the results with a baseline saved earlier")
+    parser.add_argument('--threshold', type=float, default=0.1,
+        help="with --compare, exit with an error if a median is slower by more than this fraction")
+    args = parser.parse_args(argv)
+
+    benchmarks = Benchmarks(args.rows, args.width)
+    names = [name for name in benchmarks.names() if not args.filter or args.filter in name]
+    results = run(benchmarks, names, args.repeat)
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "date": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "rows": args.rows,
+            "width": args.width,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if (baseline['meta']['rows'], baseline['meta']['width']) != (args.rows, args.width):
+            print("Warning: baseline was taken with rows = %s, width = %s" % (baseline['meta']['rows'], baseline['meta']['width']))
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nSlower than the baseline by more than %d%% - %s" % (args.threshold * 100, ", ".join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
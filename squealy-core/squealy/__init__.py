@@ -1,2 +1,3 @@
-from .core import Squealy, SquealyException, SquealyConfigException, SquealyYamlException
-from .core import Resource, Engine, Table
+from .core import Squealy, SquealyException, SquealyConfigException, SquealyYamlException, SquealyBadRequestException
+from .core import Resource, Engine, AsyncEngine, SyncEngineAdapter, Table, RequestStats, HookEvent
+from .encoders import TableEncoder
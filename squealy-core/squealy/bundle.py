@@ -0,0 +1,101 @@
+'''Bundles resources, snippets and their compiled templates into a single file
+
+Loading resources from yaml files means walking directories, parsing every file and compiling every template.
+With hundreds of resources, that slows down the start of every process. Instead, build a bundle
+as part of building the application or its docker image -
+
+    python -m squealy.bundle resources/ more-resources/ --output squealy.bundle
+
+and load it at startup with Squealy.load_bundle, which reads one file.
+
+Resources are validated and their templates compiled when the bundle is built,
+so a bundle that builds without errors also loads without errors.
+Compiled templates are python bytecode, which only works on the python and jinja2 versions that built the bundle.
+On other versions the bundle still loads, but templates are compiled at startup.
+
+Bundles are pickled - only load bundles that you built
+'''
+import argparse
+import copy
+import logging
+import marshal
+import pickle
+import sys
+
+import jinja2
+
+from .core import Squealy, SquealyConfigException
+
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# Incremented when the contents of a bundle change, bundles of other versions must be rebuilt
+BUNDLE_FORMAT = 1
+
+def _runtime():
+    'Compiled templates can only be loaded by the python and jinja2 versions that compiled them'
+    return (sys.implementation.cache_tag, jinja2.__version__)
+
+def build_bundle(dirs, bundle_file):
+    '''Loads resources and snippets from the directories, and writes them to bundle_file with their compiled templates
+
+    Raises SquealyConfigException if a resource or template is invalid. Returns the Squealy object used to validate them
+    '''
+    squealy = Squealy(metrics=False)
+    objects = squealy._read_objects(dirs)
+    raw_objects = copy.deepcopy(objects)
+    loaded = squealy._add_objects(objects)
+
+    # Bundle the queries of each resource as parsed and validated, so they are not parsed again at startup.
+    # Files in different directories can have the same name, so each object is paired with the resource built from it
+    for (ymlfile, type, rawobj), (_, added) in zip(raw_objects, loaded):
+        if type == 'resource' and rawobj:
+            rawobj['queries'] = added[str(ymlfile)].queries
+
+    jinja = squealy.get_jinja()
+    templates = {template for resource in squealy.resources.values() for template in resource.templates()}
+    jinja.compile_snippets()
+    bundle = {
+        "format": BUNDLE_FORMAT,
+        "runtime": _runtime(),
+        "objects": raw_objects,
+        "templates": {template: marshal.dumps(jinja.compile(template)) for template in templates},
+        "snippets_bytecode": dict(squealy.snippets_bytecode),
+    }
+    with open(bundle_file, 'wb') as f:
+        pickle.dump(bundle, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return squealy
+
+def read_bundle(bundle_file):
+    '''Reads a bundle written by build_bundle
+
+    Returns a dict with objects, in the form returned by Squealy._read_objects, templates - a dict of template text -> code,
+    and snippets_bytecode. templates is empty if the bundle was built by a different python or jinja2
+    '''
+    try:
+        with open(bundle_file, 'rb') as f:
+            bundle = pickle.loads(f.read())
+    except (OSError, pickle.UnpicklingError, AttributeError, ImportError, EOFError) as e:
+        raise SquealyConfigException("Could not read bundle " + str(bundle_file)) from e
+    if not isinstance(bundle, dict) or bundle.get('format') != BUNDLE_FORMAT:
+        raise SquealyConfigException("Bundle " + str(bundle_file) + " was built by a different version of squealy, rebuild it")
+
+    if tuple(bundle['runtime']) == _runtime():
+        bundle['templates'] = {template: marshal.loads(code) for template, code in bundle['templates'].items()}
+    else:
+        logger.warning("Bundle %s was built with %s, templates will be compiled at startup", bundle_file, bundle['runtime'])
+        bundle['templates'] = {}
+    return bundle
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m squealy.bundle",
+        description="Validates resources and snippets, and bundles them with their compiled templates into a single file")
+    parser.add_argument('dirs', nargs='+', help="directories containing resource and snippet files")
+    parser.add_argument('-o', '--output', default='squealy.bundle', help="the bundle file to write")
+    args = parser.parse_args(argv)
+    squealy = build_bundle(args.dirs, args.output)
+    num_resources = len({resource.id for resource in squealy.resources.values()})
+    print("Bundled %d resources and %d snippets into %s" % (num_resources, len(squealy.snippets), args.output))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+class LRUCache:
+    '''A thread safe, bounded mapping that evicts the least recently used entry
+
+    Used to hold compiled templates, so that jinja does not re-parse the same template on every request,
+    and to hold query results of resources that enable caching.
+
+    ttl is the number of seconds after which an entry expires.
+    If max_bytes is provided, sizeof must be a function that estimates the size of a value in bytes,
+    and entries are evicted until the total size is within max_bytes
+    '''
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None, sizeof=None):
+        if not max_entries or max_entries < 1:
+            raise ValueError("max_entries must be a positive integer")
+        if max_bytes and not sizeof:
+            raise ValueError("sizeof is required when max_bytes is provided")
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # key -> (value, expires_at, size)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires_at, size = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes else 0
+        if self.max_bytes and size > self.max_bytes:
+            # Caching this value would evict everything else, and still not fit
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.size > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self.size -= size
@@ -0,0 +1,78 @@
+import asyncio
+from threading import Event, Lock
+
+class SingleFlight:
+    '''Coalesces identical calls that are in flight at the same time
+
+    The first caller for a key executes the function. Callers that arrive with the same key
+    while the function is still running wait for it to finish, and share its return value.
+    If the function raises an exception, the same exception is raised in every waiting caller.
+
+    Nothing is remembered after the function returns, so this is not a cache.
+    '''
+    def __init__(self):
+        self._lock = Lock()
+        self._calls = {}
+
+    def do(self, key, fn, *args, **kwargs):
+        '''Returns a tuple (result, shared)
+
+        shared is True if the result was produced by a call made by another thread
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+
+        if not is_leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return (call.result, True)
+
+        try:
+            call.result = fn(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return (call.result, False)
+
+    def __len__(self):
+        return len(self._calls)
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+class AsyncSingleFlight:
+    '''SingleFlight for coroutines
+
+    The coroutine runs as a separate task, and every caller awaits the same task.
+    A caller that is cancelled does not cancel the query for the other callers.
+    Calls are only coalesced within the same event loop.
+    '''
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args, **kwargs):
+        'Returns a tuple (result, shared), see SingleFlight.do'
+        key = (asyncio.get_event_loop(), key)
+        task = self._calls.get(key)
+        shared = task is not None
+        if not shared:
+            task = self._calls[key] = asyncio.ensure_future(fn(*args, **kwargs))
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        result = await asyncio.shield(task)
+        return (result, shared)
+
+    def __len__(self):
+        return len(self._calls)
@@ -1,12 +1,33 @@
+from jinja2 import BytecodeCache
 from jinja2 import DictLoader
 from jinja2 import Environment
+from jinja2 import TemplateSyntaxError
+from jinja2 import meta
 from jinjasql import JinjaSql
+from jinjasql.core import bind_in_clause
+import base64
+import binascii
+import json
 import os
+import re
+import sys
+import time
+import weakref
 import yaml
 from yaml.error import MarkedYAMLError
+from fnmatch import fnmatch
 from pathlib import Path
 from .formatters import JsonFormatter
-from itertools import chain
+from .encoders import TableEncoder, convert
+from .cache import LRUCache
+from .concurrency import SingleFlight, AsyncSingleFlight
+from .metrics import default_metrics
+from itertools import chain, islice
+from functools import lru_cache, partial
+from operator import itemgetter
+import asyncio
+from threading import Event, Lock, RLock, Thread, local
+from concurrent.futures import Future, ThreadPoolExecutor
 import logging
 
 logger = logging.getLogger(__name__)
@@ -38,16 +59,95 @@ class SquealyConfigException(SquealyException):
 class SquealyYamlException(SquealyConfigException):
     pass
 
+class SquealyBadRequestException(SquealyException):
+    'Indicates that the request has invalid parameters, for example a malformed pagination cursor'
+    code = status_code = 400
+    description = default_detail = "Bad Request"
+    default_code = "bad-request"
+
+def check_int(name, value, minimum=1, maximum=None):
+    'Raises SquealyConfigException unless value is an integer within the range. Booleans are not accepted as integers'
+    if isinstance(value, int) and not isinstance(value, bool) and value >= minimum and (maximum is None or value <= maximum):
+        return
+    if maximum is not None:
+        expected = " must be an integer between " + str(minimum) + " and " + str(maximum)
+    elif minimum == 1:
+        expected = " must be a positive integer"
+    elif minimum == 0:
+        expected = " must be 0 or a positive integer"
+    else:
+        expected = " must be an integer of at least " + str(minimum)
+    raise SquealyConfigException(name + expected)
+
 class Squealy:
     '''
     Container for all resources, data sources and code snippets
     Typically, your application will create an instance at startup and use it throughout
     '''
-    def __init__(self, snippets=None, resources=None):
+    def __init__(self, snippets=None, resources=None, template_cache_size=4096, coalesce_queries=True, max_workers=8,
+                    inclause_chunk_size=None, metrics=None, lazy=False):
         self.engines = {}
         self.snippets = snippets or {}
         self.resources = resources or {}
+        # Compiled templates outlive a reload of snippets, entries are keyed by the snippets version
+        self.templates = LRUCache(template_cache_size)
+        # Compiled snippets, keyed by jinja's bytecode cache. Snippets that did not change are not compiled again on a reload
+        self.snippets_bytecode = {}
+        # Identical queries running concurrently in different threads are sent to the database only once
+        self.single_flight = SingleFlight() if coalesce_queries else None
+        self.async_single_flight = AsyncSingleFlight() if coalesce_queries else None
+        # Independent queries of a resource run concurrently on a thread pool of this size
+        self.max_workers = max_workers
+        # Lists larger than this, when used with the inclause filter, are split into several queries.
+        # Queries can override it using chunkSize
+        self.inclause_chunk_size = inclause_chunk_size
+        # PrometheusMetrics that time each stage of a request. By default, metrics are collected
+        # in prometheus_client's default registry if it is installed. Pass False to disable metrics
+        self.metrics = default_metrics() if metrics is None else (metrics or None)
+        # event -> tuple of functions, see add_hook. Replaced as a whole when hooks change, so requests can read it without a lock
+        self.hooks = {}
+        self._hooks_lock = Lock()
+        self._executor = None
+        self._executor_lock = Lock()
+        self._async_engines = {}
+        # In lazy mode, resources loaded from files are only parsed, validated and compiled when they are first used
+        self.lazy = lazy
+        # Directories passed to load_objects, and for each file loaded from them, (stamp, (type, objects it added)).
+        # Used by reload() to find files that changed
+        self._watched_dirs = []
+        self._files = {}
+        self._failed_stamps = None
+        self._watcher = None
+        self._reload_lock = RLock()
+        # True while warm_up builds resources in a background thread
+        self._warming_up = False
         self._reload_jinja()
+        _INSTANCES.add(self)
+
+    def add_hook(self, event, fn):
+        '''Calls fn with a HookEvent whenever the event happens, while processing any resource
+
+        Events are before_render, after_render, before_execute, after_execute, before_format, after_format,
+        before_serialize, after_serialize and on_error. Render and execute happen once per query.
+        Exceptions raised by fn are not caught, so a before hook can reject a request.
+        When no hooks are registered, requests do not pay for them
+        '''
+        if event not in HOOK_EVENTS:
+            raise SquealyConfigException("Unknown hook event " + str(event) + ", must be one of " + ", ".join(HOOK_EVENTS))
+        with self._hooks_lock:
+            hooks = dict(self.hooks)
+            hooks[event] = hooks.get(event, ()) + (fn, )
+            self.hooks = hooks
+
+    def remove_hook(self, event, fn):
+        with self._hooks_lock:
+            hooks = dict(self.hooks)
+            remaining = tuple(f for f in hooks.get(event, ()) if f is not fn)
+            if remaining:
+                hooks[event] = remaining
+            else:
+                hooks.pop(event, None)
+            self.hooks = hooks
 
     def add_engine(self, name, engine):
         'An Engine is responsible for querying an underlying SQL or NoSQL based data source'
@@ -60,63 +160,359 @@ class Squealy:
             name = 'default'
         return self.engines[name]
     
-    def _reload_jinja(self):
-        self.jinja = JinjaWrapper(self.snippets)
+    def execute(self, engine, query, bind_params, stats=None, limits=None):
+        '''Executes the query on the engine, sharing the results with identical queries that are already running
+
+        If limits are provided, rows are fetched in batches until the ResultLimits are exceeded
+        '''
+        execute = engine.execute if limits is None else partial(limits.fetch, engine)
+        if self.single_flight is None:
+            return execute(query, bind_params)
+        key = _query_key(engine, limits, query, bind_params)
+        if key is None:
+            return execute(query, bind_params)
+        table, shared = self.single_flight.do(key, execute, query, bind_params)
+        if shared:
+            logger.debug("Shared results of an identical query running concurrently")
+            if stats is not None:
+                stats.increment('queries_coalesced')
+        return table
+
+    def get_async_engine(self, name):
+        'Returns the engine for the datasource as an AsyncEngine, adapting synchronous engines if required'
+        engine = self.get_engine(name)
+        if isinstance(engine, AsyncEngine):
+            return engine
+        try:
+            return self._async_engines[engine]
+        except KeyError:
+            adapter = self._async_engines[engine] = self._adapt_engine(engine)
+            return adapter
+
+    def _adapt_engine(self, engine):
+        executor = self._get_executor() if engine.thread_safe else None
+        return SyncEngineAdapter(engine, executor)
+
+    async def execute_async(self, engine, query, bind_params, stats=None, limits=None):
+        '''Awaits the query on an AsyncEngine, sharing the results with identical queries that are already running
+
+        If limits are provided and the engine is an adapted synchronous engine, rows are fetched in batches
+        until the limits are exceeded. Other async engines fetch all rows, and limits are applied afterwards
+        '''
+        execute = engine.execute
+        if limits is not None and isinstance(engine, SyncEngineAdapter):
+            execute = partial(engine.run, limits.fetch, engine.engine)
+        if self.async_single_flight is None:
+            return await execute(query, bind_params)
+        key = _query_key(engine, limits, query, bind_params)
+        if key is None:
+            return await execute(query, bind_params)
+        table, shared = await self.async_single_flight.do(key, execute, query, bind_params)
+        if shared:
+            logger.debug("Shared results of an identical query running concurrently")
+            if stats is not None:
+                stats.increment('queries_coalesced')
+        return table
+
+    def run_concurrently(self, calls):
+        '''Runs the functions and returns their results, in the same order
+
+        calls is a list of (function, thread_safe) tuples.
+        Thread safe functions run on the thread pool, the rest run one after another in the calling thread.
+        If a function raises an exception, it is raised after the functions before it have completed.
+        '''
+        if len(calls) < 2 or not self.max_workers or self.max_workers < 2:
+            return [fn() for fn, _ in calls]
+        executor = self._get_executor()
+        pending = [executor.submit(fn) if thread_safe else fn for fn, thread_safe in calls]
+        results = [None] * len(pending)
+        for i, call in enumerate(pending):
+            if not isinstance(call, Future):
+                results[i] = call()
+        for i, call in enumerate(pending):
+            if isinstance(call, Future):
+                results[i] = call.result()
+        return results
+
+    def _get_executor(self):
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='squealy')
+            return self._executor
+
+    def _reload_jinja(self, compiled=None):
+        '''Recreates the jinja environments with the current snippets, and compiles the templates of all resources
+
+        compiled is an optional dict of template text -> code compiled ahead of time, from a bundle
+        '''
+        self.jinja = JinjaWrapper(self.snippets, templates=self.templates, bytecode=self.snippets_bytecode)
+        if compiled:
+            self.jinja.add_compiled(compiled)
+        for resource in self.resources.values():
+            self._compile_resource(resource)
+
+    def _compile_resource(self, resource):
+        'Compile the templates of all queries upfront, so requests only have to render them'
+        if isinstance(resource, _LazyResource):
+            # Compiled when the resource is built
+            if resource.built is None:
+                return
+            resource = resource.built
+        for template in resource.templates():
+            try:
+                self.jinja.compile_template(template)
+            except TemplateSyntaxError as e:
+                raise SquealyConfigException("Invalid query template in resource " + str(resource.id)) from e
 
     def get_jinja(self):
         return self.jinja
 
     def add_resource(self, resource):
-        self.resources[resource.id] = resource
+        self._compile_resource(resource)
+        with self._reload_lock:
+            self.resources[resource.id] = resource
 
     def get_resources(self):
         return dict(self.resources)
 
     def get_resource(self, id):
         try:
-            return self.resources[id]
+            resource = self.resources[id]
         except KeyError as e:
             raise SquealyException("Resource" + id + " does not exist") from e
+        if isinstance(resource, _LazyResource):
+            return resource.build()
+        return resource
+
+    def warm_up(self, background=True):
+        '''In lazy mode, builds all resources that have not been used yet
+
+        By default, resources are built in a daemon thread, so that startup is not delayed.
+        Invalid resources are logged, and fail when they are requested
+        '''
+        if not background:
+            self._warm_up()
+            return
+        self._warming_up = True
+        Thread(target=self._warm_up, name='squealy-warm-up', daemon=True).start()
+
+    def _warm_up(self):
+        try:
+            for resource in set(self.resources.values()):
+                if isinstance(resource, _LazyResource):
+                    try:
+                        resource.build()
+                    except SquealyException:
+                        logger.exception("Could not build resource %s", resource.id)
+        finally:
+            self._warming_up = False
+
+    def _build_resource(self, rawobj):
+        'Builds a resource in lazy mode, when it is first used'
+        resource = Resource(**rawobj)
+        self._compile_resource(resource)
+        return resource
 
     def load_objects(self, dirs=None):
         '''Loads resources and snippets from the provided directories
+        
+        The directories are remembered, so that reload() and watch() can pick up changes to their files
+        '''
+        dirs = _as_dirs(dirs)
+        with self._reload_lock:
+            files = self._find_files(dirs)
+            stamps = [_file_stamp(path) for path, _ in files]
+            loaded = self._add_objects(self._read_files(files))
+            self._watched_dirs.extend(directory for directory in dirs if directory not in self._watched_dirs)
+            for (path, _), stamp, objects in zip(files, stamps, loaded):
+                self._files[path] = (stamp, objects)
+
+    def load_bundle(self, bundle_file):
+        '''Loads resources, snippets and compiled templates from a bundle, see squealy.bundle
+
+        Faster than load_objects, because there is no yaml to parse, and the templates are already compiled
+        '''
+        from .bundle import read_bundle
+        bundle = read_bundle(bundle_file)
+        with self._reload_lock:
+            self.snippets_bytecode.update(bundle['snippets_bytecode'])
+            self._add_objects(bundle['objects'], bundle['templates'])
+
+    def reload(self):
+        '''Reloads the files that were added, changed or deleted in the directories passed to load_objects
+
+        Only those files are parsed. Templates are compiled only for queries whose text changed, and for snippets that changed.
+        Queries that include a snippet look it up when they are rendered, so they are not compiled again when it changes.
+        The new resources and snippets replace the current ones at once, so requests in progress are not affected.
+
+        If any file is invalid, nothing is reloaded and SquealyConfigException is raised.
+        The same changes are not tried again until a file changes. Returns True if anything was reloaded
+        '''
+        with self._reload_lock:
+            files = self._find_files(self._watched_dirs)
+            stamps = {path: _file_stamp(path) for path, _ in files}
+            current = {path: stamp for path, (stamp, _) in self._files.items()}
+            if stamps == current or stamps == self._failed_stamps:
+                return False
+            changed = [(path, ymlfile) for path, ymlfile in files if current.get(path) != stamps[path]]
+            deleted = [path for path in current if path not in stamps]
+
+            try:
+                added_resources, added_snippets, loaded = self._build_objects(self._read_files(changed))
+                resources = dict(self.resources)
+                snippets = dict(self.snippets)
+                for path in deleted + [path for path, _ in changed if path in self._files]:
+                    type, objects = self._files[path][1]
+                    target = resources if type == 'resource' else snippets
+                    for key, obj in objects.items():
+                        # Another file may have replaced the object since
+                        if target.get(key) is obj:
+                            del target[key]
+                resources.update(added_resources)
+                snippets.update(added_snippets)
+
+                changed_snippets = {name: snippets.get(name) for name in set(snippets) | set(self.snippets)
+                                        if snippets.get(name) != self.snippets.get(name)}
+                self.jinja.compile_snippets(changed_snippets)
+                for resource in set(added_resources.values()):
+                    self._compile_resource(resource)
+            except SquealyConfigException:
+                self._failed_stamps = stamps
+                raise
+
+            if changed_snippets:
+                self.jinja.set_snippets(snippets)
+            self.snippets = snippets
+            self.resources = resources
+            for path in deleted:
+                del self._files[path]
+            for (path, _), objects in zip(changed, loaded):
+                self._files[path] = (stamps[path], objects)
+            self._failed_stamps = None
+            logger.info("Reloaded %d changed and %d deleted files", len(changed), len(deleted))
+            return True
+
+    def watch(self, interval=2, on_reload=None):
+        '''Calls reload() every interval seconds in a background thread, so resources are updated without a restart
+
+        Directories are polled rather than watched with file system events, so this works on any file system,
+        including docker volumes. on_reload, if provided, is called after every reload that changed something.
+        Errors are logged, and the resources loaded earlier stay in use
+        '''
+        with self._reload_lock:
+            if self._watcher is not None:
+                return
+            stop = Event()
+            thread = Thread(target=self._watch, args=(interval, on_reload, stop), name='squealy-watcher', daemon=True)
+            self._watcher = (thread, stop, interval, on_reload)
+        thread.start()
+
+    def stop_watching(self):
+        with self._reload_lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            thread, stop, _, _ = watcher
+            stop.set()
+            thread.join()
+
+    def _after_fork(self):
+        '''Called in the child process after a fork, for example in the workers of gunicorn --preload
+
+        Only the thread that called fork exists in the child. The thread pool is created again on first use,
+        locks that other threads may have held are replaced, and the watcher and warm up threads are started again
+        '''
+        self._executor = None
+        self._executor_lock = Lock()
+        self._hooks_lock = Lock()
+        self._reload_lock = RLock()
+        # The warm up thread holds the lock of the template cache while it compiles templates
+        self.templates._lock = Lock()
+        # Calls in flight in other threads of the parent never finish in the child
+        if self.single_flight is not None:
+            self.single_flight = SingleFlight()
+            self.async_single_flight = AsyncSingleFlight()
+        for resource in self.resources.values():
+            if isinstance(resource, _LazyResource):
+                resource._lock = Lock()
+                resource = resource.built
+            if resource is not None and resource.cache is not None:
+                resource.cache._lock = Lock()
+        watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            _, _, interval, on_reload = watcher
+            self.watch(interval, on_reload)
+        if self._warming_up:
+            self.warm_up()
+
+    def _watch(self, interval, on_reload, stop):
+        while not stop.wait(interval):
+            try:
+                if self.reload() and on_reload is not None:
+                    on_reload()
+            except Exception:
+                logger.exception("Could not reload resources, the resources loaded earlier are still in use")
+
+    def _read_objects(self, dirs):
+        '''Returns a list of (file name, type of object, raw object) for the resource and snippet files in the directories
+
+        File names are relative to their directory
+        '''
+        return self._read_files(self._find_files(_as_dirs(dirs)))
+
+    def _find_files(self, dirs):
+        'Returns (path, file name relative to its directory) for the resource and snippet files. Each directory is walked once'
+        return [(Path(directory, ymlfile), ymlfile) for directory in dirs for ymlfile in _find_object_files(directory)]
+
+    def _read_files(self, files):
+        '''Same as _read_objects, for the files returned by _find_files
+
+        Files are read in parallel, which helps on network file systems, and parsed in this thread,
+        because parsing holds the GIL and would not run faster on more threads.
+        The threads only live while the files are read, so a process that forks after loading does not inherit them
         '''
-        if not dirs:
-            raise SquealyConfigException("Directories cannot be empty / None")
-        if isinstance(dirs, str):
-            dirs = [dirs]
+        paths = [path for path, _ in files]
+        if len(paths) > 1 and self.max_workers and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(paths)), thread_name_prefix='squealy-loader') as executor:
+                contents = list(executor.map(_read_file, paths))
+        else:
+            contents = map(_read_file, paths)
+        rawobjs = map(_parse_yaml, contents)
+        return [(ymlfile, self._find_file_type(ymlfile), rawobj) for (_, ymlfile), rawobj in zip(files, rawobjs)]
+
+    def _add_objects(self, objects, compiled=None):
+        'Adds the objects returned by _read_objects. Returns, for each of them, (type, dict of the resources or snippets it added)'
+        resources, snippets, loaded = self._build_objects(objects)
+        self.resources.update(resources)
+        self.snippets.update(snippets)
+        self._reload_jinja(compiled)
+        return loaded
+
+    def _build_objects(self, objects):
         resources = {}
         snippets = {}
-        
-        for ymlfile, rawobj in self._object_iter(dirs):
+        loaded = []
+
+        for ymlfile, type, rawobj in objects:
+            added = {}
+            loaded.append((type, added))
             if not rawobj:
                 continue
-            type = self._find_file_type(ymlfile)
             id = rawobj.get('id', None)
             if not id:
                 rawobj['id'] = str(ymlfile)
             if type == 'resource':
-                resource = Resource(**rawobj)
+                resource = _LazyResource(self, rawobj) if self.lazy else Resource(**rawobj)
                 # Store the resource using file name as well as unique id if provided
-                resources[resource.id] = resource
-                resources[str(ymlfile)] = resource
+                added[resource.id] = resource
+                added[str(ymlfile)] = resource
+                resources.update(added)
             elif type == 'snippets':
-                snippets.update(rawobj)
+                added.update(rawobj)
+                snippets.update(added)
             else:
                 raise SquealyConfigException("Unknown object of type = " + type + " in file " + ymlfile)
-        
-        self.resources.update(resources)
-        self.snippets.update(snippets)
-        self._reload_jinja()
+        return resources, snippets, loaded
 
-    def _object_iter(self, dirs):
-        extensions = ["*.resource.yml", "*.resource.yaml", "snippets.yml", "snippets.yaml"]
-        for directory in dirs:
-            for extension in extensions:
-                files = Path(directory).rglob(extension)
-                for ymlfile in files:
-                    yield (ymlfile.relative_to(directory), _load_yaml(ymlfile))
-    
     def _find_file_type(self, ymlfile):
         if ymlfile.match("*.resource.yml") or ymlfile.match("*.resource.yaml"):
             return "resource"
@@ -126,8 +522,39 @@ class Squealy:
         else:
             return "unknown"
 
+class _LazyResource:
+    '''Stands in for a Resource in lazy mode, until it is first used
+
+    Only the id and path are read from the yaml. The Resource is built, validated and its templates compiled
+    by build(), which is called by Squealy.get_resource, or when any other attribute is used
+    '''
+    def __init__(self, squealy, rawobj):
+        self.id = rawobj['id']
+        self.path = rawobj.get('path', None)
+        self.built = None
+        self._squealy = squealy
+        self._rawobj = rawobj
+        self._lock = Lock()
+
+    def build(self):
+        resource = self.built
+        if resource is None:
+            with self._lock:
+                if self.built is None:
+                    self.built = self._squealy._build_resource(self._rawobj)
+                    self._rawobj = None
+                resource = self.built
+        return resource
+
+    def __getattr__(self, name):
+        # Only called for attributes that are not set in __init__
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.build(), name)
+
 class Resource:
-    def __init__(self, id, queries, datasource=None, formatter=None, path=None, **kwargs):
+    def __init__(self, id, queries, datasource=None, formatter=None, path=None, cache=None, stream=False, pagination=None,
+                    max_rows=None, max_bytes=None, on_limit='fail', http_cache=None, **kwargs):
         if not id:
             raise SquealyConfigException("Missing id field")
         if not queries:
@@ -136,12 +563,89 @@ class Resource:
         self.id = id
         self.queries = Queries(queries)
         self.datasource = datasource
+        self.path = path
         if formatter and isinstance(formatter, str):
             self.formatter = self._load_formatter(formatter)
         else:
             self.formatter = formatter if formatter else JsonFormatter()
         if len(queries) > 1 and not self.formatter.supports_multi_queries():
             raise SquealyConfigException(type(self.formatter) + " does not support more than 1 query")
+        self.cache = self._load_cache(cache) if cache else None
+        self.limits = self._load_limits(max_rows, max_bytes, on_limit) if max_rows or max_bytes else None
+        self.stream = stream
+        if stream:
+            self._validate_stream()
+        self.pagination = self._load_pagination(pagination) if pagination else None
+        self.http_cache = self._load_http_cache(http_cache) if http_cache else None
+
+    def _load_pagination(self, pagination):
+        if not isinstance(pagination, dict):
+            raise SquealyConfigException("pagination must specify page_size and keys, in resource " + str(self.id))
+        if self.queries.shape != 'list' or not self.queries.has_root_query:
+            raise SquealyConfigException("pagination is only supported for resources with a root queryForList, in resource " + str(self.id))
+        if self.stream:
+            raise SquealyConfigException("pagination cannot be combined with stream, in resource " + str(self.id))
+        try:
+            return Pagination(self.queries.root_queries[0].query, **pagination)
+        except TypeError as e:
+            raise SquealyConfigException("Invalid pagination in resource " + str(self.id) + " - " + str(e)) from e
+
+    def _load_http_cache(self, http_cache):
+        if not isinstance(http_cache, dict):
+            raise SquealyConfigException("http_cache must specify max_age, private or version_query, in resource " + str(self.id))
+        # Imported here, because the http helpers import the exceptions of this module
+        from .http import HttpCache
+        try:
+            return HttpCache(**http_cache)
+        except TypeError as e:
+            raise SquealyConfigException("Invalid http_cache in resource " + str(self.id) + " - " + str(e)) from e
+        except SquealyConfigException as e:
+            raise SquealyConfigException(str(e) + ", in resource " + str(self.id)) from e
+
+    def templates(self):
+        'All templates of the resource, including the version query of http_cache'
+        templates = [self.query_template(query) for query in self.queries]
+        if self.http_cache is not None and self.http_cache.version_query is not None:
+            templates.append(self.http_cache.version_query.query)
+        return templates
+
+    def query_template(self, query):
+        'The template that is rendered for the query. The root query of a paginated resource is wrapped by the pagination'
+        if self.pagination is not None and query.is_root:
+            return self.pagination.query
+        return query.query
+
+    def _validate_stream(self):
+        if len(self.queries) > 1 or self.queries.shape != 'list':
+            raise SquealyConfigException("stream is only supported for resources with a single queryForList, in resource " + str(self.id))
+        if not self.formatter.supports_streaming():
+            raise SquealyConfigException(type(self.formatter).__name__ + " does not support streaming, in resource " + str(self.id))
+
+    def _load_cache(self, cache):
+        '''Results are cached in memory only if the resource provides a cache configuration like -
+            cache:
+              ttl: 300              # seconds, required
+              max_entries: 1000     # optional
+              max_bytes: 10485760   # optional, approximate size of all cached results
+        '''
+        if not isinstance(cache, dict) or cache.get('ttl') is None:
+            raise SquealyConfigException("cache must specify a ttl in seconds, in resource " + str(self.id))
+        max_entries = cache.get('max_entries', 1000)
+        max_bytes = cache.get('max_bytes')
+        try:
+            check_int("cache ttl", cache['ttl'])
+            check_int("cache max_entries", max_entries)
+            if max_bytes is not None:
+                check_int("cache max_bytes", max_bytes)
+        except SquealyConfigException as e:
+            raise SquealyConfigException(str(e) + ", in resource " + str(self.id)) from e
+        return LRUCache(max_entries=max_entries, ttl=cache['ttl'], max_bytes=max_bytes, sizeof=_table_size)
+
+    def _load_limits(self, max_rows, max_bytes, on_limit):
+        try:
+            return ResultLimits(max_rows, max_bytes, on_limit)
+        except SquealyConfigException as e:
+            raise SquealyConfigException(str(e) + ", in resource " + str(self.id)) from e
 
     def _load_formatter(self, raw_formatter):
         if not '.' in raw_formatter:
@@ -158,33 +662,684 @@ class Resource:
             m = getattr(m, comp)            
         return m
             
-    def process(self, squealy, initial_context):
+    def process(self, squealy, initial_context, stats=None):
+        if stats is None:
+            stats = RequestStats()
+        metadata = {}
+        tables = self._run(squealy, initial_context, stats, metadata)
+        return _add_metadata(self._format(squealy, tables, stats), metadata)
+
+    def etag(self, squealy, initial_context, stats=None):
+        '''Returns the ETag of the response for this context, using the version query of http_cache
+
+        Only the version query is executed, and its result is never cached, so it is cheap to call on every request.
+        Returns None if the resource has no version query, the ETag can then only be computed from the response
+        '''
+        if self.http_cache is None or self.http_cache.version_query is None:
+            return None
+        if stats is None:
+            stats = RequestStats()
+        query = self.http_cache.version_query
+        engine = squealy.get_engine(self.datasource)
+        finalquery, bindparams = self._prepare_version_query(squealy, engine, initial_context, stats)
+        with self._measure(squealy, stats, 'execute', query, finalquery, bindparams) as measurement:
+            table = squealy.execute(engine, finalquery, bindparams, stats)
+            measurement.size = len(table)
+        return self.http_cache.etag_for_version(self.id, table.data, initial_context)
+
+    async def etag_async(self, squealy, initial_context, stats=None):
+        'Same as etag, but awaits the version query like process_async'
+        if self.http_cache is None or self.http_cache.version_query is None:
+            return None
+        if stats is None:
+            stats = RequestStats()
+        query = self.http_cache.version_query
+        engine = squealy.get_async_engine(self.datasource)
+        finalquery, bindparams = self._prepare_version_query(squealy, engine, initial_context, stats)
+        with self._measure(squealy, stats, 'execute', query, finalquery, bindparams) as measurement:
+            table = await squealy.execute_async(engine, finalquery, bindparams, stats)
+            measurement.size = len(table)
+        return self.http_cache.etag_for_version(self.id, table.data, initial_context)
+
+    def _prepare_version_query(self, squealy, engine, context, stats):
+        query = self.http_cache.version_query
+        with self._measure(squealy, stats, 'render', query) as measurement:
+            finalquery, bindparams = self._prepare(squealy.get_jinja(), engine, query, context, stats)
+            measurement.sql, measurement.bind_params = finalquery, bindparams
+        return finalquery, bindparams
+
+    def process_json(self, squealy, initial_context, encoder=None, stats=None):
+        '''Same as process, but returns json text instead of python objects
+
+        Resources with a single query are serialized directly from the table by the formatter, if it supports it.
+        encoder is a TableEncoder, which decides how to convert values like dates and decimals
+        '''
+        if stats is None:
+            stats = RequestStats()
+        metadata = {}
+        tables = self._run(squealy, initial_context, stats, metadata)
+        return self._encode(squealy, tables, metadata, encoder or TableEncoder(), stats)
+
+    async def process_json_async(self, squealy, initial_context, encoder=None, stats=None):
+        'Same as process_json, but awaits queries like process_async'
+        if stats is None:
+            stats = RequestStats()
+        metadata = {}
+        tables = await self._run_async(squealy, initial_context, stats, metadata)
+        return self._encode(squealy, tables, metadata, encoder or TableEncoder(), stats)
+
+    def _encode(self, squealy, tables, metadata, encoder, stats):
+        if len(self.queries) == 1 and _encodes_directly(type(self.formatter)):
+            query = self.queries.queries[0]
+            if self.formatter.can_encode(query):
+                with self._measure(squealy, stats, 'serialize') as measurement:
+                    encoded = _add_encoded_metadata(self.formatter.encode(query, tables[query], encoder), metadata, encoder)
+                    measurement.size = len(encoded)
+                return encoded
+        results = _add_metadata(self._format(squealy, tables, stats), metadata)
+        with self._measure(squealy, stats, 'serialize') as measurement:
+            encoded = encoder.dumps(results)
+            measurement.size = len(encoded)
+        return encoded
+
+    def _run(self, squealy, initial_context, stats, metadata):
+        '''Executes all queries, and returns a dict of query -> table
+
+        Keys that must be added to the response next to the formatted data, like the pagination cursor, are added to metadata
+        '''
         logger.debug("Processing request for resource %s with initial_context %s", self.id, initial_context)
         jinja = squealy.get_jinja()
         context = initial_context
-        results = None
-        for query in self.queries:
-            engine = squealy.get_engine(query.datasource or self.datasource)
-            logger.debug("Using engine %s to process query template %s", engine, query.query)
-            finalquery, bindparams = jinja.prepare_query(query.query, context, engine.param_style)
-            logger.debug("Final Query is %s", finalquery)
-            logger.debug("Bind Parameters are %s", bindparams)
-            table = engine.execute(finalquery, bindparams)
-            if query.is_object:
-                if len(table) == 0 and not query.is_optional:
-                    raise SquealyException("Expected a single row, found none. If 0 rows are expected, you can set isOptional to true")
-                if len(table) > 1:
-                    raise SquealyException("Expected a single row, found " + len(table) + " rows")
-            
-            # Let subsequent queries access data from the current query
-            if query.context_key:
-                logger.debug("Binding result to context key %s", query.context_key)
-                context[query.context_key] = TableProxy(table, 'list' if query.is_list else 'object')
+        tables = {}
+        # Queries in a stage do not depend on each other, and can run concurrently
+        for stage in self.queries.stages:
+            calls = []
+            num_chunks = []
+            for query in stage:
+                engine = squealy.get_engine(query.datasource or self.datasource)
+                chunks = self._prepare_chunks(squealy, jinja, engine, query, context, stats)
+                for finalquery, bindparams in chunks:
+                    execute = partial(self._execute, squealy, engine, query, finalquery, bindparams, stats)
+                    calls.append((execute, engine.thread_safe))
+                num_chunks.append(len(chunks))
+
+            results = iter(squealy.run_concurrently(calls))
+            for query, count in zip(stage, num_chunks):
+                tables[query] = self._process_results(squealy, stats, query, list(islice(results, count)), context, metadata)
+        if stats.queries is not None:
+            metadata['profile'] = stats.profile()
+        return tables
+
+    async def process_async(self, squealy, initial_context, stats=None):
+        '''Same as process, but awaits queries instead of blocking the thread
+
+        Synchronous engines are adapted using SyncEngineAdapter
+        '''
+        if stats is None:
+            stats = RequestStats()
+        metadata = {}
+        tables = await self._run_async(squealy, initial_context, stats, metadata)
+        return _add_metadata(self._format(squealy, tables, stats), metadata)
+
+    async def _run_async(self, squealy, initial_context, stats, metadata):
+        'Same as _run, but awaits queries'
+        logger.debug("Processing async request for resource %s with initial_context %s", self.id, initial_context)
+        jinja = squealy.get_jinja()
+        context = initial_context
+        tables = {}
+        for stage in self.queries.stages:
+            pending = []
+            num_chunks = []
+            for query in stage:
+                engine = squealy.get_async_engine(query.datasource or self.datasource)
+                chunks = self._prepare_chunks(squealy, jinja, engine, query, context, stats)
+                for finalquery, bindparams in chunks:
+                    pending.append(self._execute_async(squealy, engine, query, finalquery, bindparams, stats))
+                num_chunks.append(len(chunks))
+
+            results = iter(await asyncio.gather(*pending))
+            for query, count in zip(stage, num_chunks):
+                tables[query] = self._process_results(squealy, stats, query, list(islice(results, count)), context, metadata)
+        if stats.queries is not None:
+            metadata['profile'] = stats.profile()
+        return tables
+
+    def process_stream(self, squealy, initial_context, encoder=None, stats=None):
+        '''Returns an iterator of strings that together make the json response
+
+        The query is executed before this method returns, so that errors can still be reported to the client.
+        Rows are then fetched from the database in batches, as the iterator is consumed.
+        encoder is a TableEncoder, which decides how to convert values like dates and decimals.
+
+        Results are never cached or shared with concurrent requests
+        '''
+        logger.debug("Streaming request for resource %s with initial_context %s", self.id, initial_context)
+        if stats is None:
+            stats = RequestStats()
+        if encoder is None:
+            encoder = TableEncoder()
+        query = self.queries.queries[0]
+        engine = squealy.get_engine(query.datasource or self.datasource)
+        if isinstance(engine, SyncEngineAdapter):
+            engine = engine.engine
+        elif isinstance(engine, AsyncEngine):
+            # Rows are fetched as the response is sent, which an AsyncEngine cannot do from a synchronous iterator
+            raise SquealyConfigException("stream requires a synchronous Engine, but datasource "
+                + str(query.datasource or self.datasource or 'default') + " is an AsyncEngine, in resource " + str(self.id))
+        with self._measure(squealy, stats, 'render', query) as measurement:
+            finalquery, bindparams = self._prepare(squealy.get_jinja(), engine, query, initial_context, stats)
+            measurement.sql, measurement.bind_params = finalquery, bindparams
+        with self._measure(squealy, stats, 'execute', query, finalquery, bindparams):
+            batches = engine.execute_stream(finalquery, bindparams)
+            if self.limits is not None:
+                batches = self.limits.limit_stream(batches)
+            first = next(batches, None)
+        batches = chain([first], batches) if first is not None else iter(())
+        return self._measure_stream(squealy, stats, self.formatter.format_stream(query, batches, encoder))
+
+    def _measure_stream(self, squealy, stats, chunks):
+        'Reports the time and bytes of a streamed response once it is fully sent, as the serialize stage'
+        if squealy.metrics is None:
+            return chunks
+        return self._measured_stream(squealy, stats, chunks)
+
+    def _measured_stream(self, squealy, stats, chunks):
+        with self._measure(squealy, stats, 'serialize') as measurement:
+            measurement.size = 0
+            for chunk in chunks:
+                measurement.size += len(chunk)
+                yield chunk
+
+    def _prepare(self, jinja, engine, query, context, stats):
+        logger.debug("Using engine %s to process query template %s", engine, query.query)
+        finalquery, bindparams = jinja.prepare_query(self.query_template(query), context, engine.param_style, stats)
+        logger.debug("Final Query is %s", finalquery)
+        logger.debug("Bind Parameters are %s", bindparams)
+        return (finalquery, bindparams)
+
+    def _prepare_chunks(self, squealy, jinja, engine, query, context, stats):
+        '''Same as _prepare, but returns a list of (finalquery, bindparams)
+
+        If the query uses the inclause filter with a list larger than the chunk size,
+        there is one entry per chunk of that list. The results of the chunks are concatenated.
+        '''
+        chunk_size = query.chunk_size if query.chunk_size is not None else squealy.inclause_chunk_size
+        with self._measure(squealy, stats, 'render', query) as measurement:
+            context = self._query_context(engine, query, context)
+            if chunk_size:
+                chunks = jinja.prepare_chunked_query(self.query_template(query), context, engine.param_style, chunk_size, stats)
             else:
-                logger.debug("context_key is not defined. " +
-                    "Results of this query will not be available to subsequent queries.")
-            results = self.formatter.format(results, query, table)
+                chunks = [self._prepare(jinja, engine, query, context, stats)]
+            measurement.sql, measurement.bind_params = chunks[0]
+        if len(chunks) > 1:
+            logger.debug("Split query into %s chunks of at most %s values", len(chunks), chunk_size)
+        return chunks
+
+    def _process_results(self, squealy, stats, query, chunks, context, metadata):
+        '''Combines the tables of the chunks of a query, applies the limits and pagination,
+        and binds the result to the context for the queries that follow
+
+        Failures, like too many rows, are reported as errors of the execute stage of the query
+        '''
+        with self._report_errors(squealy, stats, 'execute', query):
+            table = self._limit(Table.concat(chunks), metadata)
+            table = self._paginate(query, table, metadata)
+            self._bind_results(query, table, context)
+        return table
+
+    def _report_errors(self, squealy, stats, stage, query=None):
+        'Reports a failure to the metrics and on_error hooks like _measure, for steps of a stage that are not timed'
+        if squealy.metrics is None and not squealy.hooks:
+            return _NO_MEASUREMENT
+        return _ErrorReport(self, query, stage, squealy.metrics, stats, squealy.hooks)
+
+    def _measure(self, squealy, stats, stage, query=None, sql=None, bind_params=None):
+        'Times a stage of the request for the metrics and hooks of the Squealy object, and for stats if it collects timings'
+        if squealy.metrics is None and stats.timings is None and not squealy.hooks:
+            return _NO_MEASUREMENT
+        return _Measurement(self, query, stage, squealy.metrics, stats, squealy.hooks, sql, bind_params)
+
+    def _query_context(self, engine, query, context):
+        'The root query of a paginated resource also gets the position of the page, as squealy_page'
+        if self.pagination is None or not query.is_root:
+            return context
+        return dict(context, squealy_page=self.pagination.page_context(engine, context))
+
+    def _limit(self, table, metadata):
+        if self.limits is None:
+            return table
+        table, truncated = self.limits.apply(table)
+        if truncated or 'truncated' not in metadata:
+            metadata['truncated'] = truncated
+        return table
+
+    def _paginate(self, query, table, metadata):
+        if self.pagination is None or not query.is_root:
+            return table
+        table, metadata['cursor'] = self.pagination.next_page(table)
+        return table
+
+    def _format(self, squealy, tables, stats):
+        # Format in the order the queries are declared, so the merged output is deterministic
+        results = None
+        with self._measure(squealy, stats, 'format'):
+            for query in self.queries:
+                results = self.formatter.format(results, query, tables[query])
+        logger.debug("Compiled templates reused = %s, compiled = %s", stats.templates_reused, stats.templates_compiled)
         return results
+
+    def _bind_results(self, query, table, context):
+        if query.is_object:
+            if len(table) == 0 and not query.is_optional:
+                raise SquealyException("Expected a single row, found none. If 0 rows are expected, you can set isOptional to true")
+            if len(table) > 1:
+                raise SquealyException("Expected a single row, found " + str(len(table)) + " rows")
+        
+        # Let subsequent queries access data from the current query
+        if query.context_key:
+            logger.debug("Binding result to context key %s", query.context_key)
+            context[query.context_key] = TableProxy(table, 'list' if query.is_list else 'object')
+        else:
+            logger.debug("context_key is not defined. " +
+                "Results of this query will not be available to subsequent queries.")
+
+    def _execute(self, squealy, engine, query, finalquery, bindparams, stats):
+        with self._measure(squealy, stats, 'execute', query, finalquery, bindparams) as measurement:
+            table = self._execute_cached(squealy, engine, query, finalquery, bindparams, stats)
+            measurement.size = len(table)
+        if stats.queries is not None:
+            stats.add_query(measurement.query_key, measurement.datasource, finalquery, bindparams, len(table), measurement.seconds)
+        return table
+
+    def _execute_cached(self, squealy, engine, query, finalquery, bindparams, stats):
+        if self.cache is None:
+            return squealy.execute(engine, finalquery, bindparams, stats, self.limits)
+        key = _query_key(self.id, query.datasource or self.datasource, finalquery, bindparams)
+        if key is None:
+            return squealy.execute(engine, finalquery, bindparams, stats, self.limits)
+
+        table = self.cache.get(key)
+        if table is None:
+            stats.increment('cache_misses')
+            table = squealy.execute(engine, finalquery, bindparams, stats, self.limits)
+            self.cache.put(key, table)
+        else:
+            logger.debug("Found results in cache for resource %s", self.id)
+            stats.increment('cache_hits')
+        return table
+
+    async def _execute_async(self, squealy, engine, query, finalquery, bindparams, stats):
+        with self._measure(squealy, stats, 'execute', query, finalquery, bindparams) as measurement:
+            table = await self._execute_cached_async(squealy, engine, query, finalquery, bindparams, stats)
+            measurement.size = len(table)
+        if stats.queries is not None:
+            stats.add_query(measurement.query_key, measurement.datasource, finalquery, bindparams, len(table), measurement.seconds)
+        return table
+
+    async def _execute_cached_async(self, squealy, engine, query, finalquery, bindparams, stats):
+        if self.cache is None:
+            return await squealy.execute_async(engine, finalquery, bindparams, stats, self.limits)
+        key = _query_key(self.id, query.datasource or self.datasource, finalquery, bindparams)
+        if key is None:
+            return await squealy.execute_async(engine, finalquery, bindparams, stats, self.limits)
+
+        table = self.cache.get(key)
+        if table is None:
+            stats.increment('cache_misses')
+            table = await squealy.execute_async(engine, finalquery, bindparams, stats, self.limits)
+            self.cache.put(key, table)
+        else:
+            logger.debug("Found results in cache for resource %s", self.id)
+            stats.increment('cache_hits')
+        return table
+
+HOOK_EVENTS = ('before_render', 'after_render', 'before_execute', 'after_execute', 'before_format', 'after_format',
+               'before_serialize', 'after_serialize', 'on_error')
+
+class HookEvent:
+    '''Passed to the functions registered with Squealy.add_hook
+
+    name is the event, like before_execute, and stage is one of render, execute, format or serialize.
+    resource is the Resource being processed. query is the Query, or None for format and serialize.
+    sql and bind_params are set after render, and before and after execute. For chunked queries, they are of the first chunk.
+    seconds and size are set for after events. size is the number of rows for execute, and bytes for serialize.
+    error is the exception raised by the stage, for on_error. Checking the rows of a query, for example against max_rows,
+    is part of its execute stage, and fails after after_execute
+    '''
+    __slots__ = ('name', 'stage', 'resource', 'query', 'sql', 'bind_params', 'seconds', 'size', 'error')
+
+    def __init__(self, name, measurement, error=None):
+        self.name = name
+        self.stage = measurement.stage
+        self.resource = measurement.resource
+        self.query = measurement.query
+        self.sql = measurement.sql
+        self.bind_params = measurement.bind_params
+        self.seconds = measurement.seconds
+        self.size = measurement.size
+        self.error = error
+
+class _Measurement:
+    '''Context manager that times a stage of processing a request
+
+    The duration is reported to PrometheusMetrics, or an error is counted if the stage fails.
+    It is also added to the timings of RequestStats, if it collects them, and hooks are called before and after the stage.
+    size can be set within the block, to report the number of rows of a query or the bytes of a response
+    '''
+    __slots__ = ('resource', 'query', 'stage', 'metrics', 'stats', 'hooks', 'sql', 'bind_params', 'size', 'start', 'seconds')
+
+    def __init__(self, resource, query, stage, metrics, stats, hooks, sql=None, bind_params=None):
+        self.resource = resource
+        self.query = query
+        self.stage = stage
+        self.metrics = metrics
+        self.stats = stats
+        self.hooks = hooks
+        self.sql = sql
+        self.bind_params = bind_params
+        self.size = None
+        self.seconds = None
+
+    @property
+    def query_key(self):
+        return None if self.query is None else (self.query.key or 'root')
+
+    @property
+    def datasource(self):
+        return None if self.query is None else (self.query.datasource or self.resource.datasource or 'default')
+
+    def __enter__(self):
+        if self.hooks:
+            self._call_hooks('before_' + self.stage)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = seconds = time.perf_counter() - self.start
+        if self.stats.timings is not None and exc_type is None:
+            self.stats.add_timing(self.stage, self.query_key, seconds)
+        if exc_type is not None:
+            self.report_error(exc_type, exc)
+        elif self.metrics is None:
+            pass
+        elif self.query is None:
+            self.metrics.observe_resource(self.stage, str(self.resource.id), seconds, self.size)
+        else:
+            self.metrics.observe_query(self.stage, str(self.resource.id), self.query_key, self.datasource, seconds, self.size)
+        if self.hooks and exc_type is None:
+            self._call_hooks('after_' + self.stage)
+        return False
+
+    def report_error(self, exc_type, exc):
+        'Counts the error, and calls the on_error hooks'
+        if self.metrics is not None:
+            self.metrics.count_error(str(self.resource.id), self.stage)
+        if self.hooks and issubclass(exc_type, Exception):
+            self._call_hooks('on_error', exc)
+
+    def _call_hooks(self, name, error=None):
+        fns = self.hooks.get(name)
+        if fns:
+            event = HookEvent(name, self, error)
+            for fn in fns:
+                fn(event)
+
+class _ErrorReport(_Measurement):
+    'Same as _Measurement, but only reports errors. Used for steps that are part of a stage, but are not timed'
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.report_error(exc_type, exc)
+        return False
+
+class _NoMeasurement:
+    'Used instead of _Measurement when there are no metrics, timings or hooks'
+    __slots__ = ('size', 'sql', 'bind_params')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NO_MEASUREMENT = _NoMeasurement()
+
+class ResultLimits:
+    '''Limits the size of the results of each query of a resource, configured in the resource like -
+        max_rows: 10000         # optional
+        max_bytes: 52428800     # optional, approximate memory used by the rows
+        on_limit: truncate      # optional, fail or truncate. Defaults to fail
+
+    Rows are fetched in batches, and fetching stops as soon as a limit is exceeded,
+    so a large result is never held in memory in full.
+    With on_limit: fail, the request fails with an error.
+    With on_limit: truncate, the rows within the limits are returned, and the response has "truncated": true.
+    Streamed responses cannot report truncation, and are silently truncated in both modes
+    '''
+    def __init__(self, max_rows=None, max_bytes=None, on_limit='fail'):
+        for name, value in (('max_rows', max_rows), ('max_bytes', max_bytes)):
+            if value is not None:
+                check_int(name, value)
+        if on_limit not in ('fail', 'truncate'):
+            raise SquealyConfigException("on_limit must be either fail or truncate")
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.on_limit = on_limit
+
+    def fetch(self, engine, query, bind_params):
+        'Executes the query using execute_stream, and stops fetching once the limits are exceeded'
+        columns = []
+        rows = []
+        size = 0
+        batches = engine.execute_stream(query, bind_params)
+        try:
+            for batch in batches:
+                columns = batch.columns
+                rows.extend(batch.data)
+                if self.max_bytes:
+                    size += sum(map(_row_size, batch.data))
+                if self._exceeded(len(rows), size):
+                    self._check_fail()
+                    break
+        finally:
+            _close(batches)
+        return Table(columns, rows)
+
+    def apply(self, table):
+        'Returns the rows of the table that are within the limits, and True if rows had to be dropped'
+        num_rows = len(table)
+        if self.max_rows and num_rows > self.max_rows:
+            num_rows = self.max_rows
+        if self.max_bytes:
+            size = 0
+            for i, row in enumerate(table.data[:num_rows]):
+                size += _row_size(row)
+                if size > self.max_bytes:
+                    num_rows = i
+                    break
+        if num_rows == len(table):
+            return (table, False)
+        self._check_fail()
+        return (Table(table.columns, table.data[:num_rows]), True)
+
+    def limit_stream(self, batches):
+        'Yields the batches, truncated to the limits'
+        num_rows = 0
+        size = 0
+        try:
+            for batch in batches:
+                if self.max_rows and num_rows + len(batch) > self.max_rows:
+                    batch = Table(batch.columns, batch.data[:self.max_rows - num_rows])
+                if self.max_bytes:
+                    for i, row in enumerate(batch.data):
+                        size += _row_size(row)
+                        if size > self.max_bytes:
+                            batch = Table(batch.columns, batch.data[:i])
+                            break
+                num_rows += len(batch)
+                yield batch
+                if self._exceeded(num_rows, size) or (self.max_rows and num_rows >= self.max_rows):
+                    return
+        finally:
+            _close(batches)
+
+    def _exceeded(self, num_rows, size):
+        return bool((self.max_rows and num_rows > self.max_rows) or (self.max_bytes and size > self.max_bytes))
+
+    def _check_fail(self):
+        if self.on_limit == 'fail':
+            raise SquealyException("Query result exceeds the limits of the resource, max_rows = " + str(self.max_rows)
+                + ", max_bytes = " + str(self.max_bytes) + ". Narrow down the query, or set on_limit to truncate")
+
+def _close(batches):
+    'Closes the cursor of a generator returned by execute_stream, if we stop reading before the last batch'
+    close = getattr(batches, 'close', None)
+    if close is not None:
+        close()
+
+class Pagination:
+    '''Keyset pagination for resources that return a list, configured in the resource like -
+        pagination:
+          page_size: 50             # required
+          keys: [created_at, id]    # required, columns of the root query that together identify a row
+          descending: false         # optional
+          cursor_param: cursor      # optional, name of the request parameter with the cursor
+
+    The root query is wrapped in a sub query that is ordered by the keys and limited to page_size rows.
+    Instead of an offset, the next page starts after the keys of the last row of the previous page,
+    so the database can seek to it using an index on the keys, and deep pages cost the same as the first page.
+    The root query must not order the rows itself.
+
+    The response has a cursor next to the data, which the client passes back to get the next page.
+    The cursor is null on the last page
+    '''
+    def __init__(self, query, page_size, keys, descending=False, cursor_param='cursor'):
+        check_int("pagination page_size", page_size)
+        if isinstance(keys, str):
+            keys = [keys]
+        if not keys or not all(isinstance(key, str) and _IDENTIFIER.match(key) for key in keys):
+            raise SquealyConfigException("pagination keys must be a list of column names")
+        self.page_size = page_size
+        self.keys = list(keys)
+        self.descending = descending
+        self.cursor_param = cursor_param
+        self.query = self._wrap(query)
+
+    def _wrap(self, query):
+        # Expanded form of (k1, k2) > (v1, v2), because not every database supports comparing row values
+        operator = ' < ' if self.descending else ' > '
+        conditions = []
+        for i, key in enumerate(self.keys):
+            terms = ['squealy_keyset.' + earlier + ' = {{ squealy_page.after[' + str(j) + '] }}' for j, earlier in enumerate(self.keys[:i])]
+            terms.append('squealy_keyset.' + key + operator + '{{ squealy_page.after[' + str(i) + '] }}')
+            conditions.append('(' + ' AND '.join(terms) + ')')
+        direction = ' DESC' if self.descending else ''
+        return ('SELECT * FROM (\n' + query + '\n) squealy_keyset\n'
+            + '{% if squealy_page.after %}WHERE ' + ' OR '.join(conditions) + '\n{% endif %}'
+            + 'ORDER BY ' + ', '.join('squealy_keyset.' + key + direction for key in self.keys) + '\n'
+            + '{{ squealy_page.limit | sqlsafe }}')
+
+    def page_context(self, engine, context):
+        'Values available to the wrapped query as squealy_page'
+        cursor = context.get('params', {}).get(self.cursor_param)
+        if isinstance(cursor, (list, tuple)):
+            # Django's request.GET has a list of values for each parameter, the last one wins like in request.GET[name]
+            cursor = cursor[-1] if cursor else None
+        # One extra row tells us if there is a next page
+        limit = _LIMIT_CLAUSES.get(engine.dialect, 'LIMIT %d') % (self.page_size + 1)
+        return {"after": self._decode_cursor(cursor) if cursor else None, "limit": limit}
+
+    def next_page(self, table):
+        'Returns the rows of the current page, and the cursor for the next page, or None if this is the last page'
+        if len(table) <= self.page_size:
+            return (table, None)
+        rows = table.data[:self.page_size]
+        positions = []
+        for key in self.keys:
+            position = table.column_index(key)
+            if position is None:
+                raise SquealyConfigException("pagination key " + key + " is not a column of the query")
+            positions.append(position)
+        last = rows[-1]
+        return (Table(table.columns, rows), self._encode_cursor([last[i] for i in positions]))
+
+    def _encode_cursor(self, values):
+        text = json.dumps(values, default=convert, separators=(',', ':'))
+        return base64.urlsafe_b64encode(text.encode('utf-8')).decode('ascii').rstrip('=')
+
+    def _decode_cursor(self, cursor):
+        if not isinstance(cursor, str):
+            raise SquealyBadRequestException("Invalid cursor")
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        except (ValueError, binascii.Error) as e:
+            raise SquealyBadRequestException("Invalid cursor") from e
+        if not isinstance(values, list) or len(values) != len(self.keys):
+            raise SquealyBadRequestException("Invalid cursor")
+        # Each value is bound as a parameter of the query, so it must be a string, number, boolean or null
+        if any(isinstance(value, (list, dict)) for value in values):
+            raise SquealyBadRequestException("Invalid cursor")
+        return values
+
+# Databases that do not support LIMIT, by dialect name as used by SQLAlchemy and Django
+_LIMIT_CLAUSES = {
+    'oracle': 'FETCH FIRST %d ROWS ONLY',
+    'mssql': 'OFFSET 0 ROWS FETCH NEXT %d ROWS ONLY',
+    'microsoft': 'OFFSET 0 ROWS FETCH NEXT %d ROWS ONLY',
+}
+
+_IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+class RequestStats:
+    '''Counters collected while processing a single request
+
+    If timings is True, the duration of each stage is collected, for example to send a Server-Timing header.
+    If profile is True, the sql and bind parameters of each query are also collected, and added to the response.
+    Profiles expose the sql, so they must only be enabled while debugging
+    '''
+    def __init__(self, timings=False, profile=False):
+        # Number of query templates that were found in the compiled template cache
+        self.templates_reused = 0
+        # Number of query templates that had to be parsed and compiled during the request
+        self.templates_compiled = 0
+        # Number of queries answered from / missing in the resource's result cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # Number of queries that shared the results of an identical query running in another thread
+        self.queries_coalesced = 0
+        # (stage, query key, seconds) for the render, execute, format and serialize stages.
+        # query key is None for stages that apply to the whole resource
+        self.timings = [] if timings or profile else None
+        # Details of each query that was executed
+        self.queries = [] if profile else None
+        self._lock = Lock()
+
+    def increment(self, counter, by=1):
+        'Queries of a request may run on different threads, so counters are updated under a lock'
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + by)
+
+    def add_timing(self, stage, query, seconds):
+        # list.append is atomic, so no lock is needed even though queries run on different threads
+        self.timings.append((stage, query, seconds))
+
+    def add_query(self, key, datasource, sql, bind_params, rows, seconds):
+        self.queries.append({"key": key, "datasource": datasource, "sql": sql,
+                             "bind_params": len(bind_params), "rows": rows, "ms": round(seconds * 1000, 3)})
+
+    def profile(self):
+        'The queries and timings collected so far, in a form that can be serialized to json'
+        return {
+            "queries": list(self.queries),
+            "timings": [{"stage": stage, "query": query, "ms": round(seconds * 1000, 3)} for stage, query, seconds in self.timings],
+            "templates_compiled": self.templates_compiled,
+            "cache_hits": self.cache_hits,
+            "queries_coalesced": self.queries_coalesced,
+        }
         
 class Queries:
     def __init__(self, queries):
@@ -211,7 +1366,8 @@ class Queries:
         elif isinstance(queries, Queries):
             self.queries = queries.queries
         self._validate()
-        
+        self.stages = self._find_stages()
+
     def __len__(self):
         return len(self.queries)
 
@@ -257,12 +1413,42 @@ class Queries:
     def non_root_queries(self):
         return [q for q in self.queries if not q.is_root]
 
+    def _validate_merge_paths(self):
+        keys = set()
+        for q in self.queries:
+            path = q.merge.get('path') if q.merge else None
+            if path and path.split(".")[0] not in keys:
+                raise SquealyConfigException("merge path " + path + " must start with the key of an earlier query")
+            if q.key:
+                keys.add(q.key)
+
     def _validate(self):
         self._single_root_only()
         self._validate_shape_list()
+        self._validate_merge_paths()
+
+    def _find_stages(self):
+        '''Groups queries into stages that must run one after the other
+
+        A query depends on an earlier query if its template references the earlier query's contextKey.
+        A query is placed in the stage after the last stage it depends on,
+        so queries within a stage are independent of each other.
+        '''
+        stage_of = {}
+        stages = []
+        for i, query in enumerate(self.queries):
+            stage = 0
+            for earlier in self.queries[:i]:
+                if earlier.context_key and query.references(earlier.context_key):
+                    stage = max(stage, stage_of[earlier] + 1)
+            stage_of[query] = stage
+            if stage == len(stages):
+                stages.append([])
+            stages[stage].append(query)
+        return stages
 
 class Query:
-    def __init__(self, contextKey=None, isRoot=False, key=None, queryForList=None, queryForObject=None, datasource=None, merge=None, isOptional=False):
+    def __init__(self, contextKey=None, isRoot=False, key=None, queryForList=None, queryForObject=None, datasource=None, merge=None, isOptional=False, chunkSize=None):
         if queryForList and queryForObject:
             raise SquealyConfigException("Only one of queryForList, queryForObject must be provided, not both")
         if not queryForList and not queryForObject:
@@ -283,6 +1469,10 @@ class Query:
         if merge:
             if not ('child' in merge and 'parent' in merge):
                 raise SquealyConfigException("merge should specify parent and child columns")
+
+        if chunkSize is not None:
+            # 0 disables chunking
+            check_int("chunkSize", chunkSize, minimum=0)
         
         self.context_key = contextKey
         self.is_root = isRoot
@@ -290,27 +1480,163 @@ class Query:
         self.datasource = datasource
         self.is_optional = isOptional
         self.merge = merge
+        self.chunk_size = chunkSize
+        self.variables, self.includes_templates = _find_template_variables(self.query)
+
+    def references(self, variable):
+        '''Returns True if the template may use the variable
+
+        Included snippets are not inspected, so a template that includes other templates may use any variable
+        '''
+        return self.includes_templates or variable in self.variables
         
 
 class Engine:
     'A SQL / NoSQL compliant interface to execute a query. Returns a Table'
+
+    # Set to True if execute() can be called concurrently from multiple threads
+    thread_safe = False
+
+    # Number of rows fetched at a time by execute_stream
+    batch_size = 1000
+
+    # Name of the database, like sqlite, postgresql, mysql, oracle or mssql.
+    # Used where sql differs between databases, for example to limit the number of rows
+    dialect = None
+
     def execute(self, query, bind_params):
         pass
 
+    def execute_stream(self, query, bind_params):
+        '''Returns an iterator of Tables, each with at most batch_size rows
+
+        The first table is returned even if there are no rows, so that callers know the columns.
+        Engines should override this to fetch rows incrementally.
+        The default implementation fetches all rows at once
+        '''
+        table = self.execute(query, bind_params)
+        if len(table) == 0:
+            yield table
+        for start in range(0, len(table), self.batch_size):
+            yield Table(table.columns, table.data[start:start + self.batch_size])
+
+class AsyncEngine:
+    'Like Engine, but execute is a coroutine, so waiting on the database does not block a thread. Returns a Table'
+    dialect = None
+
+    async def execute(self, query, bind_params):
+        pass
+
+class SyncEngineAdapter(AsyncEngine):
+    '''Adapts a synchronous Engine to the AsyncEngine interface
+
+    If an executor is provided, queries run on the executor. 
+    Otherwise, they run in the event loop's thread and block it until the query completes.
+    Engines that are not thread safe must not be given an executor.
+    '''
+    def __init__(self, engine, executor=None):
+        self.engine = engine
+        self.param_style = engine.param_style
+        self.dialect = engine.dialect
+        self.executor = executor
+
+    async def execute(self, query, bind_params):
+        return await self.run(self.engine.execute, query, bind_params)
+
+    async def run(self, fn, *args):
+        'Calls a function that uses the synchronous engine'
+        if self.executor is None:
+            return fn(*args)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
 class Table:
-    'A basic table that is the result of a sql query'
+    '''A basic table that is the result of a sql query
+
+    Rows are stored as returned by the driver. Columns are looked up by name using an index,
+    and the values of a column are collected into a vector the first time the column is accessed.
+    A table can also be built from column vectors using Table.from_columns,
+    in which case rows are only materialized if something asks for them.
+
+    Tables may be cached and shared across requests, so they must not be modified.
+    '''
+    __slots__ = ('columns', '_data', '_vectors', '_index')
+
     def __init__(self, columns=None, data=None):
-        self.columns = columns if columns else []
-        self.data = data if data else []
-    
+        self.columns = list(columns) if columns else []
+        self._data = data if data else []
+        self._vectors = None
+        self._index = None
+
+    @classmethod
+    def from_columns(cls, columns, vectors):
+        'Builds a table from a list of column names, and a list of the values in each column'
+        table = cls(columns)
+        table._vectors = [list(vector) for vector in vectors]
+        if len(table._vectors) != len(table.columns):
+            raise SquealyException("Expected " + str(len(table.columns)) + " column vectors, found " + str(len(table._vectors)))
+        table._data = None
+        return table
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = list(zip(*self._vectors))
+        return self._data
+
+    @classmethod
+    def concat(cls, tables):
+        'Appends the rows of tables that have the same columns. A single table is returned as is'
+        if len(tables) == 1:
+            return tables[0]
+        return cls(tables[0].columns, list(chain.from_iterable(table.data for table in tables)))
+
     def __len__(self):
-        return len(self.data)
+        if self._data is None:
+            return len(self._vectors[0]) if self._vectors else 0
+        return len(self._data)
+
+    def column_index(self, name):
+        'Position of the column with this name, or None if there is no such column'
+        if self._index is None:
+            # If column names repeat, the first one wins, same as list.index
+            self._index = {column: i for i, column in reversed(list(enumerate(self.columns)))}
+        return self._index.get(name)
+
+    def column_at(self, index):
+        'Values of the column at this position. The returned list is cached, and must not be modified'
+        if self._vectors is None:
+            self._vectors = [None] * len(self.columns)
+        vector = self._vectors[index]
+        if vector is None:
+            vector = self._vectors[index] = list(map(itemgetter(index), self._data))
+        return vector
+
+    def vectors(self):
+        'Values of every column, in column order. The returned lists are cached, and must not be modified'
+        return [self.column_at(index) for index in range(len(self.columns))]
+
+    def column_values(self, index, limit=None):
+        '''Values of the column at this position, in the first limit rows if limit is provided
+
+        Unlike column_at, the values are not cached in the table. Tables in the result cache are counted
+        at their size when they are added, so values that are only read once, for example to encode a response, are not kept
+        '''
+        if self._vectors is not None and self._vectors[index] is not None:
+            vector = self._vectors[index]
+            return vector if limit is None else vector[:limit]
+        rows = self.data if limit is None else self.data[:limit]
+        return list(map(itemgetter(index), rows))
+
+    def column(self, name):
+        'Values of the column with this name. The returned list is cached, and must not be modified'
+        index = self.column_index(name)
+        if index is None:
+            raise KeyError(name)
+        return self.column_at(index)
 
     def as_dict(self):
-        result = [dict(zip(self.columns, r)) for r in self.data]
-        if self.requires_unflattening:
-            result = [Table.unflatten(d) for d in result]
-        return result
+        return _unflatten_plan(self.columns).apply(self.data)
 
     # Copied verbatim from https://stackoverflow.com/a/6037657/242940
     @staticmethod
@@ -328,34 +1654,97 @@ class Table:
     
     @property
     def requires_unflattening(self):
-        cols_with_period = [c for c in self.columns if '.' in c]
-        if cols_with_period:
-            return True
-        else:
-            return False
+        return not _unflatten_plan(self.columns).flat
+
+class _UnflattenPlan:
+    '''Converts rows into dicts, nesting columns with names like author.id into {"author": {"id": ...}}
+
+    The plan is computed once per column layout. Every nested dict gets a slot number, 
+    and every column knows the slot and key it is written to. So converting a row does not need any string operations.
+    '''
+    __slots__ = ('columns', 'flat', 'steps', 'num_slots')
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.flat = not any('.' in c for c in columns)
+        # Each step is (slot, key, column number, new slot)
+        # If column number is None, the step creates a nested dict at new slot
+        self.steps = steps = []
+        slots = {(): 0}
+        for colnum, column in enumerate(columns):
+            parts = column.split(".")
+            parent = ()
+            for part in parts[:-1]:
+                path = parent + (part, )
+                if path not in slots:
+                    slots[path] = len(slots)
+                    steps.append((slots[parent], part, None, slots[path]))
+                parent = path
+            steps.append((slots[parent], parts[-1], colnum, None))
+        self.num_slots = len(slots)
+
+    def apply(self, rows):
+        columns = self.columns
+        if self.flat:
+            return [dict(zip(columns, row)) for row in rows]
+
+        steps = self.steps
+        num_slots = self.num_slots
+        result = []
+        for row in rows:
+            nested = [None] * num_slots
+            nested[0] = {}
+            for slot, key, colnum, new_slot in steps:
+                if colnum is None:
+                    nested[new_slot] = nested[slot][key] = {}
+                else:
+                    nested[slot][key] = row[colnum]
+            result.append(nested[0])
+        return result
+
+# Plans are shared across requests that return the same column layout
+_UNFLATTEN_PLANS = LRUCache(max_entries=1024)
+
+def _unflatten_plan(columns):
+    key = tuple(columns)
+    plan = _UNFLATTEN_PLANS.get(key)
+    if plan is None:
+        plan = _UnflattenPlan(key)
+        _UNFLATTEN_PLANS.put(key, plan)
+    return plan
 
 class TableProxy:
+    '''Exposes the columns of a table as attributes to query templates
+
+    For an object, the attribute is the value in the first row. For a list, it is the list of values in the column
+    '''
+    __slots__ = ('_table', '_shape', '_columns')
+
     def __init__(self, table, shape):
         self._table = table
         if shape in ('list', 'object'):
             self._shape = shape
         else:
             raise SquealyException("Invalid shape - " + shape)
+        # Columns are collected once per request, rather than in the table, which may be in the result cache
+        self._columns = {}
     
     def __getattribute__(self, name):
         table = super().__getattribute__('_table')
+        indx = table.column_index(name)
+        if indx is None:
+            return super().__getattribute__(name)
         shape = super().__getattribute__('_shape')
-        if name in table.columns:
-            indx = table.columns.index(name)
-            if shape == 'object':
-                return table.data[0][indx]
-            elif shape == 'list':
-                values = [row[indx] for row in table.data]
-                return values
-            else:
-                raise SquealyException("Invalid shape - should not have entered this branch")
+        if shape == 'object':
+            return table.data[0][indx]
+        elif shape == 'list':
+            columns = super().__getattribute__('_columns')
+            values = columns.get(indx)
+            if values is None:
+                values = columns[indx] = table.column_values(indx)
+            return values
         else:
-            return super().__getattribute__(name)
+            raise SquealyException("Invalid shape - should not have entered this branch")
 
 class JinjaWrapper:
     """Wraps JinjaSQL object to work around some quirks in JinjaSQL
@@ -368,23 +1757,135 @@ class JinjaWrapper:
         SQLite requires that bind parameters are provided as a list. But JinjaSQL returns an ordered dict instead.
         So we convert ordered dict to list
 
+        Templates are kept in a bounded cache, keyed by the param style, the template text and the version of the snippets.
+        The environments of all param styles are configured the same way, so a template compiles to the same code
+        for every param style. It is compiled once, and the code is loaded into each environment.
+
+        If bytecode is provided, it is a dict that holds compiled snippets across instances
     """
-    def __init__(self, snippets=None):
+    PARAM_STYLES = ('qmark', 'numeric', 'format')
+
+    def __init__(self, snippets=None, templates=None, bytecode=None):
         if not snippets:
             snippets = {}
-        self.qmark_jinja = self._configure_jinjasql('qmark', snippets)
-        self.numeric_jinja = self._configure_jinjasql('numeric', snippets)
-        self.default_jinja = self._configure_jinjasql('format', snippets)
-    
-    def prepare_query(self, query, context, param_style):
+        bytecode_cache = _DictBytecodeCache(bytecode) if bytecode is not None else None
+        self.qmark_jinja = self._configure_jinjasql('qmark', snippets, bytecode_cache)
+        self.numeric_jinja = self._configure_jinjasql('numeric', snippets, bytecode_cache)
+        self.default_jinja = self._configure_jinjasql('format', snippets, bytecode_cache)
+        self.snippets_version = _snippets_version(snippets)
+        self.templates = templates if templates is not None else LRUCache()
+
+    def _get_jinjasql(self, param_style):
         if param_style == 'qmark':
-            jinja = self.qmark_jinja
+            return self.qmark_jinja
         elif param_style == 'numeric': 
-            jinja = self.numeric_jinja
+            return self.numeric_jinja
         else:
-            jinja = self.default_jinja
-        
-        final_query, bind_params = jinja.prepare_query(query, context)
+            return self.default_jinja
+
+    def get_template(self, query, param_style, stats=None):
+        'Returns the compiled template for the query, compiling it only if it is not in the cache'
+        key = (param_style, query, self.snippets_version)
+        template = self.templates.get(key)
+        if template is None:
+            template = self._from_code(param_style, self.compile(query))
+            self.templates.put(key, template)
+            if stats is not None:
+                stats.increment('templates_compiled')
+        elif stats is not None:
+            stats.increment('templates_reused')
+        return template
+
+    def compile(self, query):
+        'Compiles the template to python code, which can be loaded into the environment of any param style'
+        return self.default_jinja.env.compile(query)
+
+    def compile_template(self, query):
+        'Compiles the template for all param styles, unless it is already in the cache'
+        code = None
+        for param_style in self.PARAM_STYLES:
+            key = (param_style, query, self.snippets_version)
+            if key not in self.templates:
+                if code is None:
+                    code = self.compile(query)
+                self.templates.put(key, self._from_code(param_style, code))
+
+    def add_compiled(self, compiled):
+        'Adds templates compiled ahead of time, compiled is a dict of template text -> code'
+        for query, code in compiled.items():
+            for param_style in self.PARAM_STYLES:
+                key = (param_style, query, self.snippets_version)
+                if key not in self.templates:
+                    self.templates.put(key, self._from_code(param_style, code))
+
+    def compile_snippets(self, snippets=None):
+        '''Compiles snippets, a dict of name -> text, and stores them in the bytecode cache. By default, compiles all snippets
+
+        Raises SquealyConfigException if a snippet is invalid. Snippets that are None are skipped
+        '''
+        env = self.default_jinja.env
+        if snippets is None:
+            snippets = env.loader.mapping
+        for name, snippet in snippets.items():
+            if snippet is None:
+                continue
+            try:
+                code = env.compile(snippet, name)
+            except TemplateSyntaxError as e:
+                raise SquealyConfigException("Invalid snippet " + str(name)) from e
+            if env.bytecode_cache is not None:
+                bucket = env.bytecode_cache.get_bucket(env, name, None, snippet)
+                bucket.code = code
+                env.bytecode_cache.set_bucket(bucket)
+
+    def set_snippets(self, snippets):
+        '''Replaces the snippets of all environments at once
+
+        Compiled templates stay in the cache - they look up included snippets when they are rendered,
+        and jinja compiles a snippet again, or loads it from the bytecode cache, when its text changes
+        '''
+        for jinja in (self.qmark_jinja, self.numeric_jinja, self.default_jinja):
+            jinja.env.loader.mapping = snippets
+
+    def _from_code(self, param_style, code):
+        env = self._get_jinjasql(param_style).env
+        return env.template_class.from_code(env, code, env.make_globals(None))
+
+    def prepare_query(self, query, context, param_style, stats=None):
+        template = self.get_template(query, param_style, stats)
+        return self._render(template, context, param_style)
+
+    def prepare_chunked_query(self, query, context, param_style, chunk_size, stats=None):
+        '''Same as prepare_query, but returns a list of (final_query, bind_params)
+
+        The largest list passed to the inclause filter is split into chunks of chunk_size values,
+        and the template is rendered once for each chunk. If no list is larger than chunk_size,
+        the list has a single entry.
+
+        The results of the chunks are concatenated, so the IN clause must narrow down the rows
+        and not widen them - it must not be part of an OR condition.
+        Ordering and limits apply within a chunk.
+        '''
+        template = self.get_template(query, param_style, stats)
+        in_clauses = _InClauses()
+        _in_clauses.current = in_clauses
+        try:
+            prepared = self._render(template, context, param_style)
+            largest = max(range(len(in_clauses.sizes)), key=in_clauses.sizes.__getitem__, default=None)
+            if largest is None or in_clauses.sizes[largest] <= chunk_size:
+                return [prepared]
+            chunks = []
+            for start in range(0, in_clauses.sizes[largest], chunk_size):
+                in_clauses.chunk = (largest, start, start + chunk_size)
+                in_clauses.sizes = []
+                chunks.append(self._render(template, context, param_style))
+            return chunks
+        finally:
+            _in_clauses.current = None
+
+    def _render(self, template, context, param_style):
+        jinja = self._get_jinjasql(param_style)
+        final_query, bind_params = jinja.prepare_query(template, context)
 
         if param_style in ('qmark', 'format', 'numeric'):
             bind_params = list(bind_params)
@@ -395,14 +1896,162 @@ class JinjaWrapper:
         
         return (final_query, bind_params)
 
-    def _configure_jinjasql(self, param_style, snippets):
+    def _configure_jinjasql(self, param_style, snippets, bytecode_cache=None):
         loader = DictLoader(snippets)
-        env = Environment(loader=loader)
-        return JinjaSql(env, param_style=param_style)
+        env = Environment(loader=loader, bytecode_cache=bytecode_cache)
+        jinjasql = JinjaSql(env, param_style=param_style)
+        env.filters["inclause"] = _chunked_in_clause
+        return jinjasql
+
+class _DictBytecodeCache(BytecodeCache):
+    '''Keeps compiled snippets in a dict, which can be shared by environments and saved in a bundle
+
+    Jinja checks the source of the snippet and the python version before using an entry,
+    so entries of snippets that changed, or that were compiled by another python, are ignored
+    '''
+    def __init__(self, bytecode):
+        self.bytecode = bytecode
+
+    def load_bytecode(self, bucket):
+        data = self.bytecode.get(bucket.key)
+        if data is not None:
+            bucket.bytecode_from_string(data)
+
+    def dump_bytecode(self, bucket):
+        self.bytecode[bucket.key] = bucket.bytecode_to_string()
+
+class _InClauses:
+    '''Lists passed to the inclause filter while rendering a template, for prepare_chunked_query
+
+    sizes has the length of each list, in the order the filter is called.
+    chunk is (call number, start, end), and replaces the list of that call with a slice of it
+    '''
+    __slots__ = ('sizes', 'chunk')
+
+    def __init__(self):
+        self.sizes = []
+        self.chunk = None
+
+_in_clauses = local()
+
+def _chunked_in_clause(value):
+    'The inclause filter of jinjasql, that can substitute a chunk of the list when rendering chunked queries'
+    in_clauses = getattr(_in_clauses, 'current', None)
+    if in_clauses is not None:
+        call = len(in_clauses.sizes)
+        in_clauses.sizes.append(len(value) if isinstance(value, (list, tuple)) else 0)
+        if in_clauses.chunk is not None and in_clauses.chunk[0] == call:
+            _, start, end = in_clauses.chunk
+            value = value[start:end]
+    return bind_in_clause(value)
+
+@lru_cache(maxsize=None)
+def _encodes_directly(formatter_class):
+    '''True if encode() of the formatter can be used instead of format()
+
+    A subclass that overrides format() but not encode(), like a custom formatter that adds a key to the response,
+    expects format() to be called. Its responses are serialized from the output of format() instead
+    '''
+    def defined_by(name):
+        return next(kls for kls in formatter_class.__mro__ if name in kls.__dict__)
+    return issubclass(defined_by('encode'), defined_by('format'))
+
+def _add_metadata(results, metadata):
+    if not metadata:
+        return results
+    results = dict(results)
+    results.update(metadata)
+    return results
+
+def _add_encoded_metadata(encoded, metadata, encoder):
+    'Same as _add_metadata, but for the json text of an object'
+    if not metadata:
+        return encoded
+    return encoded[:-1] + ''.join(', ' + encoder.dumps(key) + ': ' + encoder.dumps(value) for key, value in metadata.items()) + '}'
+
+def _query_key(*parts):
+    'Builds a hashable key from the parts, the last part being the bind parameters. Returns None if not hashable'
+    bindparams = parts[-1]
+    if isinstance(bindparams, dict):
+        bindparams = tuple(sorted(bindparams.items()))
+    else:
+        bindparams = tuple(bindparams)
+    key = parts[:-1] + (bindparams, )
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+def _table_size(table):
+    'Approximate memory used by a table, in bytes'
+    return sys.getsizeof(table.data) + sum(map(_row_size, table.data))
+
+def _row_size(row):
+    return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+def _find_template_variables(query):
+    '''Returns the top level variables used by the template, 
+        and a boolean indicating if it includes, imports or extends other templates'''
+    try:
+        ast = _PARSER.parse(query)
+    except TemplateSyntaxError as e:
+        raise SquealyConfigException("Invalid query template - " + str(e)) from e
+    includes_templates = any(True for _ in meta.find_referenced_templates(ast))
+    return (meta.find_undeclared_variables(ast), includes_templates)
+
+# Only used to parse templates and find the variables they use
+_PARSER = JinjaSql(Environment()).env
+
+def _snippets_version(snippets):
+    return hash(tuple(sorted((name, str(snippet)) for name, snippet in snippets.items())))
+
+# Every Squealy object, so their threads and locks can be restored in the child process after a fork
+_INSTANCES = weakref.WeakSet()
+
+def _after_fork_in_child():
+    _UNFLATTEN_PLANS._lock = Lock()
+    for squealy in list(_INSTANCES):
+        squealy._after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+_OBJECT_FILES = ("*.resource.yml", "*.resource.yaml", "snippets.yml", "snippets.yaml")
+
+def _as_dirs(dirs):
+    if not dirs:
+        raise SquealyConfigException("Directories cannot be empty / None")
+    if isinstance(dirs, str):
+        dirs = [dirs]
+    return dirs
+
+def _file_stamp(path):
+    'Changes whenever the file is modified'
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def _find_object_files(directory):
+    'Returns the resource and snippet files under directory, relative to it, in sorted order'
+    files = []
+    for root, _, filenames in os.walk(directory):
+        for filename in filenames:
+            if any(fnmatch(filename, pattern) for pattern in _OBJECT_FILES):
+                files.append(Path(root, filename).relative_to(directory))
+    return sorted(files)
+
+# The C loader is several times faster, but is only available if PyYAML was built with libyaml
+_YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
 def _load_yaml(ymlfile):
-    with open(ymlfile) as f:
-        try:
-            return yaml.safe_load(f)
-        except MarkedYAMLError as e:
-            raise SquealyYamlException(str(e)) from e
+    return _parse_yaml(_read_file(ymlfile))
+
+def _read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _parse_yaml(data):
+    try:
+        return yaml.load(data, Loader=_YamlLoader)
+    except MarkedYAMLError as e:
+        raise SquealyYamlException(str(e)) from e
@@ -1,24 +1,40 @@
 import os
+import django
 from django.apps import apps
 from django.conf import settings
 from django.db import connections
 from django.views import View
-from django.http import JsonResponse
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.core.serializers.json import DjangoJSONEncoder
 from django.contrib.auth.decorators import login_required
+from django.contrib.auth.views import redirect_to_login
 from django.utils.decorators import method_decorator
 
 import logging
-from squealy import Squealy, Resource, Engine, Table, SquealyConfigException
+from squealy import Squealy, Resource, Engine, SyncEngineAdapter, Table, RequestStats, SquealyConfigException
+from squealy.encoders import TableEncoder, chain_defaults, convert
+from squealy.http import PROFILE_HEADER, server_timing, etag_matches, cache_headers, Compression
 
 logger = logging.getLogger(__name__)
 logger.addHandler(logging.NullHandler())
 
 class DjangoSquealy(Squealy):
     def __init__(self, snippets=None, resources=None):
-        super(DjangoSquealy, self).__init__(snippets=snippets, resources=resources)
+        # This runs when squealy.django is imported. With many resources, SQUEALY_LAZY defers building them to their first request,
+        # and SQUEALY_WARM_UP then builds them in a background thread
+        lazy = getattr(settings, 'SQUEALY_LAZY', False)
+        super(DjangoSquealy, self).__init__(snippets=snippets, resources=resources, lazy=lazy)
         for conn_name in connections:
             self.add_engine(conn_name, DjangoORMEngine(conn_name))
-        
+
+        # A bundle, built by python -m squealy.bundle, replaces loading yaml files from the installed apps
+        bundle = getattr(settings, 'SQUEALY_BUNDLE', None)
+        if bundle:
+            logger.info("Loading resources from bundle %s", bundle)
+            self.load_bundle(bundle)
+            self._warm_up_if_lazy()
+            return
+
         resource_dirs = []
         for app_config in apps.get_app_configs():
             name = app_config.name
@@ -28,15 +44,37 @@ class DjangoSquealy(Squealy):
         if resource_dirs:
             logger.info("Loading resource files from these directories - %s", resource_dirs)
             self.load_objects(resource_dirs)
+            # Pick up changes to resource files without restarting, see Squealy.watch
+            reload_interval = getattr(settings, 'SQUEALY_RELOAD_INTERVAL', None)
+            if reload_interval:
+                self.watch(reload_interval)
+            self._warm_up_if_lazy()
         else:
             logger.warn("Did not find any directories to load resources!")
 
+    def _warm_up_if_lazy(self):
+        if self.lazy and getattr(settings, 'SQUEALY_WARM_UP', False):
+            self.warm_up()
+
+    def _adapt_engine(self, engine):
+        if isinstance(engine, DjangoORMEngine):
+            return DjangoAsyncEngine(engine)
+        return super(DjangoSquealy, self)._adapt_engine(engine)
+
 class DjangoORMEngine(Engine):
+    # Django connections are bound to a thread, and are only cleaned up at the end of a request.
+    # So queries always run in the request thread, even if they are independent
+    thread_safe = False
+
     def __init__(self, conn_name):
         self.conn_name = conn_name
         # Django uses %s for bind parameters, across all databases
         self.param_style = 'format'
 
+    @property
+    def dialect(self):
+        return connections[self.conn_name].vendor
+
     def execute(self, query, bind_params):
         with connections[self.conn_name].cursor() as cursor:
             cursor.execute(query, bind_params)
@@ -45,6 +83,35 @@ class DjangoORMEngine(Engine):
         table = Table(columns=cols, data=rows)
         return table
 
+    def execute_stream(self, query, bind_params):
+        # A plain cursor on PostgreSQL and MySQL loads the whole result when the query is executed.
+        # chunked_cursor uses a server side cursor where the database supports it, so rows are fetched batch by batch
+        with connections[self.conn_name].chunked_cursor() as cursor:
+            # Let the driver fetch a whole batch in one round trip. cursor.cursor is the driver's cursor
+            cursor.cursor.arraysize = self.batch_size
+            cursor.execute(query, bind_params)
+            cols = [col[0] for col in cursor.description]
+            while True:
+                rows = cursor.fetchmany(self.batch_size)
+                # The first batch is returned even if it is empty, so callers know the columns
+                yield Table(columns=cols, data=rows)
+                if len(rows) < self.batch_size:
+                    break
+
+class DjangoAsyncEngine(SyncEngineAdapter):
+    '''Runs a DjangoORMEngine from async code
+
+    Django does not allow database access from an event loop, so queries run in 
+    the thread that Django uses for synchronous code. Requires Django 3.1 or above
+    '''
+    def __init__(self, engine):
+        from asgiref.sync import sync_to_async
+        super(DjangoAsyncEngine, self).__init__(engine)
+        self._sync_to_async = sync_to_async
+
+    async def run(self, fn, *args):
+        return await self._sync_to_async(fn, thread_sensitive=True)(*args)
+
 def load_default_squealy():
     squealy = DjangoSquealy()
     return squealy
@@ -55,6 +122,11 @@ class AnonymousSqlView(View):
     # squealy and resource_id will be set when SqlView.as_view() is called
     squealy = _DEFAULT_SQUEALY
     resource = None
+    # Set to True, or pass server_timing=True to as_view, to add a Server-Timing header to responses
+    server_timing = False
+    # Responses are compressed for clients that accept gzip. Pass compression=False to as_view to turn it off,
+    # or a Compression with a different min_size or level
+    compression = Compression()
 
     def build_context(self, request, *args, **kwargs):
         params = {}
@@ -66,17 +138,142 @@ class AnonymousSqlView(View):
             "params": params
         }
 
-    def get(self, request, *args, **kwargs):
+    def get_resource(self):
         if not self.resource:
             raise SquealyConfigException('resource is not set, did you forget to pass it in SqlView.as_view(resource=) ?')
-        context = self.build_context(request, *args, **kwargs)
         if isinstance(self.resource, Resource):
-            resource = self.resource
+            return self.resource
         else:
-            resource = self.squealy.get_resource(self.resource)
-        data = resource.process(self.squealy, context)
-        return JsonResponse(data)
+            return self.squealy.get_resource(self.resource)
+
+    def get_encoder(self):
+        'Converts dates and other values the same way as JsonResponse, and falls back to squealy for the rest'
+        return TableEncoder(chain_defaults(DjangoJSONEncoder().default, convert))
+
+    def get_stats(self, request):
+        'Collects timings if server_timing is enabled, and a profile if DEBUG is on and the client asks for it'
+        profile = settings.DEBUG and _header(request, PROFILE_HEADER) is not None
+        return RequestStats(timings=self.server_timing, profile=profile)
+
+    def add_server_timing(self, response, stats):
+        if stats.timings:
+            response['Server-Timing'] = server_timing(stats.timings)
+        return response
+
+    def add_headers(self, response, headers):
+        for name, value in headers.items():
+            response[name] = value
+        return response
+
+    def add_cache_headers(self, response, http_cache, etag):
+        return self.add_headers(response, cache_headers(http_cache, etag))
+
+    def compress(self, request, content, stream=False):
+        'Compresses the body if the client accepts gzip. Returns the body and the headers to add to the response'
+        if not self.compression:
+            return content, {}
+        return self.compression.apply(_header(request, 'Accept-Encoding'), content, stream)
+
+    def is_not_modified(self, request, etag):
+        return etag_matches(_header(request, 'If-None-Match'), etag)
+
+    def not_modified(self, resource, etag, stats):
+        return self.add_server_timing(self.add_cache_headers(HttpResponseNotModified(), resource.http_cache, etag), stats)
+
+    def json_response(self, request, resource, body, etag, stats):
+        '''Returns the json body, or 304 Not Modified if the client already has it
+
+        Without a version query, etag is None, and the ETag is computed from the body
+        '''
+        if resource.http_cache is not None and etag is None:
+            etag = resource.http_cache.etag_for_body(body)
+            if self.is_not_modified(request, etag):
+                return self.not_modified(resource, etag, stats)
+        body, headers = self.compress(request, body)
+        response = self.add_headers(HttpResponse(body, content_type='application/json'), headers)
+        return self.add_server_timing(self.add_cache_headers(response, resource.http_cache, etag), stats)
+
+    def stream_response(self, request, resource, chunks, etag, stats):
+        # Only render and execute are known when the response starts
+        chunks, headers = self.compress(request, chunks, stream=True)
+        response = self.add_headers(StreamingHttpResponse(self.streaming_content(chunks), content_type='application/json'), headers)
+        return self.add_server_timing(self.add_cache_headers(response, resource.http_cache, etag), stats)
+
+    def streaming_content(self, chunks):
+        'The iterator over the chunks of a streamed response, that is passed to StreamingHttpResponse'
+        return chunks
+
+    def get(self, request, *args, **kwargs):
+        resource = self.get_resource()
+        context = self.build_context(request, *args, **kwargs)
+        stats = self.get_stats(request)
+        # With a version query, the queries are skipped if the client already has the response
+        etag = resource.etag(self.squealy, context, stats)
+        if self.is_not_modified(request, etag):
+            return self.not_modified(resource, etag, stats)
+        if resource.stream:
+            chunks = resource.process_stream(self.squealy, context, self.get_encoder(), stats)
+            return self.stream_response(request, resource, chunks, etag, stats)
+        body = resource.process_json(self.squealy, context, self.get_encoder(), stats)
+        return self.json_response(request, resource, body, etag, stats)
 
 @method_decorator(login_required, name='dispatch')
 class SqlView(AnonymousSqlView):
-    pass
\ No newline at end of file
+    pass
+
+class AsyncAnonymousSqlView(AnonymousSqlView):
+    '''Awaits queries instead of blocking the worker thread. Requires Django 4.1 or above
+    
+    build_context runs in Django's synchronous thread, because it may access request.user.
+    Streamed resources fetch rows with the synchronous engine, so the query also runs in Django's synchronous thread,
+    and the response pulls one chunk at a time from that thread. Streamed resources require Django 4.2 or above
+    '''
+    async def get(self, request, *args, **kwargs):
+        from asgiref.sync import sync_to_async
+        resource = self.get_resource()
+        context = await sync_to_async(self._build_context_sync, thread_sensitive=True)(request, *args, **kwargs)
+        stats = self.get_stats(request)
+        etag = await resource.etag_async(self.squealy, context, stats)
+        if self.is_not_modified(request, etag):
+            return self.not_modified(resource, etag, stats)
+        if resource.stream:
+            if django.VERSION < (4, 2):
+                raise SquealyConfigException("Streamed resources in async views require Django 4.2 or above, in resource " + str(resource.id))
+            process_stream = sync_to_async(resource.process_stream, thread_sensitive=True)
+            chunks = await process_stream(self.squealy, context, self.get_encoder(), stats)
+            return self.stream_response(request, resource, chunks, etag, stats)
+        body = await resource.process_json_async(self.squealy, context, self.get_encoder(), stats)
+        return self.json_response(request, resource, body, etag, stats)
+
+    async def streaming_content(self, chunks):
+        # A synchronous iterator would be read in full into a list by Django under ASGI
+        from asgiref.sync import sync_to_async
+        next_chunk = sync_to_async(next, thread_sensitive=True)
+        try:
+            while True:
+                chunk = await next_chunk(chunks, None)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # Stops the query if the client goes away before the end of the response
+            await sync_to_async(chunks.close, thread_sensitive=True)()
+
+    def _build_context_sync(self, request, *args, **kwargs):
+        context = self.build_context(request, *args, **kwargs)
+        # request.user is lazy, load it now so that templates do not hit the database from the event loop
+        getattr(context.get('user'), 'is_authenticated', None)
+        return context
+
+class AsyncSqlView(AsyncAnonymousSqlView):
+    'Same as AsyncAnonymousSqlView, but redirects to the login page if the user is not authenticated'
+    async def get(self, request, *args, **kwargs):
+        from asgiref.sync import sync_to_async
+        is_authenticated = await sync_to_async(lambda: request.user.is_authenticated, thread_sensitive=True)()
+        if not is_authenticated:
+            return redirect_to_login(request.get_full_path())
+        return await super(AsyncSqlView, self).get(request, *args, **kwargs)
+
+def _header(request, name):
+    # request.headers requires Django 2.2, request.META has the headers on every version
+    return request.META.get('HTTP_' + name.upper().replace('-', '_'))
@@ -0,0 +1,173 @@
+import base64
+import datetime
+import json
+import math
+import uuid
+from decimal import Decimal
+from json.encoder import encode_basestring_ascii
+
+def convert(value):
+    '''Converts values that json does not support natively
+
+    Decimals and UUIDs become strings, dates and times become ISO 8601 strings, and bytes are base64 encoded
+    '''
+    if isinstance(value, (Decimal, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError("Object of type " + type(value).__name__ + " is not JSON serializable")
+
+def chain_defaults(*defaults):
+    '''Combines several json default functions into one
+
+    Each function is tried in order, until one of them does not raise a TypeError.
+    Used to prefer the web framework's conversions, and fall back to squealy's for the rest
+    '''
+    def default(value):
+        for fn in defaults[:-1]:
+            try:
+                return fn(value)
+            except TypeError:
+                pass
+        return defaults[-1](value)
+    return default
+
+def _encode_float(value):
+    if math.isfinite(value):
+        return float.__repr__(value)
+    elif value != value:
+        return 'NaN'
+    return 'Infinity' if value > 0 else '-Infinity'
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+# Types that json supports natively, and a fast function that converts a value of that type to json
+_NATIVE_ENCODERS = {
+    str: encode_basestring_ascii,
+    int: int.__repr__,
+    float: _encode_float,
+    bool: _encode_bool,
+}
+
+class TableEncoder:
+    '''Serializes tables directly to json text, without building intermediate dicts
+
+    Each column is inspected once to choose a function that converts its values to json.
+    Values are then encoded column by column, and rows are assembled using a precomputed template.
+
+    default converts values that json does not support natively, see the default parameter of json.dumps
+    '''
+    def __init__(self, default=None):
+        self.default = default or convert
+
+    def dumps(self, obj):
+        return json.dumps(obj, default=self.default)
+
+    def encode_column(self, values):
+        'Returns a list with the json text of each value'
+        types = set(map(type, values))
+        has_nulls = type(None) in types
+        types.discard(type(None))
+        if not types:
+            return ['null'] * len(values)
+        encoder = self._column_encoder(types, values)
+        if encoder is _encode_float and not has_nulls and all(map(math.isfinite, values)):
+            encoder = float.__repr__
+        if has_nulls:
+            return [encoder(v) if v is not None else 'null' for v in values]
+        return list(map(encoder, values))
+
+    def encode_array(self, values):
+        return '[' + ', '.join(self.encode_column(values)) + ']'
+
+    def encode_objects(self, table, limit=None):
+        '''Encodes each row as a json object, and returns the list of encoded rows
+
+        Columns with names like author.id are nested, same as Table.as_dict.
+        If limit is provided, only the first limit rows are encoded
+        '''
+        num_rows = len(table) if limit is None else min(limit, len(table))
+        template, order = _object_template(table.columns)
+        if template is None:
+            return [self.dumps(row) for row in table.as_dict()[:num_rows]]
+        columns = [table.column_values(i, num_rows) for i in order]
+        return self._fill(template, columns, num_rows)
+
+    def encode_arrays(self, table):
+        'Encodes each row as a json array, and returns the list of encoded rows'
+        return self.encode_rows(table, '[' + ', '.join(['%s'] * len(table.columns)) + ']')
+
+    def encode_rows(self, table, template):
+        'Encodes each row using a %-format template, that has a %s for every column'
+        return self._fill(template, [table.column_values(i) for i in range(len(table.columns))], len(table))
+
+    def _fill(self, template, columns, num_rows):
+        if not columns:
+            return [template] * num_rows
+        encoded = [self.encode_column(values) for values in columns]
+        return [template % values for values in zip(*encoded)]
+
+    def _column_encoder(self, types, values):
+        'Chooses a function to encode non-null values, given the set of types in the column'
+        if len(types) > 1:
+            return self._encode_value
+        encoder = _NATIVE_ENCODERS.get(next(iter(types)))
+        if encoder:
+            return encoder
+        return self._converting_encoder(next(v for v in values if v is not None))
+
+    def _converting_encoder(self, sample):
+        '''For types like Decimal or datetime, convert using default, and then encode the converted value
+
+        Other types, like dicts and lists from json or array columns, or subclasses of int, float and str like IntEnum,
+        are encoded by json.dumps, which supports them natively and only calls default for what it does not support
+        '''
+        if isinstance(sample, (dict, list, tuple, str, int, float)):
+            return self._encode_value
+        try:
+            converted_encoder = _NATIVE_ENCODERS.get(type(self.default(sample)))
+        except TypeError:
+            converted_encoder = None
+        if not converted_encoder:
+            return self._encode_value
+        default = self.default
+        return lambda v: converted_encoder(default(v))
+
+    def _encode_value(self, value):
+        return json.dumps(value, default=self.default)
+
+def _encode_key(key):
+    # Keys become part of a %-format template
+    return encode_basestring_ascii(key).replace('%', '%%')
+
+def _object_template(columns):
+    '''Returns a %-format template for a json object and the order in which columns fill the template
+
+    Returns (None, None) if column names repeat or conflict, which Table.as_dict resolves by overwriting values
+    '''
+    root = {}
+    for colnum, column in enumerate(columns):
+        parts = column.split(".")
+        node = root
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+            if not isinstance(node, dict):
+                return (None, None)
+        if parts[-1] in node:
+            return (None, None)
+        node[parts[-1]] = colnum
+
+    order = []
+    def render(node):
+        items = []
+        for key, value in node.items():
+            if isinstance(value, dict):
+                items.append(_encode_key(key) + ': ' + render(value))
+            else:
+                order.append(value)
+                items.append(_encode_key(key) + ': %s')
+        return '{' + ', '.join(items) + '}'
+    return (render(root), order)
@@ -1,12 +1,17 @@
-from flask import request, current_app, jsonify
+from flask import request, current_app, stream_with_context
 from flask.views import MethodView
 from sqlalchemy import create_engine
-from squealy import Squealy, Engine, Table, SquealyConfigException
+from squealy import Squealy, Engine, Table, RequestStats, SquealyConfigException
+from squealy.encoders import TableEncoder, chain_defaults, convert
+from squealy.http import PROFILE_HEADER, server_timing, etag_matches, cache_headers, Compression
 
 class FlaskSquealy(Squealy):
-    def __init__(self, app, home_dir=None, snippets=None, resources=None):
-        super(FlaskSquealy, self).__init__(snippets=snippets, resources=resources)
-        if home_dir:
+    def __init__(self, app, home_dir=None, snippets=None, resources=None, bundle=None, lazy=False):
+        super(FlaskSquealy, self).__init__(snippets=snippets, resources=resources, lazy=lazy)
+        # A bundle, built by python -m squealy.bundle, replaces loading yaml files from home_dir
+        if bundle:
+            self.load_bundle(bundle)
+        elif home_dir:
             self.load_objects(home_dir)
         self._load_engines(app)
 
@@ -26,18 +31,40 @@ class FlaskSquealy(Squealy):
             self.add_engine(name, SqlAlchemyEngine(engine))
 
 class SqlAlchemyEngine(Engine):
+    # Every query checks out its own connection from SQLAlchemy's pool
+    thread_safe = True
+
     def __init__(self, engine):
         self.engine = engine
+        self.dialect = engine.dialect.name
         self._set_param_style()
         
+    def connect(self):
+        'Checks out a connection from the pool. Override to instrument checkouts'
+        return self.engine.connect()
+
     def execute(self, query, bind_params):
-        with self.engine.connect() as conn:
+        with self.connect() as conn:
             result = conn.execute(query, bind_params)
             cols = result.keys()
             rows = result.fetchall()
         table = Table(columns=result.keys(), data=[r.values() for r in rows])
         return table
 
+    def execute_stream(self, query, bind_params):
+        with self.connect() as conn:
+            # Use server side cursors on databases that support them
+            result = conn.execution_options(stream_results=True).execute(query, bind_params)
+            cols = result.keys()
+            # Let the driver fetch a whole batch in one round trip
+            result.cursor.arraysize = self.batch_size
+            while True:
+                rows = result.fetchmany(self.batch_size)
+                # The first batch is returned even if it is empty, so callers know the columns
+                yield Table(columns=cols, data=[r.values() for r in rows])
+                if len(rows) < self.batch_size:
+                    break
+
     def _set_param_style(self):
         dialect_str = str(type(self.engine.dialect).__module__).lower()
         if 'sqlite' in dialect_str:
@@ -48,7 +75,17 @@ class SqlAlchemyEngine(Engine):
             self.param_style = 'format'            
 
 class SqlView(MethodView):
-    def __init__(self, resource_id=None, resource=None):
+    # Set to True, or pass server_timing=True to as_view, to add a Server-Timing header to responses
+    server_timing = False
+    # Responses are compressed for clients that accept gzip. Pass compression=False to as_view to turn it off,
+    # or a Compression with a different min_size or level
+    compression = Compression()
+
+    def __init__(self, resource_id=None, resource=None, server_timing=None, compression=None):
+        if server_timing is not None:
+            self.server_timing = server_timing
+        if compression is not None:
+            self.compression = compression
         if resource:
             self.resource = resource
         elif resource_id:
@@ -65,11 +102,98 @@ class SqlView(MethodView):
             "params": params
         }
 
-    def get(self, *args, **kwargs):
-        squealy = current_app.extensions['squealy']
+    def get_resource(self, squealy):
         if not self.resource:
             self.resource = squealy.get_resource(request.endpoint)
-        
+        return self.resource
+
+    def get_encoder(self):
+        'Converts dates and other values the same way as flask, and falls back to squealy for the rest'
+        json_provider = getattr(current_app, 'json', None)
+        if json_provider is not None and hasattr(json_provider, 'default'):
+            # Flask 2.2 and above
+            framework_default = json_provider.default
+        else:
+            framework_default = current_app.json_encoder().default
+        return TableEncoder(chain_defaults(framework_default, convert))
+
+    def get_stats(self):
+        'Collects timings if server_timing is enabled, and a profile if the app is in debug mode and the client asks for it'
+        profile = current_app.debug and PROFILE_HEADER in request.headers
+        return RequestStats(timings=self.server_timing, profile=profile)
+
+    def add_server_timing(self, response, stats):
+        if stats.timings:
+            response.headers['Server-Timing'] = server_timing(stats.timings)
+        return response
+
+    def add_cache_headers(self, response, http_cache, etag):
+        response.headers.update(cache_headers(http_cache, etag))
+        return response
+
+    def compress(self, content, stream=False):
+        'Compresses the body if the client accepts gzip. Returns the body and the headers to add to the response'
+        if not self.compression:
+            return content, {}
+        return self.compression.apply(request.headers.get('Accept-Encoding'), content, stream)
+
+    def is_not_modified(self, etag):
+        return etag_matches(request.headers.get('If-None-Match'), etag)
+
+    def not_modified(self, resource, etag, stats):
+        response = current_app.response_class(status=304)
+        return self.add_server_timing(self.add_cache_headers(response, resource.http_cache, etag), stats)
+
+    def json_response(self, resource, body, etag, stats):
+        '''Returns the json body, or 304 Not Modified if the client already has it
+
+        Without a version query, etag is None, and the ETag is computed from the body
+        '''
+        if resource.http_cache is not None and etag is None:
+            etag = resource.http_cache.etag_for_body(body)
+            if self.is_not_modified(etag):
+                return self.not_modified(resource, etag, stats)
+        body, headers = self.compress(body)
+        response = current_app.response_class(body, mimetype='application/json', headers=headers)
+        return self.add_server_timing(self.add_cache_headers(response, resource.http_cache, etag), stats)
+
+    def stream_response(self, resource, chunks, etag, stats):
+        # Only render and execute are known when the response starts
+        chunks, headers = self.compress(chunks, stream=True)
+        response = current_app.response_class(stream_with_context(chunks), mimetype='application/json', headers=headers)
+        return self.add_server_timing(self.add_cache_headers(response, resource.http_cache, etag), stats)
+
+    def get(self, *args, **kwargs):
+        squealy = current_app.extensions['squealy']
+        resource = self.get_resource(squealy)
+        context = self.build_context(request, *args, **kwargs)
+        stats = self.get_stats()
+        # With a version query, the queries are skipped if the client already has the response
+        etag = resource.etag(squealy, context, stats)
+        if self.is_not_modified(etag):
+            return self.not_modified(resource, etag, stats)
+        if resource.stream:
+            chunks = resource.process_stream(squealy, context, self.get_encoder(), stats)
+            return self.stream_response(resource, chunks, etag, stats)
+        body = resource.process_json(squealy, context, self.get_encoder(), stats)
+        return self.json_response(resource, body, etag, stats)
+
+class AsyncSqlView(SqlView):
+    '''Awaits queries instead of blocking the worker thread
+
+    Requires Flask 2.0 or above, installed with the async extra - pip install flask[async].
+    Streamed resources are processed the same way as SqlView, because Flask sends the response from the worker thread
+    '''
+    async def get(self, *args, **kwargs):
+        squealy = current_app.extensions['squealy']
+        resource = self.get_resource(squealy)
         context = self.build_context(request, *args, **kwargs)
-        data = self.resource.process(squealy, context)
-        return jsonify(data)
+        stats = self.get_stats()
+        etag = await resource.etag_async(squealy, context, stats)
+        if self.is_not_modified(etag):
+            return self.not_modified(resource, etag, stats)
+        if resource.stream:
+            chunks = resource.process_stream(squealy, context, self.get_encoder(), stats)
+            return self.stream_response(resource, chunks, etag, stats)
+        body = await resource.process_json_async(squealy, context, self.get_encoder(), stats)
+        return self.json_response(resource, body, etag, stats)
@@ -7,6 +7,28 @@ class Formatter:
     def supports_multi_queries(self):
         return False
 
+    def supports_streaming(self):
+        return False
+
+    def format_stream(self, query, tables, encoder):
+        '''Format an iterator of tables into an iterator of json strings
+        
+        Only called for resources with a single list query, if the formatter supports streaming.
+        encoder is a TableEncoder, which serializes the rows of each table
+        '''
+        pass
+
+    def can_encode(self, query):
+        'True if encode() can format the table of the query. Otherwise, the output of format() is serialized instead'
+        return False
+
+    def encode(self, query, table, encoder):
+        '''Format a table directly to json text, using a TableEncoder
+        
+        Only called for resources with a single query, if can_encode returns True
+        '''
+        pass
+
     def format(self, prev_results, query, table):
         '''Format a table, combine it with the results from previous queries, and return the new result
         
@@ -23,6 +45,13 @@ class SimpleFormatter(Formatter):
         data = {"columns": table.columns, "data": table.data}
         return data
 
+    def can_encode(self, query):
+        return True
+
+    def encode(self, query, table, encoder):
+        rows = encoder.encode_arrays(table)
+        return '{"columns": ' + encoder.dumps(table.columns) + ', "data": [' + ', '.join(rows) + ']}'
+
 class JsonFormatter(Formatter):
     def __init__(self, envelope="data"):
         self.envelope = envelope
@@ -42,14 +71,18 @@ class JsonFormatter(Formatter):
         
         result = table.as_dict()
         if query.is_object:
-            result = result[0]
+            # An optional object query may not return any rows
+            result = result[0] if result else None
 
         if query.is_root:
             return self._add_envelope(result)
         elif isinstance(prev_results, dict) or prev_results is None:
             if prev_results is None:
                 prev_results = {}
-            prev_results[query.key] = result
+            if query.merge and query.merge.get('path'):
+                self._merge_lists([prev_results], result, query.merge, query.key)
+            else:
+                prev_results[query.key] = result
             return self._add_envelope(prev_results)
         elif isinstance(prev_results, list):
             assert query.is_list
@@ -58,29 +91,89 @@ class JsonFormatter(Formatter):
         else:
             raise Exception("Should not come here")
 
+    def can_encode(self, query):
+        # Child queries are merged into the results of their parent by format()
+        return query.is_root
+
+    def encode(self, query, table, encoder):
+        if query.is_object:
+            rows = encoder.encode_objects(table, limit=1)
+            result = rows[0] if rows else 'null'
+        else:
+            result = '[' + ', '.join(encoder.encode_objects(table)) + ']'
+        return '{' + encoder.dumps(self.envelope) + ': ' + result + '}'
+
+    def supports_streaming(self):
+        return True
+
+    def format_stream(self, query, tables, encoder):
+        yield '{' + encoder.dumps(self.envelope) + ': ['
+        first = True
+        for table in tables:
+            if len(table) == 0:
+                continue
+            rows = ', '.join(encoder.encode_objects(table))
+            yield rows if first else ', ' + rows
+            first = False
+        yield ']}'
+
     def _merge_lists(self, parent_list, child_list, merge, key):
-        for parent in parent_list:
-            primary_key = parent[merge['parent']]
-            children = [c for c in child_list if c[merge['child']] == primary_key]
-            parent[key] = children
+        '''Attach each child to the parents whose merge['parent'] column equals the child's merge['child'] column
+        
+        Children are grouped by their key in one pass, and then looked up for each parent.
+        If merge['path'] is provided, the parents are the objects found by following the dotted path
+        from the top level objects, which lets children of children be merged.
+        '''
+        groups = {}
+        child_column = merge['child']
+        for child in child_list:
+            groups.setdefault(child[child_column], []).append(child)
+
+        parent_column = merge['parent']
+        for parent in self._find_parents(parent_list, merge.get('path')):
+            parent[key] = groups.get(parent[parent_column], [])
+
+    def _find_parents(self, parent_list, path):
+        if not path:
+            return parent_list
+        for part in path.split("."):
+            nested = []
+            for parent in parent_list:
+                value = parent.get(part)
+                if isinstance(value, list):
+                    nested.extend(value)
+                elif isinstance(value, dict):
+                    nested.append(value)
+            parent_list = nested
+        return parent_list
 
 class SeriesFormatter(Formatter):
     def supports_multi_queries(self):
         return False
 
     def _transpose(self, table):
-        transposed = {}
-        for colnum, colname in enumerate(table.columns):
-            series = []
-            for row in table.data:
-                series.append(row[colnum])
-            transposed[colname] = series
-        return transposed
+        # If column names repeat, the last column wins
+        return dict(zip(table.columns, map(table.column_values, range(len(table.columns)))))
 
     def format(self, prev_results, query, table):
         transposed = self._transpose(table)
         return {"data": transposed}
 
+    def can_encode(self, query):
+        return True
+
+    def encode(self, query, table, encoder):
+        # If column names repeat, the last column wins, same as _transpose
+        positions = {}
+        for colnum, colname in enumerate(table.columns):
+            positions[colname] = colnum
+        series = [encoder.dumps(colname) + ': ' + encoder.encode_array(table.column_values(colnum))
+                    for colname, colnum in positions.items()]
+        return '{"data": {' + ', '.join(series) + '}}'
+
+
+# bool is a subclass of int, but is not a number as far as google charts is concerned
+_NUMBER_TYPES = {int, float}
 
 class GoogleChartsFormatter(Formatter):
     def _generate_chart_data(self, table, column_types):
@@ -112,20 +205,29 @@ class GoogleChartsFormatter(Formatter):
         for index, column in enumerate(table.columns):
             cols.append({"id": column, "label": column, "type": column_types[index]})
         
-        for row in table.data:
-            row_list = [{"v": e} for e in row]
-            rows.append({"c": row_list})
+        rows.extend({"c": [{"v": e} for e in row]} for row in table.data)
         return response
 
     def format(self, prev_results, query, table):
-        # By default, every column is a string
-        column_types = ['string'] * len(table.columns)
-
-        # Identify column data types by looking at the first row only
-        for row in table.data:
-            for index, data in enumerate(row):
-                if type(data) in [int, float]:
-                    column_types[index] = 'number'
-            break
-        
-        return self._generate_chart_data(table, column_types)
\ No newline at end of file
+        column_types = self._find_column_types(table)
+        return self._generate_chart_data(table, column_types)
+
+    def _find_column_types(self, table):
+        '''A column is a number if all its values are ints or floats, ignoring NULLs.
+        Every other column, including one that only has NULLs, is a string'''
+        column_types = []
+        for values in map(table.column_values, range(len(table.columns))):
+            types = set(map(type, values))
+            types.discard(type(None))
+            column_types.append('number' if types and types <= _NUMBER_TYPES else 'string')
+        return column_types
+
+    def can_encode(self, query):
+        return True
+
+    def encode(self, query, table, encoder):
+        column_types = self._find_column_types(table)
+        cols = [{"id": column, "label": column, "type": column_types[index]} for index, column in enumerate(table.columns)]
+        template = '{"c": [' + ', '.join(['{"v": %s}'] * len(table.columns)) + ']}'
+        rows = encoder.encode_rows(table, template)
+        return '{"rows": [' + ', '.join(rows) + '], "cols": ' + encoder.dumps(cols) + '}'
\ No newline at end of file
@@ -0,0 +1,167 @@
+'''Helpers for the http responses of the Flask and Django views'''
+import hashlib
+import json
+import re
+import zlib
+
+from .core import SquealyConfigException, Query, check_int
+
+# When the application runs in debug mode, requests with this header get a profile in the response
+PROFILE_HEADER = 'X-Squealy-Profile'
+
+# Characters that are not allowed in a Server-Timing metric name
+_NOT_TOKEN = re.compile(r"[^!#$%&'*+\-.^_`|~0-9A-Za-z]")
+
+def server_timing(timings):
+    '''Formats the timings of RequestStats as the value of a Server-Timing header
+
+    Rendering is reported as a single render metric. Every query has its own execute metric,
+    named execute.<query key>, which adds up the chunks of the query if it was split.
+    Durations are in milliseconds
+    '''
+    totals = {}
+    for stage, query, seconds in timings:
+        if stage == 'execute':
+            name = 'execute.' + _NOT_TOKEN.sub('_', query)
+        else:
+            name = stage
+        totals[name] = totals.get(name, 0) + seconds
+    return ', '.join(name + ';dur=' + format(seconds * 1000, '.3f') for name, seconds in totals.items())
+
+def etag_matches(if_none_match, etag):
+    '''True if the If-None-Match header of a request matches the ETag, and the response can be 304 Not Modified
+
+    Uses the weak comparison of If-None-Match, which ignores the W/ prefix of weak ETags
+    '''
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    return _opaque_tag(etag) in {_opaque_tag(tag.strip()) for tag in if_none_match.split(',')}
+
+def _opaque_tag(etag):
+    return etag[2:] if etag.startswith('W/') else etag
+
+class HttpCache:
+    '''HTTP caching of the responses of a resource, configured in the resource like -
+        http_cache:
+          max_age: 60               # optional, seconds a client may reuse a response without asking again
+          private: true             # optional, false lets shared caches like a CDN store the response. Defaults to true
+          version_query: SELECT max(updated_at) FROM questions      # optional
+
+    Responses get an ETag and a Cache-Control header. Requests with a matching If-None-Match header
+    get 304 Not Modified without a body, so clients that poll do not download the same response again.
+
+    By default, the ETag is a hash of the response, so the queries still run on every request.
+    With a version_query, the ETag is a hash of its result and the request parameters instead,
+    and the queries of the resource do not run at all if the client already has the response.
+    The version query must change whenever the response would change, for example the last time the tables were modified.
+    It is rendered with the same context as the queries of the resource.
+    Streamed responses only get an ETag if the resource has a version_query
+    '''
+    def __init__(self, max_age=None, private=True, version_query=None):
+        if max_age is not None:
+            check_int("http_cache max_age", max_age, minimum=0)
+        if not isinstance(private, bool):
+            raise SquealyConfigException("http_cache private must be true or false")
+        self.max_age = max_age
+        self.private = private
+        self.version_query = Query(key='version', queryForList=version_query) if version_query else None
+
+    @property
+    def cache_control(self):
+        'Without a max_age, clients may store the response but must check that it is unchanged before using it'
+        scope = 'private' if self.private else 'public'
+        if self.max_age is None:
+            return scope + ', no-cache'
+        return scope + ', max-age=' + str(self.max_age)
+
+    def etag_for_body(self, body):
+        return _weak_etag(body.encode('utf-8') if isinstance(body, str) else body)
+
+    def etag_for_version(self, resource_id, version, context):
+        text = json.dumps([resource_id, version, context], sort_keys=True, default=str)
+        return _weak_etag(text.encode('utf-8'))
+
+def _weak_etag(data):
+    # Weak, because the same data can be sent in different encodings, for example compressed
+    return 'W/"' + hashlib.blake2b(data, digest_size=16).hexdigest() + '"'
+
+def cache_headers(http_cache, etag):
+    'The Cache-Control and ETag headers for a resource with an HttpCache, in both 200 and 304 responses'
+    if http_cache is None:
+        return {}
+    headers = {'Cache-Control': http_cache.cache_control}
+    if etag:
+        headers['ETag'] = etag
+    return headers
+
+def accepts_gzip(accept_encoding):
+    'True if the Accept-Encoding header of a request allows a gzip response'
+    if not accept_encoding:
+        return False
+    qvalues = {}
+    for coding in accept_encoding.split(','):
+        name, _, params = coding.partition(';')
+        qvalue = 1.0
+        for param in params.split(';'):
+            key, _, value = param.partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+        qvalues[name.strip().lower()] = qvalue
+    return qvalues.get('gzip', qvalues.get('x-gzip', qvalues.get('*', 0.0))) > 0
+
+class Compression:
+    '''Compresses responses with gzip, for clients that send Accept-Encoding: gzip
+
+    Responses smaller than min_size bytes are sent as is, because compressing them costs more than it saves.
+    level is the zlib compression level, from 1 - the fastest, to 9 - the smallest.
+    The size of a streamed response is not known upfront, so it is always compressed, one chunk at a time as it is sent
+    '''
+    def __init__(self, min_size=1024, level=6):
+        check_int("compression min_size", min_size, minimum=0)
+        check_int("compression level", level, maximum=9)
+        self.min_size = min_size
+        self.level = level
+
+    def apply(self, accept_encoding, content, stream=False):
+        '''Compresses the body of a response if the Accept-Encoding header of the request allows it
+
+        content is a string, or an iterator of strings if stream is True.
+        Returns the body, compressed or not, and the headers to add to the response
+        '''
+        headers = {'Vary': 'Accept-Encoding'}
+        if accepts_gzip(accept_encoding):
+            compressed = self.compress_stream(content) if stream else self.compress(content)
+            if compressed is not None:
+                headers['Content-Encoding'] = 'gzip'
+                return compressed, headers
+        return content, headers
+
+    def compress(self, body):
+        'Returns the gzip compressed body, or None if it is smaller than min_size'
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        if len(body) < self.min_size:
+            return None
+        compressor = self._compressor()
+        return compressor.compress(body) + compressor.flush()
+
+    def compress_stream(self, chunks):
+        '''Compresses an iterator of strings into an iterator of gzip bytes
+
+        zlib only holds on to its window, so the uncompressed response is never buffered in full
+        '''
+        compressor = self._compressor()
+        for chunk in chunks:
+            data = compressor.compress(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+
+    def _compressor(self):
+        # wbits of 16 + 15 writes the gzip header and trailer around the deflate stream
+        return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
@@ -0,0 +1,80 @@
+from threading import Lock
+
+# Metrics are only collected if prometheus_client is installed - pip install squealy[prometheus]
+try:
+    from prometheus_client import Counter, Histogram, REGISTRY
+except ImportError:
+    Counter = Histogram = REGISTRY = None
+
+QUERY_LABELS = ('resource', 'query', 'datasource')
+RESOURCE_LABELS = ('resource', )
+
+# Rows returned by a query, and bytes in a response, grow in powers of 4
+ROW_BUCKETS = (0, 1, 4, 16, 64, 256, 1024, 4096, 16384, 65536, 262144, 1048576)
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864)
+
+class PrometheusMetrics:
+    '''Prometheus metrics for the stages of processing a request
+
+    Query stages - render and execute - are labeled by resource id, query key and datasource.
+    Resource stages - format and serialize - are labeled by resource id.
+    Errors are counted by resource id and the stage that failed.
+
+    Metrics are registered in the provided registry, or the default registry of prometheus_client,
+    so they are exported by the application's existing /metrics endpoint
+    '''
+    def __init__(self, registry=None):
+        if Histogram is None:
+            raise ImportError("prometheus_client is not installed")
+        registry = registry if registry is not None else REGISTRY
+        self.render_seconds = Histogram('squealy_template_render_seconds',
+            'Time taken to render the template of a query', QUERY_LABELS, registry=registry)
+        self.execute_seconds = Histogram('squealy_query_execute_seconds',
+            'Time taken to execute a query and fetch its rows', QUERY_LABELS, registry=registry)
+        self.rows = Histogram('squealy_query_rows',
+            'Number of rows returned by a query', QUERY_LABELS, buckets=ROW_BUCKETS, registry=registry)
+        self.format_seconds = Histogram('squealy_format_seconds',
+            'Time taken to format the results of a resource', RESOURCE_LABELS, registry=registry)
+        self.serialize_seconds = Histogram('squealy_serialize_seconds',
+            'Time taken to serialize the response of a resource to json', RESOURCE_LABELS, registry=registry)
+        self.response_bytes = Histogram('squealy_response_bytes',
+            'Size of the json response of a resource', RESOURCE_LABELS, buckets=BYTE_BUCKETS, registry=registry)
+        self.errors = Counter('squealy_errors',
+            'Number of requests that failed, by the stage that failed', RESOURCE_LABELS + ('stage', ), registry=registry)
+
+    def observe_query(self, stage, resource, query, datasource, seconds, rows=None):
+        'stage is render or execute. rows is only provided for execute'
+        if stage == 'render':
+            self.render_seconds.labels(resource, query, datasource).observe(seconds)
+        else:
+            self.execute_seconds.labels(resource, query, datasource).observe(seconds)
+            if rows is not None:
+                self.rows.labels(resource, query, datasource).observe(rows)
+
+    def observe_resource(self, stage, resource, seconds, num_bytes=None):
+        'stage is format or serialize. num_bytes is only provided for serialize'
+        if stage == 'format':
+            self.format_seconds.labels(resource).observe(seconds)
+        else:
+            self.serialize_seconds.labels(resource).observe(seconds)
+            if num_bytes is not None:
+                self.response_bytes.labels(resource).observe(num_bytes)
+
+    def count_error(self, resource, stage):
+        self.errors.labels(resource, stage).inc()
+
+_default_metrics = None
+_default_metrics_lock = Lock()
+
+def default_metrics():
+    '''Metrics in the default registry, shared by all Squealy objects in the process
+
+    Returns None if prometheus_client is not installed
+    '''
+    global _default_metrics
+    if Histogram is None:
+        return None
+    with _default_metrics_lock:
+        if _default_metrics is None:
+            _default_metrics = PrometheusMetrics()
+        return _default_metrics
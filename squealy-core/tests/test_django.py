@@ -45,13 +45,18 @@ from squealy.django import DjangoSquealy
 from squealy import Resource
 
 resource = Resource("userprofile", queries=[{"queryForObject": "SELECT 1 as id, 'A' as name"}])
-squealy = DjangoSquealy(resources={resource.id: resource})
+streamed = Resource("streamed-users", stream=True, queries=[{"queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id"}])
+paged = Resource("paged-users", pagination={"page_size": 2, "keys": ["id"]},
+    queries=[{"queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id UNION ALL SELECT 3 as id"}])
+cached = Resource("cached-userprofile", http_cache={"max_age": 60}, queries=[{"queryForObject": "SELECT 1 as id, 'A' as name"}])
+squealy = DjangoSquealy(resources={resource.id: resource, streamed.id: streamed, cached.id: cached, paged.id: paged})
 
 # end of squealy.py
 
 #Contents of urls.py
 from django.urls import path
-from squealy.django import SqlView, AnonymousSqlView
+from squealy.django import SqlView, AnonymousSqlView, AsyncAnonymousSqlView, AsyncSqlView
+from squealy.http import Compression
 urlpatterns = [
     # Use an application provided squealy object
     path('squealy/userprofile/', AnonymousSqlView.as_view(resource='userprofile', squealy=squealy)),
@@ -73,12 +78,41 @@ urlpatterns = [
 
     # Must be authenticated
     path('squealy/auth-userprofile/', SqlView.as_view(resource='userprofile', squealy=squealy)),
+
+    # Rows are streamed to the client
+    path('squealy/streamed-users/', AnonymousSqlView.as_view(resource='streamed-users', squealy=squealy)),
+
+    # Adds a Server-Timing header
+    path('squealy/timed-questions/', AnonymousSqlView.as_view(resource='questions', server_timing=True)),
+
+    # Has Cache-Control and ETag headers
+    path('squealy/cached-userprofile/', AnonymousSqlView.as_view(resource='cached-userprofile', squealy=squealy)),
+
+    # Returns a page of rows, and a cursor for the next page
+    path('squealy/paged-users/', AnonymousSqlView.as_view(resource='paged-users', squealy=squealy)),
+
+    # Compresses responses larger than 10 bytes
+    path('squealy/compressed-streamed-users/', AnonymousSqlView.as_view(resource='streamed-users', squealy=squealy,
+        compression=Compression(min_size=10))),
+
+    # Async views, queries are awaited
+    path('squealy/async-questions/', AsyncAnonymousSqlView.as_view(resource='questions')),
+    path('squealy/async-auth-userprofile/', AsyncSqlView.as_view(resource='userprofile', squealy=squealy)),
+    path('squealy/async-cached-userprofile/', AsyncAnonymousSqlView.as_view(resource='cached-userprofile', squealy=squealy)),
+    path('squealy/async-streamed-users/', AsyncAnonymousSqlView.as_view(resource='streamed-users', squealy=squealy,
+        compression=Compression(min_size=10))),
 ]
 
 # Our Test Cases start from here
 
 
+import asyncio
+import gzip
+import json
 import unittest
+from unittest.mock import patch
+import django
+from django.http import HttpRequest
 from django.test import Client
 from django.db import connections
 from squealy.django import DjangoORMEngine
@@ -92,6 +126,16 @@ class DjangoTests(unittest.TestCase):
         self.assertEqual(['A', 'B'], table.columns)
         self.assertEqual([('a', 1)], table.data)
 
+    def test_execute_stream_uses_chunked_cursor(self):
+        engine = DjangoORMEngine('default')
+        engine.batch_size = 2
+        connection = connections['default']
+        # On SQLite, chunked_cursor returns a plain cursor. On PostgreSQL and MySQL, it is a server side cursor
+        with patch.object(connection, 'chunked_cursor', wraps=connection.chunked_cursor) as chunked_cursor:
+            batches = list(engine.execute_stream("SELECT 1 as id UNION ALL SELECT 2 UNION ALL SELECT 3", []))
+        chunked_cursor.assert_called_once_with()
+        self.assertEqual([batch.data for batch in batches], [[(1,), (2,)], [(3,)]])
+
     def test_sqlview(self):
         c = Client()
         response = c.get("/squealy/userprofile/")
@@ -137,10 +181,105 @@ class DjangoTests(unittest.TestCase):
             {'id': 2, 'comment': 'Nothing spectacular, but this is the second comment'}
         ])
 
+    def test_streamed_sqlview(self):
+        c = Client()
+        response = c.get("/squealy/streamed-users/")
+        self.assertTrue(response.streaming)
+        body = b"".join(response.streaming_content)
+        self.assertEqual(json.loads(body), {'data': [{'id': 1}, {'id': 2}]})
+
+    def test_server_timing(self):
+        c = Client()
+        response = c.get("/squealy/timed-questions/")
+        names = [metric.split(';')[0] for metric in response['Server-Timing'].split(', ')]
+        self.assertEqual(names, ['render', 'execute.root', 'execute.comments', 'format', 'serialize'])
+        self.assertFalse(c.get("/squealy/questions/").has_header('Server-Timing'))
+
+    def test_profile_in_debug_mode(self):
+        c = Client()
+        response = c.get("/squealy/questions/", HTTP_X_SQUEALY_PROFILE='1')
+        profile = response.json()['profile']
+        self.assertEqual([q['rows'] for q in profile['queries']], [2, 5])
+        self.assertNotIn('profile', c.get("/squealy/questions/").json())
+
+    def test_conditional_get(self):
+        c = Client()
+        response = c.get("/squealy/cached-userprofile/")
+        self.assertEqual(response['Cache-Control'], 'private, max-age=60')
+        etag = response['ETag']
+        response = c.get("/squealy/cached-userprofile/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        self.assertEqual(response['ETag'], etag)
+        self.assertEqual(c.get("/squealy/cached-userprofile/", HTTP_IF_NONE_MATCH='W/"other"').status_code, 200)
+        self.assertFalse(c.get("/squealy/userprofile/").has_header('ETag'))
+
+    def test_gzip_streamed_sqlview(self):
+        c = Client()
+        response = c.get("/squealy/compressed-streamed-users/", HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Vary'], 'Accept-Encoding')
+        body = gzip.decompress(b"".join(response.streaming_content))
+        self.assertEqual(json.loads(body), {'data': [{'id': 1}, {'id': 2}]})
+        self.assertFalse(c.get("/squealy/compressed-streamed-users/").has_header('Content-Encoding'))
+
+    def test_without_request_headers(self):
+        # HttpRequest.headers was added in Django 2.2, the views read headers from request.META
+        with patch.object(HttpRequest, 'headers', property(lambda request: self.fail("request.headers was used"))):
+            response = Client().get("/squealy/questions/", HTTP_X_SQUEALY_PROFILE='1')
+            self.assertIn('profile', response.json())
+            response = Client().get("/squealy/cached-userprofile/")
+            self.assertEqual(Client().get("/squealy/cached-userprofile/", HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            response = Client().get("/squealy/compressed-streamed-users/", HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(response['Content-Encoding'], 'gzip')
+
+    def test_pagination(self):
+        c = Client()
+        data = c.get("/squealy/paged-users/").json()
+        self.assertEqual(data['data'], [{'id': 1}, {'id': 2}])
+        data = c.get("/squealy/paged-users/", {'cursor': data['cursor']}).json()
+        self.assertEqual(data, {'data': [{'id': 3}], 'cursor': None})
+
     def test_sqlview_with_authentication(self):
         c = Client()
         response = c.get("/squealy/auth-userprofile/")
         # Expect a redirect to login page
         self.assertEqual(response.url, '/accounts/login/?next=/squealy/auth-userprofile/')
 
-        
\ No newline at end of file
+    @unittest.skipIf(django.VERSION < (4, 1), "Async class based views require Django 4.1 or above")
+    def test_async_sqlview(self):
+        c = Client()
+        response = c.get("/squealy/async-questions/")
+        data = response.json()['data']
+        self.assertEqual([q['id'] for q in data], [1, 2])
+        self.assertEqual(len(data[0]['comments']), 3)
+
+    @unittest.skipIf(django.VERSION < (4, 1), "Async class based views require Django 4.1 or above")
+    def test_async_sqlview_with_authentication(self):
+        c = Client()
+        response = c.get("/squealy/async-auth-userprofile/")
+        self.assertEqual(response.url, '/accounts/login/?next=/squealy/async-auth-userprofile/')
+
+    @unittest.skipIf(django.VERSION < (4, 1), "Async class based views require Django 4.1 or above")
+    def test_async_conditional_get(self):
+        c = Client()
+        response = c.get("/squealy/async-cached-userprofile/")
+        self.assertEqual(response.json(), {'data': {'id': 1, 'name': 'A'}})
+        self.assertEqual(response['Cache-Control'], 'private, max-age=60')
+        response = c.get("/squealy/async-cached-userprofile/", HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    @unittest.skipIf(django.VERSION < (4, 1), "Async class based views require Django 4.1 or above")
+    @unittest.skipIf(django.VERSION < (4, 2), "Streamed responses in async views require Django 4.2 or above")
+    def test_async_streamed_sqlview(self):
+        from django.test import AsyncClient
+        async def get():
+            response = await AsyncClient().get("/squealy/async-streamed-users/", headers={'Accept-Encoding': 'gzip'})
+            # Django would read a synchronous iterator in full into memory
+            self.assertTrue(response.is_async)
+            return response, b"".join([part async for part in response.streaming_content])
+
+        response, body = asyncio.get_event_loop().run_until_complete(get())
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body)), {'data': [{'id': 1}, {'id': 2}]})
@@ -1,7 +1,10 @@
+import gzip
 import os
+import flask
 from flask import Flask
 from squealy import Resource
-from squealy.flask import FlaskSquealy, SqlView, SqlAlchemyEngine
+from squealy.flask import FlaskSquealy, SqlView, AsyncSqlView, SqlAlchemyEngine
+from squealy.http import Compression
 from sqlalchemy import create_engine
 
 app = Flask(__name__)
@@ -11,6 +14,24 @@ engine = SqlAlchemyEngine(create_engine("sqlite:///:memory:"))
 squealy.add_engine('default', engine)
 
 app.add_url_rule('/squealy/questions', view_func=SqlView.as_view('questions'))
+app.add_url_rule('/squealy/timed-questions', view_func=SqlView.as_view('timed-questions', resource_id='questions', server_timing=True))
+app.add_url_rule('/squealy/compressed-questions', view_func=SqlView.as_view('compressed-questions', resource_id='questions', compression=Compression(min_size=10)))
+app.add_url_rule('/squealy/uncompressed-questions', view_func=SqlView.as_view('uncompressed-questions', resource_id='questions', compression=False))
+
+streamed = Resource("streamed-users", stream=True, queries=[{"queryForList": "SELECT 1 as id, 'sri' as name UNION ALL SELECT 2 as id, 'anshu' as name"}])
+squealy.add_resource(streamed)
+app.add_url_rule('/squealy/streamed-users', view_func=SqlView.as_view('streamed-users'))
+app.add_url_rule('/squealy/compressed-streamed-users', view_func=SqlView.as_view('compressed-streamed-users', resource_id='streamed-users', compression=Compression(min_size=10)))
+
+versioned = Resource("versioned-questions", http_cache={"private": False, "version_query": "SELECT 7 as version"},
+    queries=[{"queryForList": "SELECT id FROM (SELECT 1 as id UNION ALL SELECT 2 as id) t WHERE id > {{ params.after | default(0) }}"}])
+squealy.add_resource(versioned)
+app.add_url_rule('/squealy/versioned-questions', view_func=SqlView.as_view('versioned-questions', server_timing=True))
+
+# Async views, queries are awaited
+app.add_url_rule('/squealy/async-questions', view_func=AsyncSqlView.as_view('async-questions', resource_id='questions'))
+app.add_url_rule('/squealy/async-versioned-questions', view_func=AsyncSqlView.as_view('async-versioned-questions', resource_id='versioned-questions'))
+app.add_url_rule('/squealy/async-streamed-users', view_func=AsyncSqlView.as_view('async-streamed-users', resource_id='streamed-users', compression=Compression(min_size=10)))
 
 ## Test Cases start from here
 
@@ -36,3 +57,96 @@ class FlaskTests(unittest.TestCase):
                     ]
                 }
             ])
+
+    def test_streamed_response(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/streamed-users")
+            self.assertTrue(rv.is_streamed)
+            self.assertEqual(rv.mimetype, 'application/json')
+            data = json.loads(rv.data)
+            self.assertEqual(data['data'], [{'id': 1, 'name': 'sri'}, {'id': 2, 'name': 'anshu'}])
+
+    def test_server_timing(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/timed-questions")
+            names = [metric.split(';')[0] for metric in rv.headers['Server-Timing'].split(', ')]
+            self.assertEqual(names, ['render', 'execute.root', 'execute.comments', 'format', 'serialize'])
+            self.assertNotIn('profile', json.loads(rv.data))
+
+            rv = client.get("/squealy/questions")
+            self.assertNotIn('Server-Timing', rv.headers)
+
+    def test_profile_only_in_debug_mode(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/questions", headers={'X-Squealy-Profile': '1'})
+            self.assertNotIn('profile', json.loads(rv.data))
+            app.debug = True
+            try:
+                rv = client.get("/squealy/questions", headers={'X-Squealy-Profile': '1'})
+            finally:
+                app.debug = False
+            profile = json.loads(rv.data)['profile']
+            self.assertEqual([q['key'] for q in profile['queries']], ['root', 'comments'])
+            self.assertEqual([q['rows'] for q in profile['queries']], [2, 5])
+            self.assertEqual(profile['queries'][1]['bind_params'], 2)
+            self.assertIn('SELECT', profile['queries'][0]['sql'])
+
+    def test_conditional_get_with_version_query(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/versioned-questions")
+            self.assertEqual(rv.headers['Cache-Control'], 'public, no-cache')
+            etag = rv.headers['ETag']
+            self.assertEqual(len(json.loads(rv.data)['data']), 2)
+
+            rv = client.get("/squealy/versioned-questions", headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 304)
+            self.assertEqual(rv.headers['ETag'], etag)
+            # Only the version query was executed
+            names = [metric.split(';')[0] for metric in rv.headers['Server-Timing'].split(', ')]
+            self.assertEqual(names, ['render', 'execute.version'])
+
+            # Other parameters have a different ETag
+            rv = client.get("/squealy/versioned-questions?after=1", headers={'If-None-Match': etag})
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotEqual(rv.headers['ETag'], etag)
+
+    def test_gzip(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/compressed-questions", headers={'Accept-Encoding': 'gzip'})
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(rv.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(json.loads(gzip.decompress(rv.data))['data'][0]['id'], 1)
+
+            rv = client.get("/squealy/compressed-questions")
+            self.assertNotIn('Content-Encoding', rv.headers)
+            self.assertEqual(json.loads(rv.data)['data'][0]['id'], 1)
+
+            # The default min_size is larger than the response
+            rv = client.get("/squealy/questions", headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', rv.headers)
+            rv = client.get("/squealy/uncompressed-questions", headers={'Accept-Encoding': 'gzip'})
+            self.assertNotIn('Content-Encoding', rv.headers)
+            self.assertNotIn('Vary', rv.headers)
+
+    def test_gzip_streamed_response(self):
+        with app.test_client() as client:
+            rv = client.get("/squealy/compressed-streamed-users", headers={'Accept-Encoding': 'gzip'})
+            self.assertTrue(rv.is_streamed)
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            data = json.loads(gzip.decompress(rv.data))
+            self.assertEqual(data['data'], [{'id': 1, 'name': 'sri'}, {'id': 2, 'name': 'anshu'}])
+
+    @unittest.skipIf(int(flask.__version__.split('.')[0]) < 2, "Async views require Flask 2.0 or above")
+    def test_async_sqlview(self):
+        with app.test_client() as client:
+            self.assertEqual(json.loads(client.get("/squealy/async-questions").data), json.loads(client.get("/squealy/questions").data))
+
+            rv = client.get("/squealy/async-versioned-questions")
+            self.assertEqual(rv.headers['Cache-Control'], 'public, no-cache')
+            rv = client.get("/squealy/async-versioned-questions", headers={'If-None-Match': rv.headers['ETag']})
+            self.assertEqual(rv.status_code, 304)
+
+            rv = client.get("/squealy/async-streamed-users", headers={'Accept-Encoding': 'gzip'})
+            self.assertTrue(rv.is_streamed)
+            self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(rv.data))['data'], [{'id': 1, 'name': 'sri'}, {'id': 2, 'name': 'anshu'}])
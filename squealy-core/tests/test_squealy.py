@@ -1,10 +1,29 @@
+import asyncio
+import base64
+import gzip
+import json
 import os
+import pickle
+import signal
+import tempfile
+import threading
+import time
 import unittest
+from datetime import datetime
+from decimal import Decimal
+from enum import IntEnum
+from unittest.mock import patch
 from uuid import uuid4
-from squealy import Squealy, Resource, Engine, Table, SquealyYamlException
+from squealy import Squealy, TableEncoder, Resource, Engine, AsyncEngine, SyncEngineAdapter, Table, RequestStats, SquealyYamlException, SquealyConfigException, SquealyBadRequestException, SquealyException
 from squealy.formatters import JsonFormatter, SimpleFormatter, SeriesFormatter, GoogleChartsFormatter
 
-from squealy.core import _load_yaml
+from squealy.core import _load_yaml, _parse_yaml, _unflatten_plan, TableProxy, Query
+from squealy.encoders import convert
+from squealy.bundle import build_bundle
+from squealy.cache import LRUCache
+from squealy.http import Compression, accepts_gzip
+from squealy.concurrency import SingleFlight, AsyncSingleFlight
+from squealy.metrics import PrometheusMetrics
 
 class InMemorySqliteEngine(Engine):
     def __init__(self):
@@ -20,6 +39,18 @@ class InMemorySqliteEngine(Engine):
         return Table(cols, rows)
 
 
+class CountingEngine(Engine):
+    'Wraps an engine and counts the number of queries executed'
+    def __init__(self, engine):
+        self.engine = engine
+        self.param_style = engine.param_style
+        self.count = 0
+
+    def execute(self, query, bind_params):
+        self.count += 1
+        return self.engine.execute(query, bind_params)
+
+
 class LoaderTests(unittest.TestCase):
     def test_load_from_memory(self):
         queries = [{
@@ -31,6 +62,23 @@ class LoaderTests(unittest.TestCase):
         data = resource.process(squealy, {"params": {}})
         self.assertEqual(data, {'data': [{'id': 1, 'name': 'sri'}, {'id': 2, 'name': 'anshu'}]})
 
+    def test_load_objects_from_nested_directories(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            os.makedirs(os.path.join(tmpdir, "reports", "monthly"))
+            with open(os.path.join(tmpdir, "reports", "monthly", "sales.resource.yml"), 'w') as f:
+                f.write("id: sales\nqueries:\n  - queryForList: SELECT {% include 'one' %} as id\n")
+            with open(os.path.join(tmpdir, "snippets.yml"), 'w') as f:
+                f.write("one: '1'\n")
+            with open(os.path.join(tmpdir, "reports", "notes.yml"), 'w') as f:
+                f.write("not: a resource\n")
+            squealy = Squealy()
+            squealy.add_engine('default', InMemorySqliteEngine())
+            squealy.load_objects(tmpdir)
+
+        self.assertEqual(set(squealy.get_resources().keys()), {"sales", os.path.join("reports", "monthly", "sales.resource.yml")})
+        data = squealy.get_resource("sales").process(squealy, {"params": {}})
+        self.assertEqual(data, {'data': [{'id': 1}]})
+
     def test_load_malformed_yaml(self):
         ymlfile = os.path.join(os.path.dirname(__file__), "malformed.yaml")
         with self.assertRaises(SquealyYamlException):
@@ -155,6 +203,1287 @@ class ResourceTests(unittest.TestCase):
             }
         ])
 
+class BundleTests(unittest.TestCase):
+    def setUp(self):
+        self.tests_dir = os.path.dirname(__file__)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.bundle_file = os.path.join(self.tmpdir.name, "squealy.bundle")
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def load_bundle(self):
+        squealy = Squealy()
+        squealy.add_engine('default', InMemorySqliteEngine())
+        squealy.load_bundle(self.bundle_file)
+        return squealy
+
+    def test_bundle_has_same_resources_as_yaml_files(self):
+        build_bundle([self.tests_dir], self.bundle_file)
+        bundled = self.load_bundle()
+        loaded = Squealy()
+        loaded.add_engine('default', InMemorySqliteEngine())
+        loaded.load_objects(self.tests_dir)
+
+        self.assertEqual(set(bundled.get_resources().keys()), set(loaded.get_resources().keys()))
+        self.assertEqual(bundled.snippets, loaded.snippets)
+        for squealy in (bundled, loaded):
+            data = squealy.get_resource("questions").process(squealy, {"params": {}})
+            self.assertEqual([q['id'] for q in data['data']], [1, 2])
+
+    def test_bundle_loads_without_compiling_templates(self):
+        build_bundle([self.tests_dir], self.bundle_file)
+        with patch('jinja2.Environment.compile', side_effect=AssertionError("template was compiled")):
+            squealy = self.load_bundle()
+            # questions includes a snippet, which is loaded from the bundled bytecode
+            data = squealy.get_resource("questions").process(squealy, {"params": {}})
+        self.assertEqual(len(data['data']), 2)
+
+    def test_bundle_built_by_other_python_compiles_templates(self):
+        build_bundle([self.tests_dir], self.bundle_file)
+        with open(self.bundle_file, 'rb') as f:
+            bundle = pickle.load(f)
+        bundle['runtime'] = ('cpython-00', '0.0')
+        with open(self.bundle_file, 'wb') as f:
+            pickle.dump(bundle, f)
+
+        squealy = self.load_bundle()
+        data = squealy.get_resource("questions").process(squealy, {"params": {}})
+        self.assertEqual(len(data['data']), 2)
+
+    def test_same_file_name_in_different_directories(self):
+        for app in ('app1', 'app2'):
+            os.mkdir(os.path.join(self.tmpdir.name, app))
+            with open(os.path.join(self.tmpdir.name, app, "report.resource.yml"), 'w') as f:
+                f.write("id: " + app + "\nqueries:\n  - queryForObject: SELECT " + app[-1] + " as x\n")
+        build_bundle([os.path.join(self.tmpdir.name, app) for app in ('app1', 'app2')], self.bundle_file)
+        squealy = self.load_bundle()
+        for app in ('app1', 'app2'):
+            data = squealy.get_resource(app).process(squealy, {"params": {}})
+            self.assertEqual(data['data'], {'x': int(app[-1])})
+
+    def test_bundle_of_other_format_fails(self):
+        with open(self.bundle_file, 'wb') as f:
+            pickle.dump({"format": 0}, f)
+        with self.assertRaises(SquealyConfigException):
+            self.load_bundle()
+
+    def test_invalid_resource_fails_build(self):
+        with open(os.path.join(self.tmpdir.name, "broken.resource.yml"), 'w') as f:
+            f.write("queries:\n  - queryForList: SELECT {% if %}\n")
+        with self.assertRaises(SquealyConfigException):
+            build_bundle([self.tmpdir.name], self.bundle_file)
+        self.assertFalse(os.path.exists(self.bundle_file))
+
+class ReloadTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.write("users.resource.yml", "queries:\n  - queryForList: SELECT {% include 'user' %}\n")
+        self.write("snippets.yml", "user: 1 as id\n")
+        self.squealy = Squealy()
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+        self.squealy.load_objects(self.tmpdir.name)
+
+    def tearDown(self):
+        self.squealy.stop_watching()
+        self.tmpdir.cleanup()
+
+    def write(self, name, text):
+        path = os.path.join(self.tmpdir.name, name)
+        mtime = os.stat(path).st_mtime if os.path.exists(path) else time.time()
+        with open(path, 'w') as f:
+            f.write(text)
+        # File systems with coarse timestamps would not see a change made in the same second
+        os.utime(path, (mtime + 1, mtime + 1))
+
+    def process(self, resource_id):
+        return self.squealy.get_resource(resource_id).process(self.squealy, {"params": {}})
+
+    def test_reload_without_changes(self):
+        self.assertFalse(self.squealy.reload())
+
+    def test_reload_parses_only_changed_files(self):
+        self.write("users.resource.yml", "queries:\n  - queryForList: SELECT 2 as id\n")
+        with patch('squealy.core._parse_yaml', wraps=_parse_yaml) as parse:
+            self.assertTrue(self.squealy.reload())
+        self.assertEqual(parse.call_count, 1)
+        self.assertEqual(self.process("users.resource.yml"), {'data': [{'id': 2}]})
+
+    def test_reload_added_and_deleted_files(self):
+        resources = self.squealy.resources
+        self.write("groups.resource.yml", "id: groups\nqueries:\n  - queryForList: SELECT 3 as id\n")
+        os.remove(os.path.join(self.tmpdir.name, "users.resource.yml"))
+        self.assertTrue(self.squealy.reload())
+
+        self.assertEqual(self.process("groups"), {'data': [{'id': 3}]})
+        self.assertNotIn("users.resource.yml", self.squealy.get_resources())
+        # The resources are replaced as a whole, so requests holding the old dict are not affected
+        self.assertIn("users.resource.yml", resources)
+
+    def test_snippet_change_does_not_compile_queries(self):
+        self.write("snippets.yml", "user: 5 as id\n")
+        with patch.object(self.squealy.jinja, 'compile', side_effect=AssertionError("query was compiled")):
+            self.assertTrue(self.squealy.reload())
+            self.assertEqual(self.process("users.resource.yml"), {'data': [{'id': 5}]})
+
+    def test_invalid_file_keeps_loaded_resources(self):
+        self.write("users.resource.yml", "queries:\n  - queryForList: SELECT {% if %}\n")
+        self.write("groups.resource.yml", "id: groups\nqueries:\n  - queryForList: SELECT 3 as id\n")
+        with self.assertRaises(SquealyConfigException):
+            self.squealy.reload()
+        self.assertEqual(self.process("users.resource.yml"), {'data': [{'id': 1}]})
+        self.assertNotIn("groups", self.squealy.get_resources())
+        # Not retried until a file changes again
+        self.assertFalse(self.squealy.reload())
+
+        self.write("users.resource.yml", "queries:\n  - queryForList: SELECT 2 as id\n")
+        self.assertTrue(self.squealy.reload())
+        self.assertEqual(self.process("groups"), {'data': [{'id': 3}]})
+
+    def test_watch(self):
+        reloaded = threading.Event()
+        self.squealy.watch(interval=0.01, on_reload=reloaded.set)
+        self.write("users.resource.yml", "queries:\n  - queryForList: SELECT 2 as id\n")
+        self.assertTrue(reloaded.wait(5))
+        self.assertEqual(self.process("users.resource.yml"), {'data': [{'id': 2}]})
+
+class LazyTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.write("users.resource.yml", "id: users\npath: /users\nqueries:\n  - queryForList: SELECT 1 as id\n")
+        self.write("groups.resource.yml", "id: groups\npath: /groups\nqueries:\n  - queryForList: SELECT 2 as id\n")
+        self.squealy = Squealy(lazy=True)
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def write(self, name, text):
+        with open(os.path.join(self.tmpdir.name, name), 'w') as f:
+            f.write(text)
+
+    def test_resources_are_built_on_first_use(self):
+        self.squealy.load_objects(self.tmpdir.name)
+        resources = self.squealy.get_resources()
+        self.assertEqual({r.path for r in resources.values()}, {"/users", "/groups"})
+        self.assertTrue(all(r.built is None for r in resources.values()))
+        self.assertEqual(len(self.squealy.templates), 0)
+
+        users = self.squealy.get_resource("users")
+        self.assertIsInstance(users, Resource)
+        self.assertIs(self.squealy.get_resource("users.resource.yml"), users)
+        self.assertEqual(users.process(self.squealy, {"params": {}}), {'data': [{'id': 1}]})
+        self.assertIsNone(resources["groups"].built)
+
+    def test_invalid_resource_fails_when_it_is_used(self):
+        self.write("broken.resource.yml", "id: broken\nqueries:\n  - queryForList: SELECT {% if %}\n")
+        self.squealy.load_objects(self.tmpdir.name)
+        with self.assertRaises(SquealyConfigException):
+            self.squealy.get_resource("broken")
+        self.assertEqual(self.squealy.get_resource("users").process(self.squealy, {"params": {}}), {'data': [{'id': 1}]})
+
+    def test_warm_up_builds_all_resources(self):
+        self.write("broken.resource.yml", "id: broken\nqueries:\n  - queryForList: SELECT {% if %}\n")
+        self.squealy.load_objects(self.tmpdir.name)
+        with self.assertLogs('squealy.core', level='ERROR'):
+            self.squealy.warm_up(background=False)
+        built = {r.id for r in self.squealy.get_resources().values() if r.built is not None}
+        self.assertEqual(built, {"users", "groups"})
+
+@unittest.skipUnless(hasattr(os, 'fork'), "os.fork is not available")
+class ForkTests(unittest.TestCase):
+    'Servers like gunicorn --preload load resources in the master process, and fork workers that serve requests'
+    def setUp(self):
+        self.squealy = Squealy(lazy=True)
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+        self.squealy.load_objects(os.path.dirname(__file__))
+
+    def tearDown(self):
+        self.squealy.stop_watching()
+
+    def in_child(self, fn):
+        'Runs fn in a forked process, and returns its exit code - 0 if fn returned True'
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = 0 if fn() else 1
+            finally:
+                os._exit(code)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            finished, status = os.waitpid(pid, os.WNOHANG)
+            if finished:
+                return os.WEXITSTATUS(status)
+            time.sleep(0.01)
+        # The child is stuck, for example waiting on a thread that does not exist after the fork
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+        return -1
+
+    def test_loading_does_not_start_the_thread_pool(self):
+        self.assertIsNone(self.squealy._executor)
+
+    def test_thread_pool_works_after_fork(self):
+        calls = [(lambda: 1, True), (lambda: 2, True)]
+        # The thread pool of the parent is started, but its threads do not exist in the child
+        self.assertEqual(self.squealy.run_concurrently(calls), [1, 2])
+        self.assertEqual(self.in_child(lambda: self.squealy.run_concurrently(calls) == [1, 2]), 0)
+
+    def test_locks_held_by_other_threads_are_replaced(self):
+        resource = self.squealy.resources["questions"]
+        locked = threading.Event()
+        release = threading.Event()
+        def hold_lock():
+            with resource._lock:
+                locked.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            locked.wait(5)
+            self.assertEqual(self.in_child(lambda: self.squealy.get_resource("questions").id == "questions"), 0)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_template_cache_lock_held_by_other_threads_is_replaced(self):
+        # Like the warm up thread, while it compiles a template
+        locked = threading.Event()
+        release = threading.Event()
+        def hold_lock():
+            with self.squealy.templates._lock:
+                locked.set()
+                release.wait(5)
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        try:
+            locked.wait(5)
+            def process():
+                resource = self.squealy.get_resource("questions")
+                return len(resource.process(self.squealy, {"params": {}})['data']) == 2
+            self.assertEqual(self.in_child(process), 0)
+        finally:
+            release.set()
+            thread.join()
+
+    def test_watcher_restarts_after_fork(self):
+        self.squealy.watch(interval=60)
+        self.assertEqual(self.in_child(lambda: self.squealy._watcher[0].is_alive()), 0)
+
+class TemplateCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.squealy = Squealy(snippets={'one': 'SELECT 1 as id'})
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+
+    def test_templates_compiled_when_resource_is_added(self):
+        resource = Resource("cached", queries=[{"queryForList": "{% include 'one' %}"}])
+        self.squealy.add_resource(resource)
+
+        stats = RequestStats()
+        data = resource.process(self.squealy, {"params": {}}, stats)
+        self.assertEqual(data, {'data': [{'id': 1}]})
+        self.assertEqual(stats.templates_reused, 1)
+        self.assertEqual(stats.templates_compiled, 0)
+
+    def test_template_compiled_once_on_first_request(self):
+        resource = Resource("not-added", queries=[{"queryForList": "SELECT {{params.id}} as id"}])
+        first, second = RequestStats(), RequestStats()
+        resource.process(self.squealy, {"params": {"id": 1}}, first)
+        data = resource.process(self.squealy, {"params": {"id": 2}}, second)
+        self.assertEqual(data, {'data': [{'id': 2}]})
+        self.assertEqual((first.templates_compiled, first.templates_reused), (1, 0))
+        self.assertEqual((second.templates_compiled, second.templates_reused), (0, 1))
+
+    def test_snippet_changes_invalidate_templates(self):
+        resource = Resource("cached", queries=[{"queryForList": "{% include 'one' %}"}])
+        self.squealy.add_resource(resource)
+        self.squealy.snippets['one'] = 'SELECT 2 as id'
+        self.squealy._reload_jinja()
+
+        data = resource.process(self.squealy, {"params": {}})
+        self.assertEqual(data, {'data': [{'id': 2}]})
+
+    def test_invalid_template_fails_at_load_time(self):
+        with self.assertRaises(SquealyConfigException):
+            Resource("broken", queries=[{"queryForList": "SELECT {% if %}"}])
+
+class ResultCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = CountingEngine(InMemorySqliteEngine())
+        self.squealy = Squealy()
+        self.squealy.add_engine('default', self.engine)
+
+    def test_results_are_cached(self):
+        resource = Resource("cached", queries=[{"queryForList": "SELECT {{params.id}} as id"}], cache={"ttl": 60})
+        first, second = RequestStats(), RequestStats()
+        resource.process(self.squealy, {"params": {"id": 1}}, first)
+        data = resource.process(self.squealy, {"params": {"id": 1}}, second)
+
+        self.assertEqual(data, {'data': [{'id': 1}]})
+        self.assertEqual(self.engine.count, 1)
+        self.assertEqual((first.cache_hits, first.cache_misses), (0, 1))
+        self.assertEqual((second.cache_hits, second.cache_misses), (1, 0))
+
+    def test_bind_params_are_part_of_the_key(self):
+        resource = Resource("cached", queries=[{"queryForList": "SELECT {{params.id}} as id"}], cache={"ttl": 60})
+        resource.process(self.squealy, {"params": {"id": 1}})
+        data = resource.process(self.squealy, {"params": {"id": 2}})
+        self.assertEqual(data, {'data': [{'id': 2}]})
+        self.assertEqual(self.engine.count, 2)
+
+    def test_no_caching_by_default(self):
+        resource = Resource("not-cached", queries=[{"queryForList": "SELECT 1 as id"}])
+        resource.process(self.squealy, {"params": {}})
+        resource.process(self.squealy, {"params": {}})
+        self.assertEqual(self.engine.count, 2)
+
+    def test_cached_tables_do_not_grow(self):
+        # The size of a table is counted when it is cached, so encoding must not keep column vectors in the table
+        queries = [
+            {"contextKey": "items", "queryForList": "SELECT 1 as id, 'a' as name UNION ALL SELECT 2 as id, 'b' as name"},
+            {"key": "tags", "merge": {"parent": "id", "child": "item_id"},
+                "queryForList": "SELECT 1 as item_id, 'x' as tag WHERE item_id in {{ items.id | inclause }}"},
+        ]
+        resources = [Resource("cached", queries=queries, cache={"ttl": 60})]
+        for formatter in (JsonFormatter(), SimpleFormatter(), SeriesFormatter(), GoogleChartsFormatter()):
+            resources.append(Resource(str(uuid4()), queries=queries[:1], formatter=formatter, cache={"ttl": 60}))
+        with patch.object(Table, 'column_at', side_effect=AssertionError("column vector was cached in the table")):
+            for resource in resources:
+                resource.process_json(self.squealy, {"params": {}})
+                resource.process(self.squealy, {"params": {}})
+
+    def test_ttl_is_mandatory(self):
+        with self.assertRaises(SquealyConfigException):
+            Resource("bad-cache", queries=[{"queryForList": "SELECT 1 as id"}], cache={"max_entries": 10})
+
+    def test_invalid_cache_settings(self):
+        for cache in ({"ttl": "5m"}, {"ttl": -1}, {"ttl": 0}, {"ttl": True}, {"ttl": 60, "max_entries": 0},
+                {"ttl": 60, "max_entries": "10"}, {"ttl": 60, "max_bytes": 1.5}):
+            with self.assertRaisesRegex(SquealyConfigException, "must be a positive integer, in resource bad-cache"):
+                Resource("bad-cache", queries=[{"queryForList": "SELECT 1 as id"}], cache=cache)
+
+class LRUCacheTests(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = LRUCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (3, 1, 1))
+
+    def test_evicts_to_stay_within_max_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=10, sizeof=len)
+        cache.put('a', 'xxxxxx')
+        cache.put('b', 'yyyyyy')
+        self.assertNotIn('a', cache)
+        self.assertEqual(cache.size, 6)
+        cache.put('c', 'z' * 11)
+        self.assertNotIn('c', cache)
+
+    def test_entries_expire(self):
+        cache = LRUCache(ttl=0.01)
+        cache.put('a', 1)
+        time.sleep(0.02)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+class BlockingEngine(Engine):
+    'Blocks every query until released, so that tests can issue concurrent queries'
+    def __init__(self, error=None):
+        self.param_style = 'qmark'
+        self.entered = threading.Event()
+        self.release = threading.Event()
+        self.error = error
+        self.count = 0
+
+    def execute(self, query, bind_params):
+        self.count += 1
+        self.entered.set()
+        self.release.wait(5)
+        if self.error:
+            raise self.error
+        return Table(['id'], [(1,)])
+
+class SingleFlightTests(unittest.TestCase):
+    def _run_concurrently(self, squealy, engine, num_threads=5):
+        results, errors = [], []
+        def target():
+            try:
+                results.append(squealy.execute(engine, "SELECT ?", [1]))
+            except Exception as e:
+                errors.append(e)
+        leader = threading.Thread(target=target)
+        leader.start()
+        engine.entered.wait(5)
+        followers = [threading.Thread(target=target) for i in range(num_threads - 1)]
+        for t in followers:
+            t.start()
+        # Give followers enough time to start waiting on the leader
+        time.sleep(0.1)
+        engine.release.set()
+        for t in [leader] + followers:
+            t.join(5)
+        return results, errors
+
+    def test_identical_queries_are_coalesced(self):
+        engine = BlockingEngine()
+        results, errors = self._run_concurrently(Squealy(), engine)
+        self.assertEqual(engine.count, 1)
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 5)
+        self.assertTrue(all(r is results[0] for r in results))
+
+    def test_errors_are_raised_in_every_waiter(self):
+        engine = BlockingEngine(error=ValueError("database is down"))
+        results, errors = self._run_concurrently(Squealy(), engine)
+        self.assertEqual(engine.count, 1)
+        self.assertEqual(results, [])
+        self.assertEqual(len(errors), 5)
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+
+    def test_coalescing_can_be_disabled(self):
+        engine = BlockingEngine()
+        engine.release.set()
+        squealy = Squealy(coalesce_queries=False)
+        squealy.execute(engine, "SELECT ?", [1])
+        squealy.execute(engine, "SELECT ?", [1])
+        self.assertEqual(engine.count, 2)
+
+    def test_nothing_is_remembered_after_completion(self):
+        flight = SingleFlight()
+        self.assertEqual(flight.do('key', lambda: 1), (1, False))
+        self.assertEqual(flight.do('key', lambda: 2), (2, False))
+        self.assertEqual(len(flight), 0)
+
+class ThreadSafeSqliteEngine(Engine):
+    '''Waits until the expected number of queries are running concurrently, then runs them one by one
+
+    If queries run sequentially, the barrier is never reached and every query fails
+    '''
+    thread_safe = True
+
+    def __init__(self, concurrent_queries):
+        import sqlite3
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.param_style = 'qmark'
+        self.barrier = threading.Barrier(concurrent_queries, timeout=5)
+        self.lock = threading.Lock()
+
+    def execute(self, query, bind_params):
+        self.barrier.wait()
+        with self.lock:
+            cursor = self.conn.cursor()
+            cursor.execute(query, bind_params)
+            cols = [col[0] for col in cursor.description]
+            return Table(cols, cursor.fetchall())
+
+class ParallelQueryTests(unittest.TestCase):
+    def test_stages(self):
+        resource = Resource("dashboard", queries=[
+            {"key": "a", "contextKey": "a", "queryForObject": "SELECT 1 as id"},
+            {"key": "b", "contextKey": "b", "queryForObject": "SELECT 2 as id"},
+            {"key": "c", "queryForObject": "SELECT {{ a.id }} as id"},
+            {"key": "d", "queryForObject": "SELECT {{ c.id }} as id"},
+            {"key": "e", "queryForObject": "{% include 'anything' %}"},
+            {"key": "f", "queryForObject": "SELECT {{ b.id }} + {{ params.x }} as id"},
+        ])
+        stages = [[q.key for q in stage] for stage in resource.queries.stages]
+        self.assertEqual(stages, [['a', 'b', 'd'], ['c', 'e', 'f']])
+
+    def test_independent_queries_run_concurrently(self):
+        squealy = Squealy()
+        squealy.add_engine('default', ThreadSafeSqliteEngine(concurrent_queries=3))
+        resource = Resource("dashboard", queries=[
+            {"key": "sales", "queryForObject": "SELECT 10 as total"},
+            {"key": "visits", "queryForObject": "SELECT 20 as total"},
+            {"key": "months", "queryForList": "SELECT 'jan' as month UNION ALL SELECT 'feb' as month"},
+        ])
+        data = resource.process(squealy, {"params": {}})
+        self.assertEqual(list(data['data'].keys()), ['sales', 'visits', 'months'])
+        self.assertEqual(data['data'], {
+            'sales': {'total': 10},
+            'visits': {'total': 20},
+            'months': [{'month': 'jan'}, {'month': 'feb'}]
+        })
+
+    def test_dependent_queries_see_results_of_earlier_stages(self):
+        squealy = Squealy()
+        squealy.add_engine('default', ThreadSafeSqliteEngine(concurrent_queries=1))
+        resource = Resource("dashboard", queries=[
+            {"key": "first", "contextKey": "first", "queryForObject": "SELECT 1 as id"},
+            {"key": "second", "queryForObject": "SELECT 2 as id"},
+            {"key": "third", "queryForObject": "SELECT {{ first.id }} + 2 as id"},
+        ])
+        data = resource.process(squealy, {"params": {}})
+        self.assertEqual(data['data'], {'first': {'id': 1}, 'second': {'id': 2}, 'third': {'id': 3}})
+
+    def test_errors_are_propagated(self):
+        squealy = Squealy()
+        squealy.add_engine('default', ThreadSafeSqliteEngine(concurrent_queries=2))
+        resource = Resource("dashboard", queries=[
+            {"key": "ok", "queryForObject": "SELECT 1 as id"},
+            {"key": "broken", "queryForObject": "SELECT * FROM missing_table"},
+        ])
+        with self.assertRaises(Exception):
+            resource.process(squealy, {"params": {}})
+
+class ChunkedQueryTests(unittest.TestCase):
+    def _resource(self, chunk_size=None, datasource=None):
+        child = {
+            "key": "answers",
+            "merge": {"parent": "id", "child": "qid"},
+            "datasource": datasource,
+            "queryForList": """
+                WITH RECURSIVE answers(qid) AS (SELECT 1 UNION ALL SELECT qid + 1 FROM answers WHERE qid < 10)
+                SELECT qid, qid * 10 as score FROM answers WHERE qid in {{ questions.id | inclause }}
+            """
+        }
+        if chunk_size is not None:
+            child["chunkSize"] = chunk_size
+        return Resource("questions", queries=[{
+            "contextKey": "questions",
+            "queryForList": """
+                WITH RECURSIVE questions(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM questions WHERE id < 5)
+                SELECT id FROM questions
+            """
+        }, child])
+
+    def _expected(self):
+        return [{'id': i, 'answers': [{'qid': i, 'score': i * 10}]} for i in range(1, 6)]
+
+    def test_large_in_clauses_are_split_into_chunks(self):
+        engine = CountingEngine(InMemorySqliteEngine())
+        squealy = Squealy()
+        squealy.add_engine('default', engine)
+        data = self._resource(chunk_size=2).process(squealy, {"params": {}})
+        self.assertEqual(data['data'], self._expected())
+        # 1 parent query, and 3 chunks of 2, 2 and 1 ids
+        self.assertEqual(engine.count, 4)
+
+    def test_chunk_size_can_be_set_for_all_queries(self):
+        engine = CountingEngine(InMemorySqliteEngine())
+        squealy = Squealy(inclause_chunk_size=4)
+        squealy.add_engine('default', engine)
+        data = self._resource().process(squealy, {"params": {}})
+        self.assertEqual(data['data'], self._expected())
+        self.assertEqual(engine.count, 3)
+
+        engine.count = 0
+        data = self._resource(chunk_size=0).process(squealy, {"params": {}})
+        self.assertEqual(data['data'], self._expected())
+        self.assertEqual(engine.count, 2)
+
+    def test_chunks_run_concurrently(self):
+        squealy = Squealy()
+        squealy.add_engine('default', InMemorySqliteEngine())
+        squealy.add_engine('parallel', ThreadSafeSqliteEngine(concurrent_queries=3))
+        data = self._resource(chunk_size=2, datasource='parallel').process(squealy, {"params": {}})
+        self.assertEqual(data['data'], self._expected())
+
+    def test_async_chunks(self):
+        engine = CountingEngine(InMemorySqliteEngine())
+        squealy = Squealy()
+        squealy.add_engine('default', engine)
+        data = run_async(self._resource(chunk_size=3).process_async(squealy, {"params": {}}))
+        self.assertEqual(data['data'], self._expected())
+        self.assertEqual(engine.count, 3)
+
+    def test_invalid_chunk_size(self):
+        with self.assertRaises(SquealyConfigException):
+            self._resource(chunk_size=-1)
+
+class PaginationTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = CountingEngine(InMemorySqliteEngine())
+        self.squealy = Squealy()
+        self.squealy.add_engine('default', self.engine)
+
+    def _resource(self, **pagination):
+        return Resource("paged", pagination=pagination, queries=[{
+            "contextKey": "items",
+            "queryForList": """
+                WITH RECURSIVE items(id, grp) AS (SELECT 1, 1 UNION ALL SELECT id + 1, (id + 1) % 3 FROM items WHERE id < 7)
+                SELECT id, grp FROM items {% if params.grp %} WHERE grp = {{ params.grp }} {% endif %}
+            """
+        }, {
+            "key": "tags",
+            "merge": {"parent": "id", "child": "item_id"},
+            "queryForList": """
+                WITH RECURSIVE tags(item_id) AS (SELECT 1 UNION ALL SELECT item_id + 1 FROM tags WHERE item_id < 7)
+                SELECT item_id, 'tag' || item_id as tag FROM tags WHERE item_id in {{ items.id | inclause }}
+            """
+        }])
+
+    def _pages(self, resource, params=None):
+        pages = []
+        cursor = None
+        while True:
+            page_params = dict(params or {})
+            if cursor:
+                page_params['cursor'] = cursor
+            data = resource.process(self.squealy, {"params": page_params})
+            self.assertEqual(json.loads(resource.process_json(self.squealy, {"params": page_params})), data)
+            pages.append(data['data'])
+            cursor = data['cursor']
+            if cursor is None:
+                return pages
+
+    def test_pages_follow_the_keys(self):
+        pages = self._pages(self._resource(page_size=3, keys=['id']))
+        self.assertEqual([[row['id'] for row in page] for page in pages], [[1, 2, 3], [4, 5, 6], [7]])
+        self.assertEqual(pages[0][0], {'id': 1, 'grp': 1, 'tags': [{'item_id': 1, 'tag': 'tag1'}]})
+
+    def test_composite_keys_in_descending_order(self):
+        pages = self._pages(self._resource(page_size=2, keys=['grp', 'id'], descending=True))
+        rows = [(row['grp'], row['id']) for page in pages for row in page]
+        self.assertEqual([len(page) for page in pages], [2, 2, 2, 1])
+        self.assertEqual(rows, sorted(rows, reverse=True))
+
+    def test_pagination_applies_after_the_filters_of_the_query(self):
+        pages = self._pages(self._resource(page_size=1, keys='id'), {'grp': 1})
+        self.assertEqual(pages, [[{'id': 1, 'grp': 1, 'tags': [{'item_id': 1, 'tag': 'tag1'}]}],
+                                 [{'id': 4, 'grp': 1, 'tags': [{'item_id': 4, 'tag': 'tag4'}]}],
+                                 [{'id': 7, 'grp': 1, 'tags': [{'item_id': 7, 'tag': 'tag7'}]}]])
+
+    def test_invalid_cursor(self):
+        resource = self._resource(page_size=3, keys=['id'])
+        with self.assertRaises(SquealyBadRequestException):
+            resource.process(self.squealy, {"params": {"cursor": "not a cursor"}})
+        # Valid json, but a value that cannot be bound as a parameter
+        nested = base64.urlsafe_b64encode(b'[[1]]').decode('ascii')
+        with self.assertRaises(SquealyBadRequestException):
+            resource.process(self.squealy, {"params": {"cursor": nested}})
+
+    def test_cursor_from_a_list_of_values(self):
+        # Django's request.GET has a list of values for each parameter
+        resource = self._resource(page_size=3, keys=['id'])
+        cursor = resource.process(self.squealy, {"params": {}})['cursor']
+        data = resource.process(self.squealy, {"params": {"cursor": [cursor]}})
+        self.assertEqual([row['id'] for row in data['data']], [4, 5, 6])
+
+    def test_limit_depends_on_the_dialect(self):
+        class RecordingEngine(Engine):
+            param_style = 'format'
+            dialect = 'mssql'
+            def execute(self, query, bind_params):
+                self.query = query
+                return Table(['id'], [])
+        engine = RecordingEngine()
+        squealy = Squealy()
+        squealy.add_engine('default', engine)
+        resource = Resource("paged", pagination={"page_size": 10, "keys": ["id"]},
+                            queries=[{"queryForList": "SELECT id FROM items"}])
+        self.assertEqual(resource.process(squealy, {"params": {}}), {"data": [], "cursor": None})
+        self.assertIn("ORDER BY squealy_keyset.id\nOFFSET 0 ROWS FETCH NEXT 11 ROWS ONLY", engine.query)
+
+    def test_invalid_configuration(self):
+        with self.assertRaises(SquealyConfigException):
+            self._resource(page_size=0, keys=['id'])
+        with self.assertRaises(SquealyConfigException):
+            self._resource(page_size=10, keys=['id; drop table items'])
+        with self.assertRaises(SquealyConfigException):
+            self._resource(page_size=10)
+        with self.assertRaises(SquealyConfigException):
+            Resource("paged", pagination={"page_size": 10, "keys": ["id"]}, queries=[{"queryForObject": "SELECT 1 as id"}])
+
+class AsyncSqliteEngine(AsyncEngine):
+    'Sleeps before running the query, so that concurrent queries overlap'
+    def __init__(self, delay=0.05):
+        self.engine = InMemorySqliteEngine()
+        self.param_style = 'qmark'
+        self.delay = delay
+        self.count = 0
+
+    async def execute(self, query, bind_params):
+        self.count += 1
+        await asyncio.sleep(self.delay)
+        return self.engine.execute(query, bind_params)
+
+def run_async(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+class AsyncProcessTests(unittest.TestCase):
+    def setUp(self):
+        self.squealy = Squealy()
+        self.engine = AsyncSqliteEngine()
+        self.squealy.add_engine('default', self.engine)
+        self.squealy.add_engine('sync', InMemorySqliteEngine())
+
+    def test_process_async(self):
+        resource = Resource("questions", queries=[
+            {"contextKey": "questions", "queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id"},
+            {"key": "comments", "merge": {"parent": "id", "child": "qid"}, "queryForList": 
+                "SELECT 1 as qid, 'First!' as comment WHERE 1 in {{ questions.id | inclause }}"}
+        ])
+        data = run_async(resource.process_async(self.squealy, {"params": {}}))
+        self.assertEqual(data['data'], [
+            {'id': 1, 'comments': [{'qid': 1, 'comment': 'First!'}]},
+            {'id': 2, 'comments': []}
+        ])
+
+    def test_independent_queries_are_awaited_concurrently(self):
+        resource = Resource("dashboard", queries=[
+            {"key": "q%d" % i, "queryForObject": "SELECT %d as id" % i} for i in range(10)
+        ])
+        start = time.monotonic()
+        data = run_async(resource.process_async(self.squealy, {"params": {}}))
+        elapsed = time.monotonic() - start
+        self.assertEqual(data['data']['q9'], {'id': 9})
+        self.assertLess(elapsed, 10 * self.engine.delay)
+
+    def test_sync_engines_are_adapted(self):
+        resource = Resource("sync", datasource='sync', queries=[{"queryForObject": "SELECT 1 as id"}])
+        data = run_async(resource.process_async(self.squealy, {"params": {}}))
+        self.assertEqual(data, {'data': {'id': 1}})
+        self.assertIsInstance(self.squealy.get_async_engine('sync'), SyncEngineAdapter)
+
+    def test_identical_queries_are_coalesced(self):
+        resource = Resource("one", queries=[{"queryForObject": "SELECT {{ params.id }} as id"}])
+        async def concurrent_requests():
+            return await asyncio.gather(*[resource.process_async(self.squealy, {"params": {"id": 1}}) for i in range(5)])
+        results = run_async(concurrent_requests())
+        self.assertEqual(results, [{'data': {'id': 1}}] * 5)
+        self.assertEqual(self.engine.count, 1)
+
+    def test_errors_are_raised_in_every_waiter(self):
+        flight = AsyncSingleFlight()
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("database is down")
+        async def concurrent_calls():
+            return await asyncio.gather(*[flight.do('key', fail) for i in range(3)], return_exceptions=True)
+        errors = run_async(concurrent_calls())
+        self.assertTrue(all(isinstance(e, ValueError) for e in errors))
+        self.assertEqual(len(flight), 0)
+
+class StreamingTests(unittest.TestCase):
+    def setUp(self):
+        self.squealy = Squealy()
+        engine = InMemorySqliteEngine()
+        engine.batch_size = 2
+        self.squealy.add_engine('default', engine)
+
+    def test_stream_in_batches(self):
+        resource = Resource("numbers", stream=True, queries=[{"queryForList": """
+            WITH RECURSIVE n(id) as (SELECT 1 UNION ALL SELECT id + 1 FROM n WHERE id < {{ params.max }})
+            SELECT id, 'row ' || id as 'label.text' FROM n
+            """}])
+        chunks = list(resource.process_stream(self.squealy, {"params": {"max": 5}}, TableEncoder()))
+        # envelope start, 3 batches, envelope end
+        self.assertEqual(len(chunks), 5)
+        data = json.loads("".join(chunks))
+        self.assertEqual(data['data'][0], {'id': 1, 'label': {'text': 'row 1'}})
+        self.assertEqual([r['id'] for r in data['data']], [1, 2, 3, 4, 5])
+
+    def test_stream_empty_results(self):
+        resource = Resource("empty", stream=True, queries=[{"queryForList": "SELECT 1 as id WHERE 1 = 0"}])
+        chunks = resource.process_stream(self.squealy, {"params": {}}, TableEncoder())
+        self.assertEqual(json.loads("".join(chunks)), {'data': []})
+
+    def test_errors_are_raised_before_streaming(self):
+        resource = Resource("broken", stream=True, queries=[{"queryForList": "SELECT * FROM missing_table"}])
+        with self.assertRaises(Exception):
+            resource.process_stream(self.squealy, {"params": {}}, TableEncoder())
+
+    def test_stream_requires_sync_engine(self):
+        resource = Resource("numbers", stream=True, datasource="async", queries=[{"queryForList": "SELECT 1 as id"}])
+        self.squealy.add_engine('async', AsyncSqliteEngine())
+        with self.assertRaisesRegex(SquealyConfigException, "requires a synchronous Engine"):
+            resource.process_stream(self.squealy, {"params": {}}, TableEncoder())
+        # Adapted engines are streamed with the synchronous engine they wrap
+        self.squealy.add_engine('async', SyncEngineAdapter(InMemorySqliteEngine()))
+        chunks = resource.process_stream(self.squealy, {"params": {}}, TableEncoder())
+        self.assertEqual(json.loads("".join(chunks)), {'data': [{'id': 1}]})
+
+    def test_stream_requires_single_list_query(self):
+        with self.assertRaises(SquealyConfigException):
+            Resource("object", stream=True, queries=[{"queryForObject": "SELECT 1 as id"}])
+        with self.assertRaises(SquealyConfigException):
+            Resource("many", stream=True, queries=[
+                {"contextKey": "q", "queryForList": "SELECT 1 as id"},
+                {"key": "c", "merge": {"parent": "id", "child": "id"}, "queryForList": "SELECT 1 as id"}
+            ])
+        with self.assertRaises(SquealyConfigException):
+            Resource("series", stream=True, formatter=SeriesFormatter(), queries=[{"queryForList": "SELECT 1 as id"}])
+
+class BatchCountingEngine(InMemorySqliteEngine):
+    'Fetches rows with fetchmany, and counts the batches that were fetched'
+    thread_safe = True
+    batch_size = 2
+
+    def __init__(self):
+        import sqlite3
+        self.conn = sqlite3.connect(":memory:", check_same_thread=False)
+        self.param_style = 'qmark'
+        self.batches = 0
+
+    def execute_stream(self, query, bind_params):
+        cursor = self.conn.cursor()
+        cursor.execute(query, bind_params)
+        cols = [col[0] for col in cursor.description]
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            self.batches += 1
+            yield Table(cols, rows)
+            if len(rows) < self.batch_size:
+                break
+
+class ResultLimitTests(unittest.TestCase):
+    QUERY = """
+        WITH RECURSIVE n(id) as (SELECT 1 UNION ALL SELECT id + 1 FROM n WHERE id < 10)
+        SELECT id FROM n
+    """
+    def setUp(self):
+        self.engine = BatchCountingEngine()
+        self.squealy = Squealy()
+        self.squealy.add_engine('default', self.engine)
+
+    def test_truncate_stops_fetching_at_the_limit(self):
+        resource = Resource("numbers", max_rows=3, on_limit='truncate', queries=[{"queryForList": self.QUERY}])
+        data = resource.process(self.squealy, {"params": {}})
+        self.assertEqual(data, {'data': [{'id': 1}, {'id': 2}, {'id': 3}], 'truncated': True})
+        self.assertEqual(self.engine.batches, 2)
+        self.assertEqual(json.loads(resource.process_json(self.squealy, {"params": {}})), data)
+
+    def test_results_within_limits(self):
+        resource = Resource("numbers", max_rows=10, on_limit='truncate', queries=[{"queryForList": self.QUERY}])
+        data = resource.process(self.squealy, {"params": {}})
+        self.assertEqual(len(data['data']), 10)
+        self.assertEqual(data['truncated'], False)
+
+    def test_fail_fast(self):
+        resource = Resource("numbers", max_rows=3, queries=[{"queryForList": self.QUERY}])
+        with self.assertRaisesRegex(SquealyException, "max_rows = 3"):
+            resource.process(self.squealy, {"params": {}})
+        self.assertEqual(self.engine.batches, 2)
+
+    def test_max_bytes(self):
+        resource = Resource("numbers", max_bytes=200, on_limit='truncate', queries=[{"queryForList": self.QUERY}])
+        data = resource.process(self.squealy, {"params": {}})
+        self.assertTrue(data['truncated'])
+        self.assertTrue(0 < len(data['data']) < 10)
+        self.assertLess(self.engine.batches, 5)
+
+    def test_async_truncate(self):
+        resource = Resource("numbers", max_rows=3, on_limit='truncate', queries=[{"queryForList": self.QUERY}])
+        data = run_async(resource.process_async(self.squealy, {"params": {}}))
+        self.assertEqual(data, {'data': [{'id': 1}, {'id': 2}, {'id': 3}], 'truncated': True})
+        self.assertEqual(self.engine.batches, 2)
+
+    def test_streams_are_truncated(self):
+        resource = Resource("numbers", max_rows=3, stream=True, queries=[{"queryForList": self.QUERY}])
+        chunks = resource.process_stream(self.squealy, {"params": {}}, TableEncoder())
+        self.assertEqual(json.loads("".join(chunks)), {'data': [{'id': 1}, {'id': 2}, {'id': 3}]})
+        self.assertEqual(self.engine.batches, 2)
+
+    def test_invalid_limits(self):
+        with self.assertRaises(SquealyConfigException):
+            Resource("numbers", max_rows=-1, queries=[{"queryForList": self.QUERY}])
+        with self.assertRaises(SquealyConfigException):
+            Resource("numbers", max_rows=10, on_limit='ignore', queries=[{"queryForList": self.QUERY}])
+
+class HttpCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.engine = InMemorySqliteEngine()
+        self.engine.conn.execute("CREATE TABLE versions (version)")
+        self.engine.conn.execute("INSERT INTO versions VALUES (1)")
+        self.squealy = Squealy(resources=[])
+        self.squealy.add_engine('default', self.engine)
+
+    def test_cache_control(self):
+        resource = Resource("numbers", http_cache={"max_age": 300}, queries=[{"queryForList": "SELECT 1 as id"}])
+        self.assertEqual(resource.http_cache.cache_control, 'private, max-age=300')
+        resource = Resource("numbers", http_cache={"private": False}, queries=[{"queryForList": "SELECT 1 as id"}])
+        self.assertEqual(resource.http_cache.cache_control, 'public, no-cache')
+        self.assertIsNone(Resource("numbers", queries=[{"queryForList": "SELECT 1 as id"}]).http_cache)
+
+    def test_max_age_may_be_0(self):
+        resource = Resource("numbers", http_cache={"max_age": 0}, queries=[{"queryForList": "SELECT 1 as id"}])
+        self.assertEqual(resource.http_cache.cache_control, 'private, max-age=0')
+        with self.assertRaisesRegex(SquealyConfigException, "max_age must be 0 or a positive integer"):
+            Resource("numbers", http_cache={"max_age": -1}, queries=[{"queryForList": "SELECT 1 as id"}])
+
+    def test_invalid_http_cache(self):
+        for http_cache in ({"max_age": -1}, {"private": "yes"}, {"ttl": 60}, "60"):
+            with self.assertRaisesRegex(SquealyConfigException, "in resource numbers"):
+                Resource("numbers", http_cache=http_cache, queries=[{"queryForList": "SELECT 1 as id"}])
+
+    def test_etag_for_body(self):
+        resource = Resource("numbers", http_cache={"max_age": 60}, queries=[{"queryForList": "SELECT 1 as id"}])
+        body = resource.process_json(self.squealy, {"params": {}})
+        self.assertEqual(resource.http_cache.etag_for_body(body), resource.http_cache.etag_for_body(body.encode('utf-8')))
+        self.assertTrue(resource.http_cache.etag_for_body(body).startswith('W/"'))
+        self.assertNotEqual(resource.http_cache.etag_for_body(body), resource.http_cache.etag_for_body(body + " "))
+        self.assertIsNone(resource.etag(self.squealy, {"params": {}}))
+
+    def test_etag_from_version_query(self):
+        engine = CountingEngine(self.engine)
+        self.squealy.add_engine('default', engine)
+        resource = Resource("numbers", cache={"ttl": 300},
+            http_cache={"version_query": "SELECT version FROM versions WHERE version > {{ params.min | default(0) }}"},
+            queries=[{"queryForList": "SELECT 1 as id"}])
+        self.squealy.add_resource(resource)
+        etag = resource.etag(self.squealy, {"params": {}})
+        self.assertEqual(resource.etag(self.squealy, {"params": {}}), etag)
+        self.assertNotEqual(resource.etag(self.squealy, {"params": {"min": 0}}), etag)
+        # The version query is never served from the result cache of the resource
+        self.assertEqual(engine.count, 3)
+
+        self.engine.conn.execute("UPDATE versions SET version = 2")
+        self.assertNotEqual(resource.etag(self.squealy, {"params": {}}), etag)
+
+    def test_async_etag_and_body(self):
+        resource = Resource("numbers", http_cache={"version_query": "SELECT version FROM versions"},
+            queries=[{"queryForList": "SELECT 1 as id"}])
+        self.squealy.add_resource(resource)
+        self.assertEqual(run_async(resource.etag_async(self.squealy, {"params": {}})), resource.etag(self.squealy, {"params": {}}))
+        self.assertEqual(run_async(resource.process_json_async(self.squealy, {"params": {}})),
+            resource.process_json(self.squealy, {"params": {}}))
+
+class CompressionTests(unittest.TestCase):
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip("gzip, deflate, br"))
+        self.assertTrue(accepts_gzip("br;q=1.0, GZIP;q=0.5"))
+        self.assertTrue(accepts_gzip("*"))
+        self.assertFalse(accepts_gzip("gzip;q=0, *"))
+        self.assertFalse(accepts_gzip("deflate, br"))
+        self.assertFalse(accepts_gzip(None))
+
+    def test_compress_above_min_size(self):
+        compression = Compression(min_size=100)
+        self.assertIsNone(compression.compress('{"data": []}'))
+        body = json.dumps({"data": list(range(1000))})
+        self.assertEqual(gzip.decompress(compression.compress(body)).decode('utf-8'), body)
+
+    def test_compress_stream(self):
+        chunks = ['{"data": [', ', '.join(str(i) for i in range(1000)), ']}']
+        compressed = list(Compression(level=1).compress_stream(iter(chunks)))
+        self.assertEqual(gzip.decompress(b"".join(compressed)).decode('utf-8'), "".join(chunks))
+
+    def test_apply(self):
+        compression = Compression(min_size=10)
+        body, headers = compression.apply("gzip", "x" * 100)
+        self.assertEqual(headers, {'Vary': 'Accept-Encoding', 'Content-Encoding': 'gzip'})
+        self.assertEqual(gzip.decompress(body), b"x" * 100)
+        self.assertEqual(compression.apply("identity", "x" * 100), ("x" * 100, {'Vary': 'Accept-Encoding'}))
+        self.assertEqual(compression.apply("gzip", "x"), ("x", {'Vary': 'Accept-Encoding'}))
+
+    def test_invalid_settings(self):
+        with self.assertRaises(SquealyConfigException):
+            Compression(level=10)
+        with self.assertRaises(SquealyConfigException):
+            Compression(min_size=-1)
+        with self.assertRaisesRegex(SquealyConfigException, "min_size must be 0 or a positive integer"):
+            Compression(min_size=True)
+        Compression(min_size=0)
+
+try:
+    from prometheus_client import CollectorRegistry
+except ImportError:
+    CollectorRegistry = None
+
+@unittest.skipIf(CollectorRegistry is None, "prometheus_client is not installed")
+class MetricsTests(unittest.TestCase):
+    def setUp(self):
+        self.registry = CollectorRegistry()
+        self.squealy = Squealy(metrics=PrometheusMetrics(self.registry))
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+        self.resource = Resource("questions", queries=[
+            {"contextKey": "questions", "queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id"},
+            {"key": "answers", "merge": {"parent": "id", "child": "qid"},
+                "queryForList": "SELECT 1 as qid WHERE qid in {{ questions.id | inclause }}"}
+        ])
+
+    def _sample(self, name, **labels):
+        return self.registry.get_sample_value(name, labels)
+
+    def test_stages_are_timed(self):
+        body = self.resource.process_json(self.squealy, {"params": {}})
+        for query, rows in (('root', 2), ('answers', 1)):
+            labels = {'resource': 'questions', 'query': query, 'datasource': 'default'}
+            self.assertEqual(self._sample('squealy_template_render_seconds_count', **labels), 1)
+            self.assertEqual(self._sample('squealy_query_execute_seconds_count', **labels), 1)
+            self.assertEqual(self._sample('squealy_query_rows_sum', **labels), rows)
+        self.assertEqual(self._sample('squealy_format_seconds_count', resource='questions'), 1)
+        self.assertEqual(self._sample('squealy_serialize_seconds_count', resource='questions'), 1)
+        self.assertEqual(self._sample('squealy_response_bytes_sum', resource='questions'), len(body))
+
+    def test_errors_are_counted_by_stage(self):
+        resource = Resource("broken", queries=[{"queryForList": "SELECT * FROM missing_table"}])
+        with self.assertRaises(Exception):
+            resource.process(self.squealy, {"params": {}})
+        self.assertEqual(self._sample('squealy_errors_total', resource='broken', stage='execute'), 1)
+        self.assertIsNone(self._sample('squealy_query_execute_seconds_count', resource='broken', query='root', datasource='default'))
+
+    def test_errors_after_execute_are_counted(self):
+        resource = Resource("limited", max_rows=1, queries=[{"queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id"}])
+        with self.assertRaises(SquealyException):
+            resource.process(self.squealy, {"params": {}})
+        self.assertEqual(self._sample('squealy_errors_total', resource='limited', stage='execute'), 1)
+
+    def test_metrics_can_be_disabled(self):
+        squealy = Squealy(metrics=False)
+        self.assertIsNone(squealy.metrics)
+        squealy.add_engine('default', InMemorySqliteEngine())
+        self.assertEqual(len(self.resource.process(squealy, {"params": {}})['data']), 2)
+
+class HookTests(unittest.TestCase):
+    def setUp(self):
+        self.squealy = Squealy(metrics=False)
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+        self.resource = Resource("questions", queries=[
+            {"contextKey": "questions", "queryForList": "SELECT 1 as id UNION ALL SELECT 2 as id"},
+            {"key": "answers", "merge": {"parent": "id", "child": "qid"},
+                "queryForList": "SELECT 1 as qid WHERE qid in {{ questions.id | inclause }}"}
+        ])
+        self.events = []
+        for event in ('before_render', 'after_render', 'before_execute', 'after_execute', 'before_format', 'after_format', 'on_error'):
+            self.squealy.add_hook(event, self.events.append)
+
+    def test_hooks_are_called_for_each_stage(self):
+        self.resource.process(self.squealy, {"params": {}})
+        self.assertEqual([(e.name, e.query.key if e.query else None) for e in self.events], [
+            ('before_render', None), ('after_render', None), ('before_execute', None), ('after_execute', None),
+            ('before_render', 'answers'), ('after_render', 'answers'), ('before_execute', 'answers'), ('after_execute', 'answers'),
+            ('before_format', None), ('after_format', None),
+        ])
+        after_execute = self.events[7]
+        self.assertIs(after_execute.resource, self.resource)
+        self.assertEqual(after_execute.size, 1)
+        self.assertEqual(after_execute.bind_params, [1, 2])
+        self.assertIn("qid in (?,?)", after_execute.sql)
+        self.assertGreaterEqual(after_execute.seconds, 0)
+
+    def test_serialize_hooks_are_paired(self):
+        for event in ('before_serialize', 'after_serialize'):
+            self.squealy.add_hook(event, self.events.append)
+        # A keyed query is not encoded directly, so only the output of format() is serialized
+        resource = Resource("keyed", queries=[{"key": "user", "queryForObject": "SELECT 1 as id"}])
+        self.assertEqual(json.loads(resource.process_json(self.squealy, {"params": {}})), {'data': {'user': {'id': 1}}})
+        self.assertEqual([e.name for e in self.events if e.stage in ('format', 'serialize')],
+            ['before_format', 'after_format', 'before_serialize', 'after_serialize'])
+
+    def test_errors(self):
+        resource = Resource("broken", queries=[{"queryForList": "SELECT * FROM missing_table"}])
+        with self.assertRaises(Exception):
+            resource.process(self.squealy, {"params": {}})
+        self.assertEqual([e.name for e in self.events], ['before_render', 'after_render', 'before_execute', 'on_error'])
+        self.assertEqual(self.events[-1].stage, 'execute')
+        self.assertIsNotNone(self.events[-1].error)
+
+    def test_errors_checking_results(self):
+        resource = Resource("user", queries=[{"queryForObject": "SELECT 1 as id UNION ALL SELECT 2 as id"}])
+        with self.assertRaisesRegex(SquealyException, "found 2 rows"):
+            resource.process(self.squealy, {"params": {}})
+        self.assertEqual([e.name for e in self.events], ['before_render', 'after_render', 'before_execute', 'after_execute', 'on_error'])
+        self.assertEqual(self.events[-1].stage, 'execute')
+        self.assertEqual(self.events[-1].query.key, None)
+
+    def test_errors_in_pagination_cursor(self):
+        resource = Resource("paged", pagination={"page_size": 2, "keys": ["id"]}, queries=[{"queryForList": "SELECT 1 as id"}])
+        with self.assertRaises(SquealyBadRequestException):
+            resource.process(self.squealy, {"params": {"cursor": "not a cursor"}})
+        self.assertEqual([e.name for e in self.events], ['before_render', 'on_error'])
+        self.assertEqual(self.events[-1].stage, 'render')
+
+    def test_before_hooks_can_reject_a_request(self):
+        def reject(event):
+            raise SquealyException("Not allowed")
+        self.squealy.add_hook('before_execute', reject)
+        with self.assertRaisesRegex(SquealyException, "Not allowed"):
+            self.resource.process(self.squealy, {"params": {}})
+        self.squealy.remove_hook('before_execute', reject)
+        self.resource.process(self.squealy, {"params": {}})
+
+    def test_unknown_event(self):
+        with self.assertRaises(SquealyConfigException):
+            self.squealy.add_hook('before_everything', print)
+
+class TableTests(unittest.TestCase):
+    def test_columns_are_looked_up_by_name(self):
+        table = Table(['id', 'name', 'id'], [(1, 'sri', 10), (2, 'anshu', 20)])
+        self.assertEqual(table.column_index('name'), 1)
+        self.assertEqual(table.column_index('id'), 0)
+        self.assertEqual(table.column_index('missing'), None)
+        self.assertEqual(table.column('name'), ['sri', 'anshu'])
+        self.assertEqual(table.column_at(2), [10, 20])
+        self.assertIs(table.column('name'), table.column('name'))
+        with self.assertRaises(KeyError):
+            table.column('missing')
+
+    def test_rows_are_materialized_lazily(self):
+        table = Table.from_columns(['id', 'name'], [(1, 2), ('sri', 'anshu')])
+        self.assertEqual(len(table), 2)
+        self.assertEqual(table.column('id'), [1, 2])
+        self.assertEqual(table.data, [(1, 'sri'), (2, 'anshu')])
+        self.assertEqual(table.as_dict(), [{'id': 1, 'name': 'sri'}, {'id': 2, 'name': 'anshu'}])
+        self.assertEqual(len(Table.from_columns([], [])), 0)
+
+    def test_tables_do_not_accept_new_attributes(self):
+        with self.assertRaises(AttributeError):
+            Table().rows = []
+
+    def test_nested_columns_are_unflattened(self):
+        columns = ['id', 'author.id', 'author.address.city', 'title', 'author.name', 'editor.id']
+        table = Table(columns, [(1, 10, 'Pune', 'Hello', 'sri', 20), (2, 11, None, 'World', 'anshu', None)])
+        result = table.as_dict()
+        self.assertEqual(result, [Table.unflatten(dict(zip(columns, row))) for row in table.data])
+        self.assertEqual(list(result[0].keys()), ['id', 'author', 'title', 'editor'])
+        self.assertEqual(result[0]['author'], {'id': 10, 'address': {'city': 'Pune'}, 'name': 'sri'})
+        self.assertIsNot(result[0]['author'], result[1]['author'])
+        self.assertTrue(table.requires_unflattening)
+        self.assertFalse(Table(['id'], [(1,)]).requires_unflattening)
+
+    def test_unflatten_plan_is_cached_by_column_layout(self):
+        self.assertIs(_unflatten_plan(['a.b', 'c']), _unflatten_plan(('a.b', 'c')))
+        self.assertIsNot(_unflatten_plan(['a.b', 'c']), _unflatten_plan(['a.b', 'd']))
+
+    def test_table_proxy(self):
+        table = Table(['id', 'name'], [(1, 'sri'), (2, 'anshu')])
+        as_list = TableProxy(table, 'list')
+        as_object = TableProxy(table, 'object')
+        self.assertEqual(as_list.id, [1, 2])
+        self.assertIs(as_list.id, as_list.id)
+        self.assertEqual(as_object.name, 'sri')
+        with self.assertRaises(AttributeError):
+            as_list.missing
+
+class MergeTests(unittest.TestCase):
+    def setUp(self):
+        self.squealy = Squealy()
+        self.squealy.add_engine('default', InMemorySqliteEngine())
+
+    def test_grandchildren_are_merged_into_children(self):
+        queries = [{
+            "contextKey": "questions",
+            "queryForList": "SELECT 100 as id UNION ALL SELECT 200 as id UNION ALL SELECT 300 as id"
+        }, {
+            "key": "comments",
+            "contextKey": "comments",
+            "merge": {"parent": "id", "child": "qid"},
+            "queryForList": """
+                SELECT * FROM (
+                    SELECT 101 as id, 100 as qid UNION ALL
+                    SELECT 102 as id, 100 as qid UNION ALL
+                    SELECT 201 as id, 200 as qid
+                ) WHERE qid in {{ questions.id | inclause }}
+            """
+        }, {
+            "key": "replies",
+            "merge": {"parent": "id", "child": "cid", "path": "comments"},
+            "queryForList": """
+                SELECT * FROM (
+                    SELECT 1 as cid, 'first' as reply UNION ALL
+                    SELECT 102 as cid, 'second' as reply UNION ALL
+                    SELECT 102 as cid, 'third' as reply UNION ALL
+                    SELECT 201 as cid, 'fourth' as reply
+                ) WHERE cid in {{ comments.id | inclause }}
+            """
+        }]
+        resource = Resource("nested", queries=queries)
+        data = resource.process(self.squealy, {"params": {}})['data']
+        self.assertEqual(data, [
+            {'id': 100, 'comments': [
+                {'id': 101, 'qid': 100, 'replies': []},
+                {'id': 102, 'qid': 100, 'replies': [{'cid': 102, 'reply': 'second'}, {'cid': 102, 'reply': 'third'}]}
+            ]},
+            {'id': 200, 'comments': [{'id': 201, 'qid': 200, 'replies': [{'cid': 201, 'reply': 'fourth'}]}]},
+            {'id': 300, 'comments': []}
+        ])
+
+    def test_merge_into_an_object(self):
+        queries = [{
+            "queryForObject": "SELECT 1 as id, 'sri' as name"
+        }, {
+            "key": "questions",
+            "queryForList": "SELECT 100 as id UNION ALL SELECT 200 as id"
+        }, {
+            "key": "comments",
+            "merge": {"parent": "id", "child": "qid", "path": "questions"},
+            "queryForList": "SELECT 100 as qid, 'nice' as comment"
+        }]
+        resource = Resource("profile", queries=queries)
+        data = resource.process(self.squealy, {"params": {}})['data']
+        self.assertEqual(data['questions'], [
+            {'id': 100, 'comments': [{'qid': 100, 'comment': 'nice'}]},
+            {'id': 200, 'comments': []}
+        ])
+
+    def test_merge_path_must_refer_to_earlier_query(self):
+        with self.assertRaises(SquealyConfigException):
+            Resource("bad-path", queries=[
+                {"queryForList": "SELECT 1 as id"},
+                {"key": "replies", "merge": {"parent": "id", "child": "cid", "path": "comments"}, 
+                    "queryForList": "SELECT 1 as cid"}
+            ])
+
+class EncoderTests(unittest.TestCase):
+    def setUp(self):
+        self.table = Table(['id', 'price', 'created', 'author.name', 'author.photo', '100%', 'mixed'], [
+            (1, Decimal('10.50'), datetime(2020, 1, 2, 3, 4, 5), 'sri', b'\x00\x01', 0.5, 'a'),
+            (2, None, None, 'Ānshu "quoted"', None, float('nan'), 2),
+            (3, Decimal('1'), datetime(2020, 1, 3), None, b'', None, None),
+        ])
+        self.query = Query(isRoot=True, queryForList="SELECT 1")
+        self.encoder = TableEncoder()
+
+    def assertSameJson(self, formatter, query=None):
+        query = query or self.query
+        expected = json.loads(json.dumps(formatter.format(None, query, self.table), default=convert))
+        actual = formatter.encode(query, self.table, self.encoder)
+        self.assertEqual(json.loads(actual), expected)
+
+    def test_encode_json_formatter(self):
+        self.assertSameJson(JsonFormatter())
+        self.assertSameJson(JsonFormatter(), Query(isRoot=True, queryForObject="SELECT 1"))
+
+    def test_encode_other_formatters(self):
+        self.assertSameJson(SimpleFormatter())
+        self.assertSameJson(SeriesFormatter())
+        self.assertSameJson(GoogleChartsFormatter())
+
+    def test_encode_values(self):
+        row = json.loads(self.encoder.encode_objects(self.table, limit=1)[0])
+        self.assertEqual(row['price'], '10.50')
+        self.assertEqual(row['created'], '2020-01-02T03:04:05')
+        self.assertEqual(row['author'], {'name': 'sri', 'photo': 'AAE='})
+        self.assertEqual(row['100%'], 0.5)
+
+    def test_encode_json_and_array_columns(self):
+        # Like the json, jsonb and array columns of PostgreSQL
+        table = Table(['id', 'tags', 'scores'], [(1, {'a': 1}, [1, 2]), (2, None, [])])
+        self.assertEqual(json.loads(JsonFormatter().encode(self.query, table, self.encoder)),
+            {'data': [{'id': 1, 'tags': {'a': 1}, 'scores': [1, 2]}, {'id': 2, 'tags': None, 'scores': []}]})
+        table = Table(['prices'], [({'price': Decimal('1.5')},)])
+        self.assertEqual(self.encoder.encode_objects(table), ['{"prices": {"price": "1.5"}}'])
+
+    def test_encode_subclasses_of_native_types(self):
+        class Size(IntEnum):
+            SMALL = 1
+        class Name(str):
+            pass
+        table = Table(['size', 'name'], [(Size.SMALL, Name('sri'))])
+        self.assertEqual(self.encoder.encode_objects(table), ['{"size": 1, "name": "sri"}'])
+
+    def test_repeated_columns_fall_back_to_dicts(self):
+        table = Table(['id', 'id'], [(1, 2)])
+        self.assertEqual(self.encoder.encode_objects(table), ['{"id": 2}'])
+
+    def test_process_json(self):
+        squealy = Squealy()
+        squealy.add_engine('default', InMemorySqliteEngine())
+        single = Resource("single", queries=[{"queryForObject": "SELECT 1 as id, 'sri' as name"}])
+        multiple = Resource("multiple", queries=[
+            {"key": "a", "queryForObject": "SELECT 1 as id"},
+            {"key": "b", "queryForList": "SELECT 2 as id"},
+        ])
+        self.assertEqual(json.loads(single.process_json(squealy, {"params": {}})), {'data': {'id': 1, 'name': 'sri'}})
+        self.assertEqual(json.loads(multiple.process_json(squealy, {"params": {}})), {'data': {'a': {'id': 1}, 'b': [{'id': 2}]}})
+
 class FormatterTests(unittest.TestCase):
     def setUp(self):
         snippet = '''
@@ -211,6 +1540,15 @@ class FormatterTests(unittest.TestCase):
             {'c': [{'v': 'mar'}, {'v': 98}]}
         ])
 
+    def test_google_charts_column_types_consider_every_row(self):
+        formatter = GoogleChartsFormatter()
+        table = Table(['sales', 'label', 'flag', 'empty', 'mixed'],
+                      [(None, None, True, None, 1), (10, 'a', False, None, 'b'), (2.5, 'b', None, None, 2)])
+        self.assertEqual(formatter._find_column_types(table), ['number', 'string', 'string', 'string', 'string'])
+        data = formatter.format({}, None, table)
+        self.assertEqual([col['type'] for col in data['cols']], ['number', 'string', 'string', 'string', 'string'])
+        self.assertEqual(json.loads(formatter.encode(None, table, TableEncoder())), json.loads(json.dumps(data)))
+
     def test_json_formatter(self):
         resource = self._clone_resource("monthly-sales", JsonFormatter())
         data = resource.process(self.squealy, {"params": {}})
@@ -221,6 +1559,18 @@ class FormatterTests(unittest.TestCase):
         self.assertEqual(data[2], {'month': 'mar', 'sales': 98})
 
 
+    def test_custom_format_is_not_bypassed_by_encode(self):
+        class CountingFormatter(JsonFormatter):
+            def format(self, prev_results, query, table):
+                results = super().format(prev_results, query, table)
+                results['count'] = len(table)
+                return results
+
+        resource = self._clone_resource("monthly-sales", CountingFormatter())
+        data = resource.process(self.squealy, {"params": {}})
+        self.assertEqual(data['count'], 3)
+        self.assertEqual(json.loads(resource.process_json(self.squealy, {"params": {}})), data)
+
     def _clone_resource(self, resource_name, formatter):
         resource = self.squealy.get_resource(resource_name)
         cloned = Resource(uuid4(), queries=resource.queries, datasource=resource.datasource, formatter=formatter)